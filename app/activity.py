@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+"""
+Write-behind tracking of UserPrefs.date_lastactivity and date_lastlogin.
+
+Putting the UserPrefs on every request would double the datastore writes
+and evict the cached object each time. Instead, record() keeps the latest
+timestamps in memcache and marks the user as dirty, and flush() (a cron
+job, /services/activity/flush) writes all dirty users in batches:
+
+    activity.record(userprefs)              # any request of a user
+    activity.record(userprefs, login=True)  # after a login
+
+- An instance records the activity of a user at most once per
+  settings.ACTIVITY_RESOLUTION_SECONDS (tracked in process memory), with
+  one incr and one set_multi memcache RPC.
+- Dirty users are numbered by a memcache sequence counter, so flush()
+  reads the users marked since its last run by key instead of scanning.
+- flush() updates the users in cross-group transactions of up to 25
+  entities with one put_multi each, so a concurrent change of a user's
+  settings is never overwritten. Users whose transaction failed are
+  marked dirty again for the next flush. The cached UserPrefs are evicted
+  with one batch delete, instead of one delete per put.
+
+Activity recorded in memcache is lost if memcache evicts it before the next
+flush; the timestamps are for statistics only.
+"""
+import time
+import logging
+
+from datetime import datetime
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+
+import mc
+import settings
+from mc.tiered import LRUCache
+from models import UserPrefs
+
+# Memcache keys of the dirty marker sequence and of the last flushed marker
+SEQUENCE_KEY = "activity:sequence"
+FLUSHED_KEY = "activity:flushed"
+
+# Dirty markers and timestamps expire if they are not flushed within a day
+EXPIRES = 86400
+
+# Markers read per memcache RPC, and users per transaction (the maximum of
+# a cross-group transaction)
+FLUSH_BATCH_SIZE = 500
+TRANSACTION_SIZE = 25
+
+# Key names of the users this instance recorded recently
+_recent = LRUCache(10000)
+
+
+def _activity_key(key_name):
+    return "activity:last:%s" % key_name
+
+
+def _login_key(key_name):
+    return "activity:login:%s" % key_name
+
+
+def _marker_key(seq):
+    return "activity:dirty:%s" % seq
+
+
+def record(userprefs, login=False):
+    """Records the current time as the last activity (and the last login) of
+    the user"""
+    key_name = userprefs.key.id()
+    now = int(time.time())
+    if not login and _recent.get(key_name):
+        return
+    _recent.set(key_name, True, settings.ACTIVITY_RESOLUTION_SECONDS)
+
+    seq = memcache.incr(SEQUENCE_KEY, initial_value=0)
+    values = {_activity_key(key_name): now}
+    if login:
+        values[_login_key(key_name)] = now
+    if seq:
+        values[_marker_key(seq)] = key_name
+    memcache.set_multi(values, time=EXPIRES)
+
+
+def flush():
+    """Writes the recorded timestamps of all dirty users to their UserPrefs.
+    Returns the number of updated users."""
+    seq = memcache.get(SEQUENCE_KEY) or 0
+    flushed = memcache.get(FLUSHED_KEY)
+    if flushed is None or flushed > seq:
+        # Evicted counters: markers older than a day are expired anyway
+        flushed = 0
+
+    updated = 0
+    while flushed < seq:
+        last = min(seq, flushed + FLUSH_BATCH_SIZE)
+        markers = memcache.get_multi([_marker_key(n)
+                for n in xrange(flushed + 1, last + 1)])
+        written, failed = _flush_users(set(markers.itervalues()))
+        updated += written
+        if failed and not _mark_dirty(failed):
+            # Retry the batch with the next flush
+            break
+        flushed = last
+        memcache.set(FLUSHED_KEY, flushed)
+
+    logging.info("Activity: updated %s users", updated)
+    return updated
+
+
+def _mark_dirty(key_names):
+    """Adds new dirty markers for the users, so a later flush writes them.
+    Returns False if that failed."""
+    last = memcache.incr(SEQUENCE_KEY, delta=len(key_names), initial_value=0)
+    if not last:
+        return False
+    first = last - len(key_names) + 1
+    return not memcache.set_multi(dict((_marker_key(first + i), key_name)
+            for i, key_name in enumerate(key_names)), time=EXPIRES)
+
+
+def _flush_users(key_names):
+    """Writes the recorded timestamps of the users to their UserPrefs and
+    evicts them from the cache. Returns the number of updated users and
+    the list of users whose update failed."""
+    key_names = list(key_names)
+    cached = memcache.get_multi([_activity_key(k) for k in key_names] +
+            [_login_key(k) for k in key_names])
+
+    @ndb.tasklet
+    def update(batch):
+        entities = yield ndb.get_multi_async([ndb.Key(UserPrefs, key_name)
+                for key_name in batch])
+        changed = []
+        for prefs in entities:
+            if not prefs:
+                continue
+            key_name = prefs.key.id()
+            last = cached.get(_activity_key(key_name))
+            login = cached.get(_login_key(key_name))
+            if last:
+                prefs.date_lastactivity = max(prefs.date_lastactivity,
+                        datetime.utcfromtimestamp(last))
+            if login:
+                prefs.date_lastlogin = max(prefs.date_lastlogin,
+                        datetime.utcfromtimestamp(login))
+            prefs._activity_only = True
+            changed.append(prefs)
+        yield ndb.put_multi_async(changed)
+        for prefs in changed:
+            del prefs._activity_only
+        raise ndb.Return(changed)
+
+    futures = [ndb.transaction_async(
+            lambda batch=key_names[i:i + TRANSACTION_SIZE]: update(batch),
+            xg=True) for i in xrange(0, len(key_names), TRANSACTION_SIZE)]
+    ndb.Future.wait_all(futures)
+
+    # Evict the cached objects with one RPC. Not updated in place: that
+    # could overwrite a settings change that was cached in the meantime.
+    written = []
+    failed = []
+    for i, future in enumerate(futures):
+        if future.get_exception():
+            logging.warning("Activity: update failed: %r",
+                    future.get_exception())
+            failed.extend(key_names[i * TRANSACTION_SIZE:
+                    (i + 1) * TRANSACTION_SIZE])
+            continue
+        written.extend(prefs.key.id() for prefs in future.get_result())
+    if written:
+        mc.cache.userprefs_cache.delete_multi([u"%s" % key_name
+                for key_name in written])
+    return len(written), failed
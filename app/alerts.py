@@ -0,0 +1,270 @@
+# -*- coding: utf-8 -*-
+"""
+Streaming evaluation of alert rules (see models.AlertRule).
+
+Rules are evaluated as samples arrive: evaluate() is called by the ingest
+handler with the samples of a request, and updates a small rolling state
+per rule instead of querying the history of the series:
+
+- threshold rules keep the EWMA of the values
+- rate rules keep a ring buffer of the samples within their window
+- all rules keep the last seen timestamp, which absence rules are checked
+  against by a cron job (check_absence())
+
+The states of all rules of a request are read and written with one
+memcache RPC each, with compare-and-set: the rules whose state another
+request changed in the meantime are evaluated again on the new state, so
+concurrent ingests neither lose updates nor notify twice. The states are
+written through to the datastore (AlertState) when an alert fires or
+resolves, and at least every settings.ALERT_PERSIST_SECONDS, so a memcache
+eviction loses little.
+
+Firing and resolved alerts wake up the polling dashboards (see changes.py)
+and are sent as emails by the services.py mail worker
+(/services/cron1-worker1).
+"""
+import time
+import logging
+import calendar
+
+from google.appengine.api import memcache
+from google.appengine.api import taskqueue
+from google.appengine.ext import ndb
+
+import changes
+import mc
+import settings
+from models import AlertState, Emails
+
+# Maximum number of samples in the ring buffer of a rate rule
+RING_SIZE = 64
+
+# Attempts to write the states with compare-and-set, before the updates of
+# the rules that are still changed concurrently are dropped
+CAS_ATTEMPTS = 3
+
+
+def evaluate(project, samples):
+    """Updates the state of the project's alert rules with an iterable of
+    (series, timestamp, value) samples"""
+    rules = mc.cache.get_alert_rules(project.key)
+    if not rules:
+        return
+
+    by_series = {}
+    for rule in rules:
+        by_series.setdefault(rule.series, []).append(rule)
+
+    points = {}
+    for series, timestamp, value in samples:
+        if series in by_series:
+            points.setdefault(series, []).append((timestamp, value))
+    if not points:
+        return
+
+    for series in points:
+        points[series].sort()
+
+    def apply_samples(rule, state):
+        for timestamp, value in points[rule.series]:
+            update(rule, state, timestamp, value)
+
+    update_states([rule for series in points for rule in by_series[series]],
+            apply_samples)
+
+
+def check_absence(rules):
+    """Fires the absence rules whose series got no sample within their
+    window (called from cron for all absence rules)"""
+    update_states(rules, lambda rule, state: None)
+
+
+def update_states(rules, func):
+    """Applies func(rule, state) to the states of the rules, fires or
+    resolves them and saves the states with compare-and-set. Rules whose
+    state was changed concurrently are updated again on the new state."""
+    client = memcache.Client()
+    for attempt in xrange(CAS_ATTEMPTS):
+        states, cached = _load_states(rules, client)
+        now = time.time()
+        changed = []
+        for rule in rules:
+            state = states[rule.key.id()]
+            func(rule, state)
+            if set_firing(rule, state, is_firing(rule, state, now)):
+                changed.append(rule)
+
+        rules = save_states(rules, states, changed, client, cached)
+        if not rules:
+            return
+    logging.warning("Alert states of %s rules changed concurrently, update "
+            "dropped", len(rules))
+
+
+def update(rule, state, timestamp, value):
+    """Updates the rolling state of a rule with one sample"""
+    if timestamp < state.get("last_seen", 0):
+        # Late samples only count for the absence of data
+        return
+    state["last_seen"] = timestamp
+    state["last_value"] = value
+
+    if rule.kind == "threshold":
+        ewma = state.get("ewma")
+        state["ewma"] = value if ewma is None else \
+                rule.alpha * value + (1 - rule.alpha) * ewma
+
+    elif rule.kind == "rate":
+        ring = state.setdefault("ring", [])
+        ring.append((timestamp, value))
+        while len(ring) > RING_SIZE or ring[0][0] < timestamp - rule.window:
+            ring.pop(0)
+
+
+def is_firing(rule, state, now):
+    """Returns True if the rule fires in this state"""
+    if rule.kind == "absence":
+        # A series that never reported counts from the rule's creation
+        last_seen = state.get("last_seen", state.get("created", now))
+        return now - last_seen > rule.window
+
+    if rule.kind == "threshold":
+        value = state.get("ewma")
+    else:
+        ring = state.get("ring")
+        if not ring or len(ring) < 2 or ring[-1][0] == ring[0][0]:
+            return False
+        value = (ring[-1][1] - ring[0][1]) / float(ring[-1][0] - ring[0][0])
+
+    if value is None:
+        return False
+    if rule.op == ">":
+        return value > rule.threshold
+    return value < rule.threshold
+
+
+def set_firing(rule, state, firing):
+    """Sets the firing flag of the state. Returns True if it changed, in
+    which case save_states() notifies about it."""
+    if bool(state.get("firing")) is firing:
+        return False
+    state["firing"] = firing
+    state["since"] = int(time.time())
+    return True
+
+
+def notify(rule, state):
+    """Queues an email about a firing or resolved alert for the mail
+    worker"""
+    if not rule.notify:
+        return
+
+    status = "FIRING" if state["firing"] else "resolved"
+    text = "Alert %s for %s: %s rule (%s %s, window %ss). Last value: %s" % (
+            status, rule.series, rule.kind, rule.op, rule.threshold,
+            rule.window, state.get("last_value"))
+    email = Emails(to=rule.notify, subject="[Thatstat] %s: %s" % (status,
+            rule.series), body_text=text, body_html="<p>%s</p>" % text)
+    email.put()
+    taskqueue.add(url='/services/cron1-worker1',
+            params={"keys": email.key.urlsafe()})
+    logging.info("Alert %s: rule %s", status, rule.key.id())
+
+
+def load_states(rules):
+    """Returns a dict of {rule id: state} from memcache, falling back to
+    the written-through AlertState entities"""
+    return _load_states(rules)[0]
+
+
+def _load_states(rules, client=None):
+    """Returns ({rule id: state}, set of the rule ids whose state was found
+    in memcache). With a memcache.Client, the states are read for a later
+    compare-and-set with it."""
+    keys = dict((rule.key.id(), _state_key(rule)) for rule in rules)
+    if client:
+        cached = client.get_multi(keys.values(), for_cas=True)
+    else:
+        cached = memcache.get_multi(keys.values())
+
+    states = {}
+    missing = []
+    for rule_id, key in keys.iteritems():
+        if key in cached:
+            states[rule_id] = cached[key]
+        else:
+            missing.append(rule_id)
+
+    if missing:
+        stored = ndb.get_multi([ndb.Key(AlertState, rule_id)
+                for rule_id in missing])
+        for rule_id, entity in zip(missing, stored):
+            states[rule_id] = entity.state if entity else {}
+
+    for rule in rules:
+        state = states[rule.key.id()]
+        if "last_seen" not in state and "created" not in state:
+            state["created"] = _created(rule)
+    return states, set(keys) - set(missing)
+
+
+def save_states(rules, states, changed=(), client=None, cached=()):
+    """Writes all states to memcache with one RPC, and writes them through
+    to the datastore if they changed or were not persisted recently.
+    Notifies about the changed rules.
+
+    With a memcache.Client, the states of the rule ids in cached are
+    written with compare-and-set and the others only if they are still not
+    in memcache. Returns the rules whose state was not written because it
+    changed in the meantime."""
+    now = int(time.time())
+    persist = set()
+    for rule in rules:
+        state = states[rule.key.id()]
+        if rule in changed or now - state.get("persisted", 0) > \
+                settings.ALERT_PERSIST_SECONDS:
+            state["persisted"] = now
+            persist.add(rule.key.id())
+
+    mapping = dict((_state_key(rule), states[rule.key.id()])
+            for rule in rules)
+    failed = set()
+    if client:
+        cas = [_state_key(rule) for rule in rules if rule.key.id() in cached]
+        add = [_state_key(rule) for rule in rules
+                if rule.key.id() not in cached]
+        if cas:
+            failed.update(client.cas_multi(dict((key, mapping[key])
+                    for key in cas)) or [])
+        if add:
+            failed.update(client.add_multi(dict((key, mapping[key])
+                    for key in add)) or [])
+    else:
+        memcache.set_multi(mapping)
+
+    saved = [rule for rule in rules if _state_key(rule) not in failed]
+    entities = [AlertState(id=rule.key.id(), state=states[rule.key.id()])
+            for rule in saved if rule.key.id() in persist]
+    if entities:
+        ndb.put_multi(entities)
+
+    changed = [rule for rule in saved if rule in changed]
+    for rule in changed:
+        notify(rule, states[rule.key.id()])
+
+    # Wakes up the dashboards polling for changes
+    for project_key in set(rule.project for rule in changed):
+        changes.notify(project_key)
+    return [rule for rule in rules if _state_key(rule) in failed]
+
+
+def _created(rule):
+    """Returns the creation time of a rule in unix seconds (now for rules
+    created before it was recorded)"""
+    if rule.date_created:
+        return calendar.timegm(rule.date_created.timetuple())
+    return int(time.time())
+
+
+def _state_key(rule):
+    return "alertstate:%s" % rule.key.id()
@@ -0,0 +1,204 @@
+# -*- coding: utf-8 -*-
+"""
+Batch anomaly detection over all series of a project.
+
+An hourly cron job (/services/anomaly) enqueues one task per project. The
+task (/services/anomaly/project, detect()) loads the hourly rollups of the
+last settings.ANOMALY_DAYS of the project's series, a page of series at a
+time, into a NumPy matrix with one row per series and one column per
+bucket (NaN where a bucket has no samples). The bucket means of the last
+complete hour are then scored for all series at once:
+
+- ewma: z-score against the exponentially weighted moving mean and
+  variance of the preceding buckets
+- seasonal: z-score against the mean and standard deviation of the same
+  hour on the preceding days (settings.ANOMALY_SEASON)
+
+Only the EWMA recursion loops in Python, over the columns (one step per
+bucket for all series), never over single points. Scores above
+settings.ANOMALY_THRESHOLD are stored as AnomalyCandidate entities.
+
+Series are found through their rollup chunk of the current period, so
+series that stopped reporting are not scored (absence alert rules cover
+them). A task that takes longer than TASK_SECONDS continues with the
+next page in a new task for the same bucket, named after project, bucket
+and cursor so that a retried task does not continue twice.
+"""
+import time
+import logging
+
+from hashlib import md5
+
+import numpy as np
+
+from google.appengine.api import taskqueue
+from google.appengine.ext import ndb
+
+import settings
+import tools.fanout as fanout
+from models import AnomalyCandidate, Project, RollupChunk
+
+QUEUE = "anomaly"
+
+# Rollup chunks of the current period loaded per page
+PAGE_SIZE = 500
+
+# Stop paging and continue in a new task after this many seconds
+TASK_SECONDS = 300
+
+# Lower bound of the standard deviation, relative to the mean, so that the
+# first change of an almost constant series is not an extreme z-score
+MIN_RELATIVE_STD = 0.01
+
+
+def enqueue_projects():
+    """Enqueues one detection task per project"""
+    tasks = [taskqueue.Task(url="/services/anomaly/project",
+            params={"project": key.id()})
+            for key in Project.query().iter(keys_only=True)]
+    fanout.add_tasks(tasks, QUEUE)
+    logging.info("Enqueued %s anomaly detection tasks", len(tasks))
+
+
+def load_matrix(chunks, first, columns, resolution):
+    """Returns a (len(chunks) series x columns) matrix of the bucket means
+    of lists of RollupChunks (one list per series), where column 0 is the
+    bucket starting at first"""
+    matrix = np.empty((len(chunks), columns))
+    matrix.fill(np.nan)
+    for row, series_chunks in enumerate(chunks):
+        for chunk in series_chunks:
+            # start, min, max, sum, count, last per bucket (no copy)
+            buckets = np.frombuffer(chunk.data or "", dtype=np.float64)
+            buckets = buckets.reshape(-1, 6)
+            column = ((buckets[:, 0] - first) // resolution).astype(int)
+            valid = (column >= 0) & (column < columns) & (buckets[:, 4] > 0)
+            matrix[row, column[valid]] = buckets[valid, 3] / buckets[valid, 4]
+    return matrix
+
+
+def _std_floor(std, mean):
+    return np.maximum(std, MIN_RELATIVE_STD * np.abs(mean) + 1e-9)
+
+
+def ewma_scores(matrix, alpha):
+    """Returns the (z-scores, expected values) of the last column of the
+    matrix against the EWMA mean and variance of the columns before it.
+    NaN buckets are skipped."""
+    rows, columns = matrix.shape
+    mean = matrix[:, 0].copy()
+    var = np.zeros(rows)
+    for column in xrange(1, columns - 1):
+        x = matrix[:, column]
+        valid = ~np.isnan(x)
+        first = valid & np.isnan(mean)
+        mean[first] = x[first]
+
+        update = valid & ~first
+        diff = x[update] - mean[update]
+        increment = alpha * diff
+        mean[update] += increment
+        var[update] = (1 - alpha) * (var[update] + diff * increment)
+
+    scores = (matrix[:, -1] - mean) / _std_floor(np.sqrt(var), mean)
+    return scores, mean
+
+
+def seasonal_scores(matrix, period):
+    """Returns the (z-scores, expected values) of the last column of the
+    matrix against the columns one or more periods (in columns) before it"""
+    columns = matrix.shape[1]
+    same_phase = matrix[:, np.arange(columns - 1 - period, -1, -period)]
+    valid = ~np.isnan(same_phase)
+    count = valid.sum(axis=1)
+
+    mean = np.where(valid, same_phase, 0.0).sum(axis=1) / \
+            np.maximum(count, 1)
+    deviation = np.where(valid, same_phase - mean[:, np.newaxis], 0.0)
+    std = np.sqrt((deviation ** 2).sum(axis=1) / np.maximum(count - 1, 1))
+
+    scores = (matrix[:, -1] - mean) / _std_floor(std, mean)
+    scores[count < 3] = np.nan
+    return scores, mean
+
+
+def score(matrix):
+    """Returns a list of (row, method, score, value, expected) of the
+    anomalies in the last column of the matrix"""
+    resolution = settings.ANOMALY_RESOLUTION
+    history = (~np.isnan(matrix[:, :-1])).sum(axis=1)
+    scored = (history >= settings.ANOMALY_MIN_POINTS) & \
+            ~np.isnan(matrix[:, -1])
+
+    findings = []
+    for method, (scores, expected) in (
+            ("ewma", ewma_scores(matrix, settings.ANOMALY_ALPHA)),
+            ("seasonal", seasonal_scores(matrix,
+                    settings.ANOMALY_SEASON // resolution))):
+        with np.errstate(invalid="ignore"):
+            anomalous = scored & (np.abs(scores) > settings.ANOMALY_THRESHOLD)
+        for row in np.nonzero(anomalous)[0]:
+            findings.append((row, method, float(scores[row]),
+                    float(matrix[row, -1]), float(expected[row])))
+    return findings
+
+
+def detect(project_key, end=None, cursor=None):
+    """Scores the last complete bucket before end (unix seconds) of all
+    series of the project and stores the anomalies. Returns the number of
+    anomalies."""
+    started = time.time()
+    resolution = settings.ANOMALY_RESOLUTION
+    period = settings.ROLLUP_PERIODS[resolution]
+    end = end or int(started) - settings.ROLLUP_SETTLE_SECONDS
+    end -= end % resolution
+    columns = settings.ANOMALY_DAYS * 86400 // resolution
+    first = end - columns * resolution
+    current = RollupChunk.period_start(resolution, end - resolution)
+
+    q = RollupChunk.query(RollupChunk.project == project_key,
+            RollupChunk.resolution == resolution,
+            RollupChunk.start == current)
+    found = 0
+    more = True
+    while more:
+        chunks, cursor, more = q.fetch_page(PAGE_SIZE, start_cursor=cursor)
+
+        # Earlier chunks within the analysed days, with one batch get
+        earlier = [[RollupChunk.key_for(project_key, chunk.series,
+                resolution, start) for start in xrange(
+                        RollupChunk.period_start(resolution, first), current,
+                        period)] for chunk in chunks]
+        loaded = iter(ndb.get_multi([key for keys in earlier
+                for key in keys]))
+        series_chunks = [[c for c in [next(loaded) for key in keys] if c] +
+                [chunk] for chunk, keys in zip(chunks, earlier)]
+
+        matrix = load_matrix(series_chunks, first, columns, resolution)
+        candidates = [AnomalyCandidate(key=AnomalyCandidate.key_for(
+                project_key, chunks[row].series, end - resolution, method),
+                project=project_key, series=chunks[row].series,
+                timestamp=end - resolution, method=method, score=z,
+                value=value, expected=expected)
+                for row, method, z, value, expected in score(matrix)]
+        ndb.put_multi(candidates)
+        found += len(candidates)
+
+        if more and time.time() - started > TASK_SECONDS:
+            # Named, so a retry of this task does not start a second chain
+            cursor = cursor.urlsafe()
+            try:
+                taskqueue.add(url="/services/anomaly/project",
+                        queue_name=QUEUE, name="anomaly-%s-%s-%s" % (
+                                project_key.id(), end,
+                                md5(cursor).hexdigest()),
+                        params={"project": project_key.id(), "end": end,
+                                "cursor": cursor})
+            except (taskqueue.TaskAlreadyExistsError,
+                    taskqueue.TombstonedTaskError):
+                pass
+            break
+
+    logging.info("Anomaly detection of project %s: %s anomalies",
+            project_key.id(), found)
+    return found
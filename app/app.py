@@ -1,26 +1,39 @@
 # -*- coding: utf-8 -*-
+import tools.importprofile
+if tools.importprofile.enabled():
+    tools.importprofile.install()
+
 import os
-from google.appengine.dist import use_library
 os.environ['DJANGO_SETTINGS_MODULE'] = 'settings'
-use_library('django', '1.2')
 
 from google.appengine.ext import webapp
 from google.appengine.ext.webapp.util import run_wsgi_app
 
-# Load request handlers
-import handlers
+import tools.stats
 
-# Map url's to handlers
+# Map url's to handlers. Handlers are referenced by name, so that a handler
+# module is only imported when one of its urls is requested the first time.
 urls = [
-    (r'/', handlers.Main),
-    (r'/login', handlers.LogIn),
-    (r'/_ah/login_required', handlers.LogIn),
-    (r'/logout', handlers.LogOut),
-    (r'/account', handlers.Account),
-    (r'/account/setup', handlers.AccountSetup),
+    (r'/', 'handlers.main.Main'),
+    (r'/login', 'handlers.main.LogIn'),
+    (r'/_ah/login_required', 'handlers.main.LogIn'),
+    (r'/logout', 'handlers.main.LogOut'),
+    (r'/account', 'handlers.main.Account'),
+    (r'/account/setup', 'handlers.main.AccountSetup'),
+
+    # Metric ingest API for monitoring agents
+    (r'/api/v1/ingest', 'handlers.ingest.Ingest'),
+    (r'/api/v1/export', 'handlers.export.Export'),
+    (r'/api/v1/poll', 'handlers.poll.Poll'),
+    (r'/api/v1/series', 'handlers.series.Series'),
+
+    # Loads handlers and compiles templates before a new instance gets traffic
+    (r'/_ah/warmup', 'handlers.warmup.Warmup'),
 ]
 
-application = webapp.WSGIApplication(urls, debug=True)
+# Request stats middleware (see tools/stats.py and /services/stats)
+application = tools.stats.StatsMiddleware(
+        webapp.WSGIApplication(urls, debug=True))
 
 
 def main():
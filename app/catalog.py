@@ -0,0 +1,284 @@
+# -*- coding: utf-8 -*-
+"""
+Catalog of the series of a project with an inverted index of their labels.
+
+Series names can carry labels, eg. "cpu{host=web1,region=eu,service=api}".
+Every series gets an integer id when it is first ingested, and the id is
+added to the posting of each of its label pairs, including
+__name__=<metric name>. A posting is a sorted uint32 array of series ids.
+
+register() is called by the ingest path. It only checks which series are
+new (usually from process memory) and enqueues tasks on the "catalog" queue
+(/services/catalog/register, add_series()) to add them, so ingest never
+waits for or fails on the catalog. Failures are logged, and a series that
+was not registered is tried again by a later ingest.
+
+Selectors are answered from the postings alone, without a datastore query:
+
+    catalog.select(project.key, "cpu{region=eu,service=api}")
+    -> [u"cpu{host=web1,region=eu,service=api}", ...]
+
+select() gets the postings of the selector's label pairs from the tiered
+cache (usually from process memory) and intersects them in memory.
+
+All catalog entities of a project are children of its SeriesCatalog, so a
+registration updates the ids, names and postings in one transaction. Ids are
+allocated in ascending order, so new ids are appended to the postings and
+they stay sorted. The entity group allows about one write per second, so
+the queue runs few registrations at a time; many hosts that start sending
+new series at once are registered one batch after the other, and a batch
+skips the series that an earlier one registered already.
+
+A posting can hold about 250,000 ids (the entity size limit of 1 MB).
+"""
+import re
+import logging
+
+from array import array
+from google.appengine.api import taskqueue
+from google.appengine.ext import ndb
+
+import settings
+import tools.fanout as fanout
+from mc import tiered
+from models import SeriesCatalog, SeriesId, SeriesNames, SeriesPosting
+
+QUEUE = "catalog"
+
+# Series names per SeriesNames page
+PAGE_SIZE = 5000
+
+# Entities written per registration transaction (root, ids, name pages and
+# postings), below the limit of 500 per commit
+TRANSACTION_ENTITIES = 400
+
+# Name pages a transaction can touch (the series fit in less than one page)
+TRANSACTION_PAGES = 2
+
+# New series per registration task, to stay below the task size limit
+TASK_SIZE = 200
+
+NAME_LABEL = "__name__"
+
+_series_re = re.compile(r'^([^{}]*)(?:\{(.*)\})?$')
+
+# Postings and name pages, as raw strings. The local tier serves them for
+# 30s, so a series registered on another instance shows up after that.
+postings_cache = tiered.TieredCache("postings", ttl=24 * 3600, local_ttl=30)
+names_cache = tiered.TieredCache("seriesnames", ttl=24 * 3600, local_ttl=30)
+
+# Names of the series known to be registered, by "<project id>:<series>"
+_registered = tiered.LRUCache(100000)
+
+
+def parse(series):
+    """Returns the (metric name, {label: value}) of a series name or a
+    selector. Raises ValueError if it is malformed."""
+    match = _series_re.match(series.strip())
+    if not match:
+        raise ValueError("invalid series name: %s" % series)
+
+    name, labels = match.group(1).strip(), {}
+    for pair in (match.group(2) or "").split(","):
+        if not pair.strip():
+            continue
+        if "=" not in pair:
+            raise ValueError("invalid label in %s: %s" % (series, pair))
+        label, value = pair.split("=", 1)
+        labels[label.strip()] = value.strip().strip('"')
+    return name, labels
+
+
+def label_pairs(series):
+    """Returns the "label=value" posting names of a series or selector"""
+    name, labels = parse(series)
+    pairs = ["%s=%s" % item for item in sorted(labels.iteritems())]
+    if name:
+        pairs.insert(0, "%s=%s" % (NAME_LABEL, name))
+    return pairs
+
+
+def register(project_key, names):
+    """Enqueues the registration of the series that are not registered yet.
+    Called with the series of every ingest request; series that are known
+    to this instance cost nothing, others one batch get. Never raises."""
+    pid = project_key.id()
+    try:
+        names = [name for name in set(names)
+                if not _registered.get("%s:%s" % (pid, name))]
+        if not names:
+            return
+
+        root = SeriesCatalog.key_for(project_key)
+        existing = ndb.get_multi([ndb.Key(SeriesId, name, parent=root)
+                for name in names])
+        new = [name for name, entity in zip(names, existing) if not entity]
+        if new:
+            fanout.add_tasks([taskqueue.Task(
+                    url="/services/catalog/register",
+                    params={"project": pid, "names": new[i:i + TASK_SIZE]})
+                    for i in xrange(0, len(new), TASK_SIZE)], QUEUE)
+    except Exception:
+        logging.exception("Registering %s series of project %s failed",
+                len(names), pid)
+        return
+
+    for name in names:
+        _registered.set("%s:%s" % (pid, name), True, 3600)
+
+
+def add_series(project_key, names):
+    """Assigns ids to the new series and adds them to the name pages and
+    postings, in transactions of up to TRANSACTION_ENTITIES written
+    entities. Series that are invalid or too long are skipped."""
+    batch = []
+    pairs = set()
+    added = 0
+    for name in set(names):
+        try:
+            if len(name.encode("utf-8")) > settings.SERIES_MAX_BYTES:
+                raise ValueError("series name too long")
+            name_pairs = set(label_pairs(name))
+            if 1 + 1 + TRANSACTION_PAGES + len(name_pairs) > \
+                    TRANSACTION_ENTITIES:
+                raise ValueError("too many labels")
+        except ValueError as e:
+            logging.info("Not indexing series %r: %s", name, e)
+            continue
+
+        if 1 + len(batch) + 1 + TRANSACTION_PAGES + \
+                len(pairs | name_pairs) > TRANSACTION_ENTITIES:
+            added += _add_series_batch(project_key, batch)
+            batch = []
+            pairs = set()
+        batch.append(name)
+        pairs |= name_pairs
+
+    if batch:
+        added += _add_series_batch(project_key, batch)
+    logging.info("Registered %s series of project %s", added,
+            project_key.id())
+
+
+def _add_series_batch(project_key, names):
+    """Registers the series that are still new in one transaction. Returns
+    their number."""
+    root_key = SeriesCatalog.key_for(project_key)
+
+    @ndb.transactional
+    def txn():
+        root = root_key.get() or SeriesCatalog(key=root_key)
+        existing = ndb.get_multi([ndb.Key(SeriesId, name, parent=root_key)
+                for name in names])
+        new = [name for name, entity in zip(names, existing) if not entity]
+        if not new:
+            return 0, [], []
+
+        # Ids, pages and postings touched by the new series
+        by_pair = {}
+        entities = []
+        for name in new:
+            series_id = root.count
+            root.count += 1
+            entities.append(SeriesId(id=name, parent=root_key,
+                    series_id=series_id))
+            for pair in label_pairs(name):
+                by_pair.setdefault(pair, []).append(series_id)
+
+        first_page = (root.count - len(new)) // PAGE_SIZE
+        page_keys = [ndb.Key(SeriesNames, page, parent=root_key) for page in
+                xrange(first_page, (root.count - 1) // PAGE_SIZE + 1)]
+        posting_keys = [ndb.Key(SeriesPosting, pair, parent=root_key)
+                for pair in by_pair]
+        loaded = ndb.get_multi(page_keys + posting_keys)
+
+        pages = [page or SeriesNames(key=key, names=[])
+                for key, page in zip(page_keys, loaded)]
+        for entity in entities:
+            pages[entity.series_id // PAGE_SIZE - first_page].names.append(
+                    entity.key.id())
+
+        postings = [posting or SeriesPosting(key=key)
+                for key, posting in zip(posting_keys, loaded[len(pages):])]
+        for posting in postings:
+            ids = posting.get_ids()
+            ids.extend(by_pair[posting.key.id()])
+            posting.set_ids(ids)
+
+        ndb.put_multi([root] + entities + pages + postings)
+        return len(new), page_keys, posting_keys
+
+    added, page_keys, posting_keys = txn()
+    postings_cache.delete_multi([_cache_key(key) for key in posting_keys])
+    names_cache.delete_multi([_cache_key(key) for key in page_keys])
+    return added
+
+
+def _cache_key(key):
+    """Cache key of a catalog entity: "<project id>:<entity id>" """
+    return "%s:%s" % (key.parent().id(), key.id())
+
+
+def get_postings(project_key, pairs):
+    """Returns {pair: array of ids} for "label=value" pairs, from the cache
+    or the datastore (one batch get for all missing ones)"""
+    root_key = SeriesCatalog.key_for(project_key)
+    keys = dict(("%s:%s" % (project_key.id(), pair), pair) for pair in pairs)
+
+    def load(missing):
+        postings = ndb.get_multi([ndb.Key(SeriesPosting, keys[key],
+                parent=root_key) for key in missing])
+        return dict((key, posting.ids if posting else "")
+                for key, posting in zip(missing, postings))
+
+    cached = postings_cache.get_multi(keys.keys(), load)
+    return dict((pair, array('I', cached.get(key) or ""))
+            for key, pair in keys.iteritems())
+
+
+def get_names(project_key, ids):
+    """Returns the series names of a list of ids"""
+    root_key = SeriesCatalog.key_for(project_key)
+    pages = set(series_id // PAGE_SIZE for series_id in ids)
+    keys = dict(("%s:%s" % (project_key.id(), page), page) for page in pages)
+
+    def load(missing):
+        entities = ndb.get_multi([ndb.Key(SeriesNames, keys[key],
+                parent=root_key) for key in missing])
+        return dict((key, entity.names if entity else [])
+                for key, entity in zip(missing, entities))
+
+    cached = names_cache.get_multi(keys.keys(), load)
+    by_page = dict((keys[key], names) for key, names in cached.iteritems())
+    names = []
+    for series_id in ids:
+        page = by_page.get(series_id // PAGE_SIZE, [])
+        offset = series_id % PAGE_SIZE
+        if offset < len(page):
+            names.append(page[offset])
+    return names
+
+
+def intersect(postings):
+    """Returns the sorted ids contained in all postings (sorted arrays).
+    Starts with the smallest posting, so the work is bounded by it."""
+    postings = sorted(postings, key=len)
+    if not postings or not postings[0]:
+        return []
+    result = set(postings[0])
+    for posting in postings[1:]:
+        result.intersection_update(posting)
+        if not result:
+            return []
+    return sorted(result)
+
+
+def select(project_key, selector):
+    """Returns the names of the series matching a selector like
+    "cpu{region=eu,service=api}", "cpu" or "{host=web1}". Raises ValueError
+    if the selector is malformed or empty."""
+    pairs = label_pairs(selector)
+    if not pairs:
+        raise ValueError("empty selector")
+    postings = get_postings(project_key, pairs)
+    return get_names(project_key, intersect(postings.values()))
@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+"""
+Change notifications for long-polling dashboards (see handlers/poll.py).
+
+Every project has a version counter in memcache, which is incremented
+whenever new samples are stored (metrics.write_samples()) or an alert
+fires or resolves (alerts.save_states()). A waiting poll request only reads
+this counter, one small memcache get per settings.POLL_INTERVAL_SECONDS,
+and goes to the datastore once it changed:
+
+    version = changes.wait(project.key, last_version, timeout=25)
+
+If memcache evicts a counter, it starts again at 0. Waiting requests see
+this as a change and read once more, so no change is missed.
+"""
+import time
+
+from google.appengine.api import memcache
+
+import settings
+
+
+def _version_key(project_key):
+    return "changes:%s" % project_key.id()
+
+
+def notify(project_key):
+    """Increments the version of the project"""
+    memcache.incr(_version_key(project_key), initial_value=0)
+
+
+def get_version(project_key):
+    return memcache.get(_version_key(project_key)) or 0
+
+
+def wait(project_key, version, timeout):
+    """Blocks until the version of the project differs from version, or
+    for at most timeout seconds. Returns the current version."""
+    deadline = time.time() + timeout
+    while True:
+        current = get_version(project_key)
+        remaining = deadline - time.time()
+        if current != version or remaining <= 0:
+            return current
+        time.sleep(min(settings.POLL_INTERVAL_SECONDS, remaining))
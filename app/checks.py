@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+"""
+Synthetic HTTP checks (see models.HttpCheck).
+
+A cron job (/services/checks) runs every minute and enqueues the checks that
+are due in this minute. Every check has a fixed phase within its interval,
+derived from its id, so the checks of a project do not all run at the
+start of the minute, and a check runs at the same second every time:
+
+1. schedule() finds the due checks with one keys-only query per interval
+   and enqueues them in tasks of settings.CHECKS_PER_TASK checks, delayed
+   to their slot of settings.CHECK_SLOT_SECONDS within the minute.
+2. run() (/services/checks/worker) fetches the urls of a task with
+   concurrent async urlfetch RPCs, at most settings.CHECK_CONCURRENCY at a
+   time, stores the results as samples of the check's series (see
+   metrics.write_samples()) and evaluates the alert rules on them (see
+   alerts.evaluate()).
+
+Check urls can point to local stand-in servers on the dev server, eg.
+"http://localhost:9000/health".
+"""
+import time
+import zlib
+import logging
+
+from google.appengine.api import apiproxy_stub_map
+from google.appengine.api import taskqueue
+from google.appengine.api import urlfetch
+from google.appengine.ext import ndb
+
+import alerts
+import metrics
+import settings
+import tools.fanout as fanout
+from models import HttpCheck
+
+QUEUE = "checks"
+
+
+def phase(key, interval):
+    """Returns the second within the interval at which the check runs"""
+    return zlib.crc32(str(key.id())) % interval
+
+
+def schedule(now=None):
+    """Enqueues the worker tasks for the checks due in the current minute.
+    Returns the number of checks."""
+    now = int(now or time.time())
+    tick = now - now % 60
+
+    slots = {}
+    for interval in settings.CHECK_INTERVALS:
+        q = HttpCheck.query(HttpCheck.interval == interval,
+                HttpCheck.enabled == True)
+        for key in q.iter(keys_only=True):
+            offset = (phase(key, interval) - tick) % interval
+            if offset < 60:
+                slots.setdefault(offset // settings.CHECK_SLOT_SECONDS,
+                        []).append(key)
+
+    tasks = []
+    count = 0
+    for slot, keys in slots.iteritems():
+        countdown = max(0, tick + slot * settings.CHECK_SLOT_SECONDS - now)
+        for i in xrange(0, len(keys), settings.CHECKS_PER_TASK):
+            tasks.append(taskqueue.Task(url="/services/checks/worker",
+                    params={"keys": ",".join(key.urlsafe() for key in
+                            keys[i:i + settings.CHECKS_PER_TASK])},
+                    countdown=countdown))
+        count += len(keys)
+    fanout.add_tasks(tasks, QUEUE)
+    logging.info("Scheduled %s checks in %s tasks", count, len(tasks))
+    return count
+
+
+def fetch(checks):
+    """Fetches the urls of the checks concurrently. Returns a list of
+    (check, timestamp, status, latency) tuples, with status 0 if the
+    request failed.
+
+    The latency is measured when wait_any() returns the RPC, so it is an
+    upper bound: it includes the time spent handling other RPCs that
+    finished first."""
+    waiting = list(checks)
+    running = {}
+    results = []
+    while waiting or running:
+        # Keep up to CHECK_CONCURRENCY requests in flight
+        while waiting and len(running) < settings.CHECK_CONCURRENCY:
+            check = waiting.pop()
+            rpc = urlfetch.create_rpc(deadline=check.timeout)
+            urlfetch.make_fetch_call(rpc, check.url, method=check.method,
+                    follow_redirects=False,
+                    headers={"User-Agent": "Thatstat-Check/1.0"})
+            running[rpc] = (check, time.time())
+
+        rpc = apiproxy_stub_map.UserRPC.wait_any(running.keys())
+        check, started = running.pop(rpc)
+        try:
+            status = rpc.get_result().status_code
+        except urlfetch.Error as e:
+            logging.info("Check %s failed: %r", check.key.id(), e)
+            status = 0
+        results.append((check, int(started), status, time.time() - started))
+    return results
+
+
+def run(keys):
+    """Runs the checks and stores their results as samples"""
+    checks = [check for check in ndb.get_multi(keys)
+            if check and check.enabled]
+    if not checks:
+        return
+
+    samples = {}
+    for check, timestamp, status, latency in fetch(checks):
+        prefix = check.series_prefix()
+        samples.setdefault(check.project, []).extend([
+            (prefix + ".up", timestamp,
+                    1.0 if status == check.expected_status else 0.0),
+            (prefix + ".status", timestamp, float(status)),
+            (prefix + ".latency", timestamp, latency),
+        ])
+
+    project_keys = samples.keys()
+    for project in ndb.get_multi(project_keys):
+        if project:
+            metrics.write_samples(project, samples[project.key])
+            alerts.evaluate(project, samples[project.key])
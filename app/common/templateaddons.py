@@ -1,12 +1,15 @@
 # -*- coding: utf-8 -*-
-from google.appengine.ext import webapp
-from django.template import Node
+from hashlib import md5
+from google.appengine.ext.webapp import template
+from django.template import Node, TemplateSyntaxError
+
+from mc import tiered
 
 """
 Custom template tags, for use from within the templates.
 
 Before rendering a relevant template from within a handler, you need to include
-the custom tags with this line of code:
+the custom tags with this line of code (BaseRequestHandler already does):
 
     webapp.template.register_template_library('common.templateaddons')
 
@@ -16,7 +19,10 @@ More infos about custom template tags:
 """
 
 # get registry, we need it to register our filter later.
-register = webapp.template.create_template_register()
+register = template.create_template_register()
+
+# Rendered template fragments (see the cache tag)
+fragment_cache = tiered.TieredCache("fragment", local_ttl=30)
 
 
 def truncate_chars(value, maxlen):
@@ -33,3 +39,50 @@ def truncate_chars(value, maxlen):
 
 
 register.filter(truncate_chars)
+
+
+class CacheNode(Node):
+    def __init__(self, nodelist, ttl, fragment_name, vary_on):
+        self.nodelist = nodelist
+        self.ttl = ttl
+        self.fragment_name = fragment_name
+        self.vary_on = vary_on
+
+    def render(self, context):
+        try:
+            ttl = int(self.ttl.resolve(context))
+        except (ValueError, TypeError):
+            raise TemplateSyntaxError("cache tag got a non-integer ttl: %r" %
+                    self.ttl.token)
+
+        vary_on = u":".join(unicode(var.resolve(context))
+                for var in self.vary_on)
+        key = "%s:%s" % (self.fragment_name,
+                md5(vary_on.encode("utf-8")).hexdigest())
+        return fragment_cache.get(key, lambda: self.nodelist.render(context),
+                ttl)
+
+
+def cache(parser, token):
+    """Caches the rendered content of the block for ttl seconds. The cached
+    fragment is identified by its name and the values of the optional
+    variables, eg. to cache a project table per project and user:
+
+        {% cache 300 project_table project.key.id prefs.nickname %}
+            ...
+        {% endcache %}
+
+    """
+    bits = token.split_contents()
+    if len(bits) < 3:
+        raise TemplateSyntaxError("%r tag requires at least 2 arguments: "
+                "ttl and fragment name" % bits[0])
+
+    nodelist = parser.parse(("endcache",))
+    parser.delete_first_token()
+    return CacheNode(nodelist, parser.compile_filter(bits[1]),
+            bits[2].strip("'\""),
+            [parser.compile_filter(bit) for bit in bits[3:]])
+
+
+register.tag(cache)
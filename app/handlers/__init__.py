@@ -1 +1 @@
-from main import *
+# Handler modules are imported on demand by the url mapping in app.py
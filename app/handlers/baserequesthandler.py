@@ -1,43 +1,125 @@
 # -*- coding: utf-8 -*-
 import os
+from hashlib import md5
 from google.appengine.api import users
 from google.appengine.ext import webapp
+from google.appengine.ext.webapp import template
+from django.template import Context
 
+import activity
 import models
 import tools.common
+import tools.stats
 import settings
 
 TEMPLATE_DIR = os.path.join(os.path.dirname(__file__),
         '../%s' % settings.TEMPLATE_DIR)
 
+# Custom template tags and filters (eg. the {% cache %} fragment cache)
+template.register_template_library('common.templateaddons')
+
+# Compiled templates of this instance, by path: {path: (mtime, template)}
+_template_cache = {}
+
+
+def get_template(template_name):
+    """Returns the compiled template, compiling it on first use only. On the
+    dev server all templates are recompiled when any file in TEMPLATE_DIR
+    has changed (a template includes and extends others)."""
+    fn = os.path.join(TEMPLATE_DIR, template_name)
+    debug = tools.common.is_testenv()
+    mtime = None
+    if debug:
+        mtime = max(os.path.getmtime(os.path.join(TEMPLATE_DIR, name))
+                for name in os.listdir(TEMPLATE_DIR))
+
+    cached = _template_cache.get(fn)
+    if cached and cached[0] == mtime:
+        return cached[1]
+
+    # In debug mode template.load() compiles the template on every
+    # call, so it is only called when the template files have changed
+    compiled = template.load(fn, debug)
+    _template_cache[fn] = (mtime, compiled)
+    return compiled
+
 
 class BaseRequestHandler(webapp.RequestHandler):
     """Extension of the normal RequestHandler
 
-    - self.userprefs provides the UserPrefs object of the current user.
+    - self.userprefs provides the UserPrefs object of the current user. It
+      is loaded on first access (at the latest by self.render()), so
+      requests that do not need it (such as API calls and 304 responses)
+      do not pay for the lookup. Loading it records the user's activity
+      (see activity.py).
     - self.render() provides a quick way to render templates with
-      common template variables already preset.
+      common template variables already preset, and answers conditional
+      requests (If-None-Match) with 304.
     """
-    def __init__(self):
-        super(BaseRequestHandler, self).__init__()
-        self.userprefs = models.UserPrefs.from_user(users.get_current_user())
+    @property
+    def userprefs(self):
+        if not hasattr(self, "_userprefs"):
+            self._userprefs = models.UserPrefs.from_user(
+                    users.get_current_user())
+            if self._userprefs:
+                activity.record(self._userprefs)
+        return self._userprefs
 
-    def render(self, template_name, template_values={}):
-        # Preset values for the template
+    def render(self, template_name, template_values={}, version=None,
+            max_age=None):
+        """Renders the template with the common template values and the
+        supplied ones. The response gets an ETag, and a request with a
+        matching If-None-Match gets an empty 304 response.
+
+        - version: string that changes whenever the page changes (eg. the
+          data watermark of a series). The ETag is derived from it, so a 304
+          is sent without rendering the template. By default the ETag is
+          the hash of the rendered page, which saves the transfer only.
+        - max_age: makes the response public, so browsers and the App Engine
+          edge cache keep it for max_age seconds. Only for pages that look
+          the same to every visitor.
+        """
+        if version is not None:
+            user = users.get_current_user()
+            etag = md5("%s:%s:%s" % (template_name, version,
+                    user.user_id() if user else "")).hexdigest()
+            if self.not_modified(etag, max_age):
+                return
+
+        # Preset values for the template. Django 1.2 does not call callable
+        # context values, so prefs is the loaded UserPrefs (or None).
         values = {
           'request': self.request,
           'prefs': self.userprefs,
-          'login_url': users.create_login_url(self.request.uri),
-          'logout_url': users.create_logout_url(self.request.uri),
         }
 
         # Add manually supplied template values
         values.update(template_values)
 
         # Render template
-        fn = os.path.join(TEMPLATE_DIR, template_name)
-        self.response.out.write(webapp.template.render(fn, values,
-                debug=tools.common.is_testenv()))
+        with tools.stats.timer("template"):
+            body = get_template(template_name).render(Context(values))
+
+        if version is None:
+            etag = md5(body.encode("utf-8")).hexdigest()
+            if self.not_modified(etag, max_age):
+                return
+        self.response.out.write(body)
+
+    def not_modified(self, etag, max_age=None):
+        """Sets the ETag and caching headers of the response. Returns True
+        and sets the status to 304 if the client has this version."""
+        self.response.headers['ETag'] = '"%s"' % etag
+        if max_age:
+            self.response.headers['Cache-Control'] = \
+                    'public, max-age=%d' % max_age
+            # Logged in visitors (with a session cookie) see a different page
+            self.response.headers['Vary'] = 'Cookie'
+
+        if etag in self.request.if_none_match:
+            self.response.set_status(304)
+            return True
+        return False
 
     def head(self, *args):
         """Head is used by Twitter. If not there the tweet button shows 0"""
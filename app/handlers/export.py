@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+import csv
+import time
+import logging
+
+from google.appengine.datastore.datastore_query import Cursor
+from google.appengine.ext import webapp
+
+# Import packages from the project
+import metrics
+import settings
+
+from models import Project
+
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+
+class Export(webapp.RequestHandler):
+    """
+    Exports the raw samples of a project (or of one series) for a time range
+    as CSV or newline-delimited JSON. Authenticates with the project's api
+    key (X-Thatstat-Key header) like the ingest API:
+
+        GET /api/v1/export?start=1350000000&end=1350086400&format=csv
+            [&series=cpu.load][&cursor=...]
+
+    Chunks are read page by page from a query cursor. App Engine buffers
+    the whole response before sending it, so the output is paged, not
+    streamed: when the response reaches settings.EXPORT_MAX_SECONDS or
+    EXPORT_MAX_BYTES (the memory a request may hold, plus one page), it
+    stops after the current page and returns the X-Thatstat-Cursor header.
+    Repeating the request with &cursor=<header value> continues the export.
+    """
+    def get(self):
+        # Only from the header: query strings end up in request logs
+        project = Project.from_api_key(
+                self.request.headers.get("X-Thatstat-Key"))
+        if not project:
+            self.error_response(401, "invalid api key")
+            return
+
+        try:
+            start = int(self.request.get("start"))
+            end = int(self.request.get("end"))
+            cursor = self.request.get("cursor")
+            cursor = Cursor(urlsafe=cursor) if cursor else None
+        except Exception:
+            self.error_response(400, "invalid start, end or cursor")
+            return
+
+        fmt = self.request.get("format") or "csv"
+        if fmt not in ROW_WRITERS:
+            self.error_response(400, "format must be csv or ndjson")
+            return
+
+        self.response.headers['Content-Type'] = CONTENT_TYPES[fmt]
+        out = self.response.out
+        write_rows = ROW_WRITERS[fmt]
+        started = time.time()
+        written = 0
+
+        pages = metrics.iter_chunk_pages(project, start, end,
+                series=self.request.get("series") or None, cursor=cursor)
+        for chunks, cursor in pages:
+            for chunk in chunks:
+                points = [(t, v) for t, v in chunk.points()
+                        if start <= t < end]
+                written += write_rows(out, chunk.series, points)
+
+            if cursor and (written > settings.EXPORT_MAX_BYTES or
+                    time.time() - started > settings.EXPORT_MAX_SECONDS):
+                self.response.headers['X-Thatstat-Cursor'] = cursor.urlsafe()
+                logging.info("Export paused after %s bytes", written)
+                break
+
+    def error_response(self, status, message):
+        self.response.set_status(status)
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.out.write(json.dumps({"error": message}))
+
+
+class _CountingWriter(object):
+    """File-like wrapper that counts the bytes written"""
+    def __init__(self, out):
+        self.out = out
+        self.count = 0
+
+    def write(self, data):
+        self.count += len(data)
+        self.out.write(data)
+
+
+def write_csv(out, series, points):
+    """Writes series,timestamp,value rows. Returns the number of bytes."""
+    writer = _CountingWriter(out)
+    rows = csv.writer(writer)
+    series = series.encode("utf-8")
+    for t, v in points:
+        rows.writerow((series, t, repr(v)))
+    return writer.count
+
+
+def write_ndjson(out, series, points):
+    """Writes {"series", "t", "v"} objects, one per line. Returns the number
+    of bytes."""
+    count = 0
+    for t, v in points:
+        line = json.dumps({"series": series, "t": t, "v": v}) + "\n"
+        out.write(line)
+        count += len(line)
+    return count
+
+
+ROW_WRITERS = {"csv": write_csv, "ndjson": write_ndjson}
+CONTENT_TYPES = {"csv": "text/csv", "ndjson": "application/x-ndjson"}
@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+import time
+import zlib
+import logging
+
+from google.appengine.ext import webapp
+
+# Import packages from the project
+import alerts
+import metrics
+import quotas
+import settings
+import tools.wireformat
+
+from models import Project
+
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+
+class Ingest(webapp.RequestHandler):
+    """
+    Metric ingest API for monitoring agents. Deliberately not a
+    BaseRequestHandler: agents authenticate with the project's api key, so
+    there is no need to look up the UserPrefs of the current user.
+
+    The api key is sent with the X-Thatstat-Key header, the body is a JSON
+    object with a list of [series, timestamp, value] samples, and optionally
+    a list of samples of histogram series (eg. single request latencies,
+    see metrics.write_histograms):
+
+        POST /api/v1/ingest
+        {"samples": [["cpu.load", 1350000000, 0.52], ...],
+         "histograms": [["api.latency", 1350000000, 0.120], ...]}
+
+    Agents with high sample rates send the compact binary format of
+    tools.wireformat instead (Content-Type application/x-thatstat-batch),
+    which is much cheaper to decode. The body may be gzip-compressed
+    (Content-Encoding: gzip), as sent by tools.agent.
+
+    Requests over the project's rate limit or daily quota are rejected with
+    429 and a Retry-After header (see quotas.py).
+    """
+    def post(self):
+        project = Project.from_api_key(
+                self.request.headers.get("X-Thatstat-Key"))
+        if not project:
+            self.error_response(401, "invalid api key")
+            return
+
+        try:
+            samples, histograms = self.parse_samples(self.get_body())
+            self.validate(samples)
+            self.validate(histograms)
+        except ValueError as e:
+            self.error_response(400, str(e))
+            return
+
+        if len(samples) + len(histograms) > settings.INGEST_MAX_SAMPLES:
+            self.error_response(413, "too many samples (max %s)" %
+                    settings.INGEST_MAX_SAMPLES)
+            return
+
+        # Rate limit and daily quota of the project (one memcache RPC)
+        retry_after = quotas.consume(project, len(samples) + len(histograms))
+        if retry_after:
+            self.response.headers['Retry-After'] = str(retry_after)
+            self.error_response(429, "ingest limit of the project exceeded, "
+                    "retry after %s seconds" % retry_after)
+            return
+
+        count = 0
+        if samples:
+            count += metrics.write_samples(project, samples)
+            alerts.evaluate(project, samples)
+        if histograms:
+            count += metrics.write_histograms(project, histograms)
+        self.json_response({"accepted": count})
+
+    def get_body(self):
+        """Returns the request body, decompressed if needed. Raises
+        ValueError if it cannot be decompressed or is too large."""
+        body = self.request.body
+        if self.request.headers.get("Content-Encoding") != "gzip":
+            return body
+
+        # Limit the decompressed size, a small payload can inflate to GBs
+        try:
+            decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            body = decompressor.decompress(body,
+                    settings.INGEST_MAX_BODY_BYTES)
+        except zlib.error:
+            raise ValueError("invalid gzip body")
+        if decompressor.unconsumed_tail:
+            raise ValueError("body too large (max %s bytes)" %
+                    settings.INGEST_MAX_BODY_BYTES)
+        return body
+
+    def parse_samples(self, body):
+        """Returns the lists of (series, timestamp, value) tuples of the
+        samples and histogram samples of the payload. Raises ValueError if
+        the payload is invalid."""
+        if self.request.content_type == tools.wireformat.CONTENT_TYPE:
+            return tools.wireformat.decode(body)
+
+        try:
+            payload = json.loads(body)
+            return [[(unicode(series), int(timestamp), float(value))
+                    for series, timestamp, value in payload.get(name, [])]
+                    for name in ("samples", "histograms")]
+        except (AttributeError, TypeError):
+            raise ValueError("invalid payload")
+
+    def validate(self, samples):
+        """Raises ValueError if a series name of the samples is longer than
+        settings.SERIES_MAX_BYTES, or a timestamp is negative or more than
+        settings.INGEST_MAX_FUTURE_SECONDS in the future, which the chunk
+        encoding cannot store"""
+        if isinstance(samples, tools.wireformat.Records):
+            # Decoded in columns, no need to create the tuples
+            names = samples.names
+            first, last = samples.time_range()
+        else:
+            names = set(series for series, timestamp, value in samples)
+            timestamps = [timestamp for series, timestamp, value in samples]
+            first = min(timestamps) if timestamps else None
+            last = max(timestamps) if timestamps else None
+
+        for series in names:
+            if len(series.encode("utf-8")) > settings.SERIES_MAX_BYTES:
+                raise ValueError("series name too long (max %s bytes)" %
+                        settings.SERIES_MAX_BYTES)
+
+        if first is not None and (first < 0 or last > time.time() +
+                settings.INGEST_MAX_FUTURE_SECONDS):
+            raise ValueError("timestamps must be unix seconds between 0 and "
+                    "%s seconds from now" % settings.INGEST_MAX_FUTURE_SECONDS)
+
+    def error_response(self, status, message):
+        logging.info("Ingest rejected (%s): %s", status, message)
+        self.response.set_status(status)
+        self.json_response({"error": message})
+
+    def json_response(self, obj):
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.out.write(json.dumps(obj))
@@ -8,9 +8,9 @@ from google.appengine.ext import webapp
 from google.appengine.ext.webapp import template
 
 # Import packages from the project
+import activity
 import mc
 import settings
-import tools.mailchimp
 
 from models import *
 from baserequesthandler import BaseRequestHandler
@@ -49,8 +49,12 @@ class LogOut(webapp.RequestHandler):
 # Main page request handler
 class Main(BaseRequestHandler):
     def get(self):
-        # Render the template
-        self.render("index.html")
+        # Anonymous visitors all get the same page, which can be served from
+        # the edge cache
+        if users.get_current_user():
+            self.render("index.html")
+        else:
+            self.render("index.html", max_age=settings.PUBLIC_MAX_AGE)
 
 
 # Account page and after-login handler
@@ -66,6 +70,10 @@ class Account(BaseRequestHandler):
         if target_url and "?continue=" in target_url:
             target_url = target_url[target_url.index("?continue=") + 10:]
 
+        if target_url:
+            # Coming from the login page
+            activity.record(self.userprefs, login=True)
+
         if not self.userprefs.is_setup:
             # First log in of user. Finish setup before forwarding.
             self.render("account_setup.html", {"target_url": target_url})
@@ -101,13 +109,13 @@ class AccountSetup(BaseRequestHandler):
         self.userprefs.subscribed_to_newsletter = bool(subscribe)
         self.userprefs.put()
 
-        # Subscribe this user to the email newsletter now (if wanted). By
-        # default does not subscribe users to mailchimp in Test Environment!
+        # Queue subscribing this user to the email newsletter (if wanted). It
+        # is sent to MailChimp in the background. By default does not
+        # subscribe users to mailchimp in Test Environment!
         if subscription_changed and settings.MAILCHIMP_ENABLED:
-            if subscribe:
-                tools.mailchimp.mailchimp_subscribe(email)
-            else:
-                tools.mailchimp.mailchimp_unsubscribe(email)
+            # Imported here to keep it out of the instance startup
+            import tools.mailchimp
+            tools.mailchimp.queue_subscription(email, bool(subscribe))
 
         # After updating UserPrefs, redirect
         self.redirect(target_url)
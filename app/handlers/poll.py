@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+import time
+
+from google.appengine.ext import webapp
+
+# Import packages from the project
+import alerts
+import changes
+import metrics
+import mc
+import settings
+
+from models import Project
+
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+
+class Poll(webapp.RequestHandler):
+    """
+    Long-poll API for dashboards, which get the new samples of the series
+    they show and the alerts that fired or resolved, instead of reloading
+    the page. Authenticates with the project's api key (X-Thatstat-Key
+    header) like the ingest API.
+
+    The client sends the last timestamp it has of each series, the version
+    and alerts_since of the previous response (empty on the first request):
+
+        GET /api/v1/poll?w=cpu.load:1350000000&w=mem.free:1350000000
+            &version=42&alerts_since=1349990000
+
+    The request returns as soon as there are samples newer than the
+    watermarks or changed alerts, or after settings.POLL_TIMEOUT_SECONDS
+    (or &timeout=, if shorter) with empty results. While waiting it only
+    checks the version counter in memcache (see changes.py). Response:
+
+        {"version": 43,
+         "series": {"cpu.load": [[1350000010, 0.52], ...]},
+         "watermarks": {"cpu.load": 1350000010, "mem.free": 1350000000},
+         "alerts": [{"id": 5, "series": "cpu.load", "firing": true,
+                     "since": 1350000011}],
+         "alerts_since": 1350000011}
+
+    Watermarks older than settings.POLL_MAX_BACKFILL_SECONDS are moved up
+    to that limit; a dashboard that was offline longer reloads its data.
+    """
+    def get(self):
+        # Only from the header: query strings end up in request logs
+        project = Project.from_api_key(
+                self.request.headers.get("X-Thatstat-Key"))
+        if not project:
+            self.error_response(401, "invalid api key")
+            return
+
+        try:
+            watermarks = dict(self.parse_watermark(w)
+                    for w in self.request.get_all("w"))
+            version = self.request.get("version")
+            version = int(version) if version else None
+            alerts_since = int(self.request.get("alerts_since") or 0)
+            timeout = min(float(self.request.get("timeout") or
+                    settings.POLL_TIMEOUT_SECONDS),
+                    settings.POLL_TIMEOUT_SECONDS)
+        except ValueError:
+            self.error_response(400, "invalid watermark, version or timeout")
+            return
+
+        oldest = int(time.time()) - settings.POLL_MAX_BACKFILL_SECONDS
+        for series, watermark in watermarks.iteritems():
+            watermarks[series] = max(watermark, oldest)
+
+        deadline = time.time() + timeout
+        points = {}
+        changed = []
+        while True:
+            current = changes.wait(project.key, version,
+                    max(0, deadline - time.time()))
+            if current != version:
+                # Something changed (or first request): read the deltas
+                points = metrics.read_since(project, watermarks,
+                        int(time.time()) + 1)
+                changed = self.changed_alerts(project, alerts_since)
+            version = current
+            if points or changed or time.time() >= deadline:
+                break
+
+        for series, series_points in points.iteritems():
+            watermarks[series] = series_points[-1][0]
+        self.json_response({
+            "version": version,
+            "series": points,
+            "watermarks": watermarks,
+            "alerts": changed,
+            "alerts_since": max([alerts_since] +
+                    [alert["since"] for alert in changed]),
+        })
+
+    def parse_watermark(self, value):
+        """Returns the (series, timestamp) of a series:timestamp parameter.
+        Raises ValueError if it is invalid."""
+        series, timestamp = value.rsplit(":", 1)
+        return series, int(timestamp)
+
+    def changed_alerts(self, project, since):
+        """Returns the alerts of the project that fired or resolved after
+        since (unix seconds)"""
+        rules = mc.cache.get_alert_rules(project.key)
+        if not rules:
+            return []
+
+        states = alerts.load_states(rules)
+        changed = []
+        for rule in rules:
+            state = states[rule.key.id()]
+            if state.get("since", 0) > since:
+                changed.append({
+                    "id": rule.key.id(),
+                    "series": rule.series,
+                    "kind": rule.kind,
+                    "firing": bool(state.get("firing")),
+                    "since": state["since"],
+                })
+        return changed
+
+    def error_response(self, status, message):
+        self.response.set_status(status)
+        self.json_response({"error": message})
+
+    def json_response(self, obj):
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.headers['Cache-Control'] = 'no-cache'
+        self.response.out.write(json.dumps(obj))
@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+from google.appengine.ext import webapp
+
+# Import packages from the project
+import catalog
+
+from models import Project
+
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+
+class Series(webapp.RequestHandler):
+    """
+    Lists the series of a project that match a label selector (see
+    catalog.py). Authenticates with the project's api key (X-Thatstat-Key
+    header) like the ingest API:
+
+        GET /api/v1/series?selector=cpu{region=eu,service=api}
+        {"series": ["cpu{host=web1,region=eu,service=api}", ...]}
+    """
+    def get(self):
+        # Only from the header: query strings end up in request logs
+        project = Project.from_api_key(
+                self.request.headers.get("X-Thatstat-Key"))
+        if not project:
+            self.error_response(401, "invalid api key")
+            return
+
+        try:
+            series = catalog.select(project.key, self.request.get("selector"))
+        except ValueError as e:
+            self.error_response(400, str(e))
+            return
+        self.json_response({"series": series})
+
+    def error_response(self, status, message):
+        self.response.set_status(status)
+        self.json_response({"error": message})
+
+    def json_response(self, obj):
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.out.write(json.dumps(obj))
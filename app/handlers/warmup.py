@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+import os
+import time
+import logging
+
+from google.appengine.ext import webapp
+
+# Import packages from the project
+import mc
+import tools.importprofile
+
+from baserequesthandler import TEMPLATE_DIR, get_template
+
+
+class Warmup(webapp.RequestHandler):
+    """
+    Called by App Engine before a new instance gets traffic (warmup inbound
+    service in app.yaml). Imports all handler modules, compiles all templates
+    and loads the cache generations, then logs the import time report and
+    stops timing imports.
+    """
+    def get(self):
+        started = time.time()
+
+        # Handler modules are otherwise imported by the first request
+        import app
+        for url, handler in app.urls:
+            __import__(handler.rsplit(".", 1)[0])
+
+        for name in os.listdir(TEMPLATE_DIR):
+            if name.endswith(".html"):
+                get_template(name)
+
+        from common.templateaddons import fragment_cache
+        for cache in (mc.cache.userprefs_cache, mc.cache.alert_rules_cache,
+                fragment_cache):
+            cache.generation()
+
+        report = tools.importprofile.report()
+        tools.importprofile.uninstall()
+        logging.info("Warmup done in %.0f ms. %s",
+                (time.time() - started) * 1000, report)
+        self.response.headers['Content-Type'] = 'text/plain'
+        self.response.out.write(report)
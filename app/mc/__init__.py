@@ -1 +1,2 @@
+import tiered
 import cache
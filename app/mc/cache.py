@@ -1,58 +1,63 @@
 # -*- coding: utf-8 -*-
-import logging
-from google.appengine.api import memcache
-
-import models
+"""
+Cached accessors for frequently used objects. They are built on
+mc.tiered, which serves values from process memory and memcache with a
+datastore fallback. To cache another function, decorate it:
 
+    @tiered.cached("someitems", ttl=300, key=lambda: "all")
+    def get_someitems():
+        return Someitem.all().fetch(100)
 
-def get_someitems(clear=False):
-    """Boilerplate for your customization"""
-    if clear:
-        memcache.delete("someitems")
-        return
+    get_someitems.clear()  # after changing a Someitem
+"""
+import logging
 
-    someitems = memcache.get("someitems")
-    if someitems:
-        #logging.info("return cached someitem")
-        return someitems
+import models
+import tiered
 
-    someitems = []
-    for someitem in Someitem.all().fetch(100):
-        someitems.append(someitem)
+# Alert rules of a project, evaluated with every ingest request
+alert_rules_cache = tiered.TieredCache("alertrules", ttl=600, local_ttl=30)
 
-    memcache.set("someitems", someitems)
-    logging.info("cached someitems")
-    return someitems
+# UserPrefs can be modified on any instance, so they are only served from
+# the local tier for a few seconds.
+userprefs_cache = tiered.TieredCache("userprefs", ttl=24 * 3600,
+        local_ttl=5)
 
 
 def get_userprefs(user, clear=False):
     """
-    Get the UserPrefs for the current user either from memcache or, if not
-    yet cached, from the datastore and put it into memcache. Used by 
+    Get the UserPrefs for the current user either from the cache or, if not
+    yet cached, from the datastore and put it into the cache. Used by
     UserPrefs.from_user(user)
     """
     if not user:
         return user
 
-    if user.federated_identity():
-        key = "userprefs_fid_%s" % user.federated_identity()
-    else:
-        key = "userprefs_gid_%s" % user.user_id()
+    key = models.UserPrefs.key_name(user)
 
     # Clearing the cache does not return anything
     if clear:
-        memcache.delete(key)
-        logging.info("- cache cleared key: %s", key)
+        clear_userprefs(key)
         return
 
-    # Try to grab the cached UserPrefs
-    prefs = memcache.get(key)
-    if prefs:
-        logging.info("- returning cached userprefs for key: %s", key)
-        return prefs
-
-    # If not cached, query the datastore, put into cache and return object
-    prefs = models.UserPrefs._from_user(user)
-    memcache.set(key, prefs)
-    logging.info("cached userprefs key: %s", key)
-    return prefs
+    return userprefs_cache.get(key,
+            lambda: models.UserPrefs._from_user(user))
+
+
+def clear_userprefs(key_name):
+    """Removes a cached UserPrefs by its key name. Called by UserPrefs
+    after .put() and .delete()."""
+    key = u"%s" % key_name
+    userprefs_cache.delete(key)
+    logging.info("- cache cleared key: %s", key)
+
+
+def get_alert_rules(project_key):
+    """Returns the list of AlertRules of a project"""
+    return alert_rules_cache.get(str(project_key.id()),
+            lambda: models.AlertRule.query(
+                    models.AlertRule.project == project_key).fetch())
+
+
+def clear_alert_rules(project_key):
+    alert_rules_cache.delete(str(project_key.id()))
@@ -0,0 +1,287 @@
+# -*- coding: utf-8 -*-
+"""
+Two-tier read-through cache: a bounded in-process LRU in front of memcache.
+
+    userprefs_cache = TieredCache("userprefs", ttl=3600, local_ttl=5)
+    prefs = userprefs_cache.get(key, lambda: load_userprefs(user))
+
+or as a decorator, with the cache key built from the arguments:
+
+    @cached("projects", ttl=600, key=lambda project_id: str(project_id))
+    def get_project(project_id):
+        return Project.get_by_id(project_id)
+
+    get_project(42)        # loads and caches
+    get_project.clear(42)  # removes the cached value
+
+- Values are first looked up in the local LRU (no RPC), then in memcache,
+  and finally loaded with the supplied loader. get_multi() and set_multi()
+  do one memcache RPC for all keys.
+- Every value has a soft TTL. After it expired, memcache keeps the value for
+  another stale_ttl seconds: one caller gets a memcache add() lock and
+  reloads the value while all other callers keep getting the stale value.
+  Callers that find no value at all while another one holds the lock wait
+  briefly for it instead of hitting the datastore as well (dogpile
+  protection).
+- invalidate() drops all values of the namespace at once by incrementing
+  its generation counter, which is part of every key.
+
+Other instances keep serving their local copy for up to local_ttl seconds
+after a value was changed or invalidated, so choose local_ttl according to
+how stale the data may be.
+"""
+import time
+import logging
+import threading
+import cPickle as pickle
+
+from collections import OrderedDict
+from hashlib import md5
+from google.appengine.api import memcache
+
+import tools.stats
+
+# Marker for "not cached", as None is a valid cached value
+_MISSING = object()
+
+# Memcache keys may not be longer than 250 bytes
+_MAX_KEY_LENGTH = 200
+
+
+class LRUCache(object):
+    """Thread-safe in-process cache with a maximum number of entries and a
+    per-entry expiry time. The least recently used entry is evicted first.
+    """
+    def __init__(self, maxsize=1000):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.pop(key, None)
+            if entry is None or entry[0] < time.time():
+                return default
+
+            # Re-insert to mark as most recently used
+            self._data[key] = entry
+            return entry[1]
+
+    def set(self, key, value, ttl):
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (time.time() + ttl, value)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+class TieredCache(object):
+    """Read-through cache for one namespace of keys. See the module
+    docstring for the behaviour of the two tiers.
+
+    - ttl: seconds after which a value is reloaded (can be overridden per
+      key with set() and set_multi())
+    - local_ttl: seconds a value is served from the in-process LRU
+    - stale_ttl: seconds a value is served after ttl while it is reloaded
+    - lock_ttl: seconds a reload lock is held at most
+    - local_size: maximum number of values in the in-process LRU
+    """
+    def __init__(self, namespace, ttl=3600, local_ttl=10, stale_ttl=60,
+            lock_ttl=10, local_size=1000):
+        self.namespace = namespace
+        self.ttl = ttl
+        self.local_ttl = local_ttl
+        self.stale_ttl = stale_ttl
+        self.lock_ttl = lock_ttl
+        self.local = LRUCache(local_size)
+
+    def get(self, key, loader=None, ttl=None):
+        """Returns the cached value of key. If not cached, returns the result
+        of loader() and caches it (for ttl seconds, if given), or None if no
+        loader is given."""
+        return self.get_multi([key],
+                loader and (lambda keys: {key: loader()}), ttl).get(key)
+
+    def get_multi(self, keys, loader=None, ttl=None):
+        """Returns a dict of the cached values of keys. If some values are not
+        cached, loader(missing_keys) is called to get a dict of them, which
+        are then cached (for ttl seconds, if given). Keys that are neither
+        cached nor loaded are omitted.
+        """
+        full_keys = self._full_keys(keys)
+        result = {}
+
+        # Tier 1: in-process LRU
+        remote = []
+        for key in keys:
+            value = self.local.get(full_keys[key], _MISSING)
+            if value is _MISSING:
+                remote.append(key)
+            else:
+                result[key] = pickle.loads(value)
+        tools.stats.count("cache.local_hits", len(result))
+        if not remote:
+            return result
+
+        # Tier 2: memcache
+        cached = memcache.get_multi([full_keys[key] for key in remote])
+        now = time.time()
+        missing = []
+        stale = []
+        for key in remote:
+            entry = cached.get(full_keys[key])
+            if entry is None:
+                missing.append(key)
+                continue
+
+            expires, value = entry
+            result[key] = value
+            if expires < now:
+                stale.append(key)
+            else:
+                self.local.set(full_keys[key], pickle.dumps(value, -1),
+                        min(self.local_ttl, expires - now))
+
+        if not loader or not (missing or stale):
+            return result
+
+        # Tier 3: loader. Each missing or stale value is reloaded by the one
+        # request that gets its lock. Other requests keep the stale value, or
+        # wait for the missing value to appear in memcache.
+        acquired = self._lock_multi([full_keys[key]
+                for key in missing + stale])
+        load = [key for key in missing + stale if full_keys[key] in acquired]
+        waiting = [key for key in missing if full_keys[key] not in acquired]
+        if waiting:
+            found = self._wait_for(waiting, full_keys)
+            result.update(found)
+            load.extend(key for key in waiting if key not in found)
+
+        loaded = loader(load) if load else {}
+        if loaded:
+            self.set_multi(loaded, ttl)
+            result.update(loaded)
+        if acquired:
+            memcache.delete_multi([self._lock_key(full_key)
+                    for full_key in acquired])
+        return result
+
+    def set(self, key, value, ttl=None):
+        self.set_multi({key: value}, ttl)
+
+    def set_multi(self, mapping, ttl=None):
+        """Caches all values of the dict mapping with one memcache RPC"""
+        ttl = ttl or self.ttl
+        full_keys = self._full_keys(mapping.keys())
+        expires = time.time() + ttl
+        entries = {}
+        for key, value in mapping.iteritems():
+            entries[full_keys[key]] = (expires, value)
+            self.local.set(full_keys[key], pickle.dumps(value, -1),
+                    min(self.local_ttl, ttl))
+
+        failed = memcache.set_multi(entries, time=ttl + self.stale_ttl)
+        if failed:
+            logging.warning("cache %s: failed to set %s keys", self.namespace,
+                    len(failed))
+
+    def delete(self, key):
+        self.delete_multi([key])
+
+    def delete_multi(self, keys):
+        full_keys = self._full_keys(keys).values()
+        for full_key in full_keys:
+            self.local.delete(full_key)
+        memcache.delete_multi(full_keys)
+
+    def invalidate(self):
+        """Drops all cached values of this namespace"""
+        memcache.incr(self._generation_key(), initial_value=0)
+        self.local.clear()
+        logging.info("cache %s: invalidated", self.namespace)
+
+    def generation(self):
+        """Returns the current generation of the namespace, which is part of
+        every key. Cached locally for local_ttl seconds."""
+        gen_key = self._generation_key()
+        generation = self.local.get(gen_key)
+        if generation is None:
+            generation = memcache.get(gen_key) or 0
+            self.local.set(gen_key, generation, self.local_ttl)
+        return generation
+
+    def _full_keys(self, keys):
+        """Returns a dict of {key: memcache key}"""
+        prefix = "%s:%s:" % (self.namespace, self.generation())
+        full_keys = {}
+        for key in keys:
+            full_key = prefix + key
+            if isinstance(full_key, unicode):
+                full_key = full_key.encode("utf-8")
+            if len(full_key) > _MAX_KEY_LENGTH:
+                full_key = prefix + md5(full_key).hexdigest()
+            full_keys[key] = full_key
+        return full_keys
+
+    def _generation_key(self):
+        return "%s:generation" % self.namespace
+
+    def _lock_key(self, full_key):
+        return "%s:lock" % full_key
+
+    def _lock_multi(self, full_keys):
+        """Returns the set of full keys we got the reload lock for"""
+        if not full_keys:
+            return set()
+        failed = memcache.add_multi(dict((self._lock_key(full_key), 1)
+                for full_key in full_keys), time=self.lock_ttl)
+        return set(full_key for full_key in full_keys
+                if self._lock_key(full_key) not in failed)
+
+    def _wait_for(self, keys, full_keys, interval=0.05, retries=10):
+        """Polls memcache until the values of keys are set by the request
+        holding their reload lock. Returns a dict of the values found."""
+        found = {}
+        for i in xrange(retries):
+            time.sleep(interval)
+            cached = memcache.get_multi([full_keys[key] for key in keys
+                    if key not in found])
+            for key in keys:
+                if full_keys[key] in cached:
+                    found[key] = cached[full_keys[key]][1]
+            if len(found) == len(keys):
+                break
+        return found
+
+
+def cached(namespace, key=None, **options):
+    """Decorator that caches the results of a function in a TieredCache.
+    key(*args) returns the cache key for the arguments (default: their repr).
+    All other keyword arguments are passed on to TieredCache.
+
+    The decorated function gets two attributes: .cache (the TieredCache)
+    and .clear(*args), which removes the cached result for the arguments.
+    """
+    key = key or (lambda *args: repr(args))
+
+    def decorator(func):
+        cache = TieredCache(namespace, **options)
+
+        def _wrapper(*args):
+            return cache.get(key(*args), lambda: func(*args))
+
+        _wrapper.__name__ = func.__name__
+        _wrapper.__doc__ = func.__doc__
+        _wrapper.cache = cache
+        _wrapper.clear = lambda *args: cache.delete(key(*args))
+        return _wrapper
+
+    return decorator
@@ -0,0 +1,224 @@
+# -*- coding: utf-8 -*-
+"""
+Write and read paths for metric samples.
+
+Samples are (series, timestamp, value) tuples, with the timestamp in unix
+seconds. They are stored in SeriesChunk entities, one per series and time
+window (see models.SeriesChunk). The ingest handler (handlers/ingest.py)
+validates the payload and hands it to write_samples(), which merges the new
+samples into the affected chunks with one batch get and parallel batch puts.
+
+New series are added to the project's series catalog (see catalog.py).
+
+Samples of histogram series (eg. request latencies) are not stored one by
+one but counted in quantile sketches per time bucket (see
+models.HistogramBucket, write_histograms() and read_percentiles()).
+"""
+import random
+import logging
+
+from datetime import datetime
+from google.appengine.ext import ndb
+
+import catalog
+import changes
+import settings
+import tools.sketch
+import tools.tscodec
+from models import SeriesChunk, HistogramBucket
+
+# Resolution of the histogram buckets written by ingest
+HISTOGRAM_RESOLUTION = min(settings.ROLLUP_PERIODS)
+
+
+def write_samples(project, samples):
+    """Stores an iterable of (series, timestamp, value) tuples for the
+    project. Returns the number of received samples.
+
+    Chunks are updated without a transaction: a series is expected to be
+    written by a single agent, and merging is idempotent for retried
+    batches."""
+    by_chunk = {}
+    count = 0
+    for series, timestamp, value in samples:
+        start = SeriesChunk.window_start(timestamp)
+        by_chunk.setdefault((series, start), []).append((timestamp, value))
+        count += 1
+
+    keys = [SeriesChunk.key_for(project.key, series, start)
+            for series, start in by_chunk]
+    chunks = ndb.get_multi(keys)
+
+    for i, (series, start) in enumerate(by_chunk):
+        if not chunks[i]:
+            chunks[i] = SeriesChunk(key=keys[i], project=project.key,
+                    series=series, start=start)
+        chunks[i].set_points(tools.tscodec.merge(chunks[i].points(),
+                by_chunk[(series, start)]))
+
+    # Issue all put RPCs at once and wait for them together
+    futures = []
+    size = settings.INGEST_PUT_BATCH_SIZE
+    for i in xrange(0, len(chunks), size):
+        futures.extend(ndb.put_multi_async(chunks[i:i + size]))
+    ndb.Future.wait_all(futures)
+    for future in futures:
+        future.check_success()
+    changes.notify(project.key)
+    catalog.register(project.key, [series for series, start in by_chunk])
+
+    logging.info("Stored %s samples in %s chunks for project %s", count,
+            len(chunks), project.key.id())
+    return count
+
+
+def read_range(project, series, start, end):
+    """Returns the sorted (timestamp, value) samples of a series with
+    start <= timestamp < end (unix seconds). Costs one batch get of the
+    chunks covering the range."""
+    keys = [SeriesChunk.key_for(project.key, series, window)
+            for window in xrange(SeriesChunk.window_start(start), end,
+                    settings.CHUNK_SECONDS)]
+
+    points = []
+    for chunk in ndb.get_multi(keys):
+        if chunk:
+            points.extend((t, v) for t, v in chunk.points()
+                    if start <= t < end)
+    return points
+
+
+def read_since(project, watermarks, end):
+    """Returns a dict of {series: sorted (timestamp, value) samples} with
+    watermark < timestamp < end for a dict of {series: watermark}, reading
+    the chunks of all series with one batch get. Series without new
+    samples are omitted."""
+    ranges = []
+    keys = []
+    for series, watermark in watermarks.iteritems():
+        windows = range(SeriesChunk.window_start(watermark + 1), end,
+                settings.CHUNK_SECONDS)
+        ranges.append((series, watermark, len(windows)))
+        keys.extend(SeriesChunk.key_for(project.key, series, window)
+                for window in windows)
+
+    chunks = iter(ndb.get_multi(keys))
+    result = {}
+    for series, watermark, count in ranges:
+        points = []
+        for i in xrange(count):
+            chunk = next(chunks)
+            if chunk:
+                points.extend((t, v) for t, v in chunk.points()
+                        if watermark < t < end)
+        if points:
+            result[series] = points
+    return result
+
+
+def write_histograms(project, samples):
+    """Counts an iterable of (series, timestamp, value) tuples of histogram
+    series into the sketches of their buckets. Returns the number of
+    received samples.
+
+    All samples of a request go into the same randomly chosen shard, and
+    each bucket is updated in its own transaction, all in parallel."""
+    sketches = {}
+    count = 0
+    for series, timestamp, value in samples:
+        start = timestamp - timestamp % HISTOGRAM_RESOLUTION
+        sketch = sketches.get((series, start))
+        if sketch is None:
+            sketch = sketches[(series, start)] = tools.sketch.Sketch()
+        sketch.add(value)
+        count += 1
+
+    shard = random.randrange(settings.HISTOGRAM_SHARDS)
+    now = datetime.utcnow()
+
+    @ndb.tasklet
+    def update(series, start, sketch):
+        key = HistogramBucket.key_for(project.key, series,
+                HISTOGRAM_RESOLUTION, start, shard)
+        bucket = yield key.get_async()
+
+        # Merge into a copy, as the transaction may be retried
+        merged = tools.sketch.Sketch()
+        merged.merge(sketch)
+        if bucket:
+            merged.merge(bucket.get_sketch())
+        else:
+            bucket = HistogramBucket(key=key, project=project.key,
+                    series=series, resolution=HISTOGRAM_RESOLUTION,
+                    start=start)
+        bucket.set_sketch(merged)
+        bucket.updated = now
+        yield bucket.put_async()
+
+    def transaction(series, start, sketch):
+        return ndb.transaction_async(lambda: update(series, start, sketch))
+
+    futures = [transaction(series, start, sketch)
+            for (series, start), sketch in sketches.iteritems()]
+    ndb.Future.wait_all(futures)
+    for future in futures:
+        future.check_success()
+    catalog.register(project.key, [series for series, start in sketches])
+
+    logging.info("Stored %s histogram samples in %s buckets for project %s",
+            count, len(sketches), project.key.id())
+    return count
+
+
+def read_sketch(project, series, start, end, resolution=None):
+    """Returns the merged sketch of a histogram series for the buckets
+    overlapping start <= timestamp < end. If resolution is not set, the
+    smallest one with at most settings.HISTOGRAM_MAX_SKETCHES sketches is
+    used."""
+    if not resolution:
+        for resolution in sorted(settings.ROLLUP_PERIODS):
+            shards = settings.HISTOGRAM_SHARDS \
+                    if resolution == HISTOGRAM_RESOLUTION else 1
+            if (end - start) / resolution * shards <= \
+                    settings.HISTOGRAM_MAX_SKETCHES:
+                break
+
+    shards = settings.HISTOGRAM_SHARDS \
+            if resolution == HISTOGRAM_RESOLUTION else 1
+    keys = [HistogramBucket.key_for(project.key, series, resolution, t, shard)
+            for t in xrange(start - start % resolution, end, resolution)
+            for shard in xrange(shards)]
+
+    sketch = tools.sketch.Sketch()
+    for bucket in ndb.get_multi(keys):
+        if bucket:
+            sketch.merge(bucket.get_sketch())
+    return sketch
+
+
+def read_percentiles(project, series, start, end,
+        quantiles=(0.5, 0.95, 0.99)):
+    """Returns a dict of {quantile: value} of a histogram series for the
+    time range (see read_sketch())"""
+    sketch = read_sketch(project, series, start, end)
+    return dict((q, sketch.quantile(q)) for q in quantiles)
+
+
+def iter_chunk_pages(project, start, end, series=None, cursor=None,
+        page_size=100):
+    """Generator over the raw chunks of the project (or of one series)
+    overlapping start <= timestamp < end, in pages of page_size chunks.
+    Yields (chunks, cursor) tuples, where cursor continues after the page
+    (None after the last page), so a caller can stop after any page and
+    resume from there in another request."""
+    q = SeriesChunk.query(SeriesChunk.project == project.key,
+            SeriesChunk.start >= SeriesChunk.window_start(start),
+            SeriesChunk.start < end)
+    if series:
+        q = q.filter(SeriesChunk.series == series)
+    q = q.order(SeriesChunk.start)
+
+    more = True
+    while more:
+        chunks, cursor, more = q.fetch_page(page_size, start_cursor=cursor)
+        yield chunks, cursor if more else None
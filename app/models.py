@@ -1,15 +1,21 @@
 # -*- coding: utf-8 -*-
+import os
 import logging
 
+from array import array
+from binascii import hexlify
 from hashlib import md5
-from google.appengine.ext import db
 from google.appengine.ext import ndb
 from google.appengine.api import users
 
 import mc
+import settings
+import tools.common
+import tools.sketch
+import tools.tscodec
 
 
-class UserPrefs(db.Model):
+class UserPrefs(ndb.Model):
     """Storage for custom properties related to a user. Provides caching
     for super-fast access to the UserPrefs object.
 
@@ -20,68 +26,93 @@ class UserPrefs(db.Model):
 
         userprefs = UserPrefs.from_user(users.get_current_user())
 
-    This retrieves the UserPrefs object is automatically from memcache or, if
-    not already cached, from the datastore and put into memcache. The cached
-    object is cleared whenever the .put() or .delete() method is called.
+    This retrieves the UserPrefs object is automatically from the cache or,
+    if not already cached, from the datastore and put into the cache. The
+    cached object is cleared whenever the .put() or .delete() method is
+    called.
+
+    The key name is derived from the user's identity (see key_name()), so
+    loading and creating a UserPrefs is a strongly consistent get or
+    get_or_insert, and concurrent first logins cannot create duplicates.
 
     If users.get_current_user() is not logged in, from_user() returns None.
 
     The BaseRequestHandler (see handlers/baserequesthandler.py and main.py)
     automatically provides the current UserPref object via self.userprefs.
     """
+    # Cached by mc.cache, so ndb only needs to use its in-context cache
+    _use_memcache = False
+
     # Base settings. Copied over from OpenID at first login (may not be valid)
-    nickname = db.StringProperty()
-    email = db.StringProperty(default="")
+    nickname = ndb.StringProperty()
+    email = ndb.StringProperty(default="")
 
     # The md5 has of the email is used for gravatar image urls
-    email_md5 = db.StringProperty(default="")
+    email_md5 = ndb.StringProperty(default="")
 
     # email_verified is set after user clicked the link in verification mail
-    email_verified = db.BooleanProperty(default=False)
+    email_verified = ndb.BooleanProperty(default=False)
 
     # The main reference to the Google-internal user object
-    federated_identity = db.StringProperty()
-    federated_provider = db.StringProperty()
+    federated_identity = ndb.StringProperty()
+    federated_provider = ndb.StringProperty()
 
     # Google user id is only used on the dev server
-    google_user_id = db.StringProperty()
+    google_user_id = ndb.StringProperty()
 
     # Various meta information
-    date_joined = db.DateTimeProperty(auto_now_add=True)
-    date_lastlogin = db.DateTimeProperty(auto_now_add=True)  # TODO
-    date_lastactivity = db.DateTimeProperty(auto_now_add=True)  # TODO
+    date_joined = ndb.DateTimeProperty(auto_now_add=True)
+    # Updated in batches by activity.flush(), a few minutes late
+    date_lastlogin = ndb.DateTimeProperty(auto_now_add=True)
+    date_lastactivity = ndb.DateTimeProperty(auto_now_add=True)
 
     # is_setup: set to true after setting username and email at first login
-    is_setup = db.BooleanProperty(default=False)
+    is_setup = ndb.BooleanProperty(default=False)
 
     # Cursom properties
-    subscribed_to_newsletter = db.BooleanProperty(default=False)
+    subscribed_to_newsletter = ndb.BooleanProperty(default=False)
+
+    @staticmethod
+    def key_name(user=None, federated_identity=None, google_user_id=None):
+        """Returns the key name for a Google user object, or for the given
+        identity properties"""
+        if user:
+            federated_identity = user.federated_identity()
+            google_user_id = user.user_id()
+
+        if federated_identity:
+            # Standard OpenID user object
+            return "fid:%s" % federated_identity
+        else:
+            # On local devserver there is only the google user object
+            return "gid:%s" % google_user_id
 
     @staticmethod
     def from_user(user):
         """Returns the cached UserPrefs object. If not cached, get from DB and
-        put it into memcache."""
+        put it into the cache."""
         if not user:
             return None
 
         return mc.cache.get_userprefs(user)
 
-    @staticmethod
-    def _from_user(user):
+    @classmethod
+    def _from_user(cls, user):
         """Gets UserPrefs object from database. Used by
         mc.cache.get_userprefs() if not cached."""
-        if user.federated_identity():
-            # Standard OpenID user object
-            q = db.GqlQuery("SELECT * FROM UserPrefs WHERE \
-                federated_identity = :1", user.federated_identity())
-
-        else:
-            # On local devserver there is only the google user object
-            q = db.GqlQuery("SELECT * FROM UserPrefs WHERE \
-                google_user_id = :1", user.user_id())
+        key_name = cls.key_name(user)
 
         # Try to get the UserPrefs from the data store
-        prefs = q.get()
+        prefs = cls.get_by_id(key_name)
+
+        # Not migrated yet: copy the UserPrefs stored by the former db.Model
+        # (see migrate_batch()), which is deleted by the migration later
+        if not prefs:
+            legacy = cls._legacy_prefs(user)
+            if legacy:
+                logging.info("Copying legacy UserPrefs %s to %s",
+                        legacy.key.id(), key_name)
+                prefs = cls.get_or_insert(key_name, **legacy.to_dict())
 
         # If not existing, create now
         if not prefs:
@@ -91,57 +122,473 @@ class UserPrefs(db.Model):
                     # If user has email and openid-url is nickname, replace
                     nick = user.email()
 
-            # Create new user preference entity
+            # Create new user preference entity. get_or_insert returns the
+            # existing entity if a concurrent request created it first.
             logging.info("Creating new UserPrefs for %s" % nick)
-            prefs = UserPrefs(nickname=nick,
+            prefs = cls.get_or_insert(key_name, nickname=nick,
                     email=user.email(),
                     email_md5=md5(user.email().strip().lower()).hexdigest(),
                     federated_identity=user.federated_identity(),
                     federated_provider=user.federated_provider(),
                     google_user_id=user.user_id())
 
-            # Save the newly created UserPrefs
-            prefs.put()
-
-        # Keep an internal reference to the Google user object (for
-        # clearing the cache).
-        prefs._user = user
-
         # Return either found or just created user preferences
         return prefs
 
-    def put(self):
-        """
-        Overrides db.Model.put() to remove the cached object after an update.
-        """
-        # Call the put() method of the db.Model and keep the result
-        key = super(UserPrefs, self).put()
+    @classmethod
+    def _legacy_prefs(cls, user):
+        """Returns the best UserPrefs with a numeric id (stored by the former
+        db.Model) of the user, or None"""
+        if user.federated_identity():
+            q = cls.query(cls.federated_identity == user.federated_identity())
+        else:
+            q = cls.query(cls.google_user_id == user.user_id())
+        candidates = [prefs for prefs in q.fetch(10)
+                if isinstance(prefs.key.id(), (int, long))]
+        if candidates:
+            return max(candidates, key=cls._migration_rank)
 
-        # Remove previously cached object. If put() is called the first time
-        # (after creating the object) there would be no self._user.
-        if hasattr(self, "_user"):
-            self._clear_cache()
+    @staticmethod
+    def _migration_rank(prefs):
+        """Sort key of duplicate UserPrefs: the one that finished the
+        account setup wins, then the most recent one"""
+        return (prefs.is_setup, prefs.date_joined)
+
+    def _post_put_hook(self, future):
+        """Removes the previously cached object after an update. Puts of
+        activity.flush() only change the activity timestamps, which evicts
+        the cached objects of a whole batch at once."""
+        if not getattr(self, "_activity_only", False):
+            mc.cache.clear_userprefs(self.key.id())
+
+    @classmethod
+    def _post_delete_hook(cls, key, future):
+        """Removes the object from the cache after deleting it"""
+        mc.cache.clear_userprefs(key.id())
+
+    def delete(self):
+        self.key.delete()
+
+    @classmethod
+    def migrate_batch(cls, cursor=None, batch_size=100):
+        """Moves UserPrefs stored by the former db.Model (with numeric ids)
+        to entities keyed by identity, one batch at a time. Returns the
+        cursor to continue with, or None when done.
+
+        Numeric ids sort before key names, so the migration is done once the
+        first key name shows up. If there are duplicates for one identity,
+        the entity that finished the account setup is kept.
+
+        A keyed entity may already exist if the user logged in before the
+        migration ran (see _from_user()). It is kept if it finished the
+        account setup, which includes copies of the old entity; otherwise
+        the old settings replace it. Only then are the old entities
+        deleted."""
+        keys, cursor, more = cls.query().order(cls.key).fetch_page(
+                batch_size, keys_only=True, start_cursor=cursor)
+        old_keys = [key for key in keys if isinstance(key.id(), (int, long))]
+
+        # Group the old entities by their new key name
+        by_key_name = {}
+        for prefs in ndb.get_multi(old_keys):
+            if prefs:
+                by_key_name.setdefault(cls.key_name(
+                        federated_identity=prefs.federated_identity,
+                        google_user_id=prefs.google_user_id), []).append(prefs)
+
+        new_keys = [ndb.Key(cls, key_name) for key_name in by_key_name]
+        existing = ndb.get_multi(new_keys)
+        migrated = []
+        for key, current in zip(new_keys, existing):
+            best = max(by_key_name[key.id()], key=cls._migration_rank)
+            if current and (current.is_setup or not best.is_setup):
+                continue
+
+            prefs = cls(key=key, **best.to_dict())
+            if current:
+                # Keep the activity recorded since the first login
+                prefs.date_joined = min(current.date_joined, best.date_joined)
+                prefs.date_lastlogin = max(current.date_lastlogin,
+                        best.date_lastlogin)
+                prefs.date_lastactivity = max(current.date_lastactivity,
+                        best.date_lastactivity)
+            migrated.append(prefs)
+
+        ndb.put_multi(migrated)
+        ndb.delete_multi(old_keys)
+        logging.info("Migrated %s of %s UserPrefs", len(migrated),
+                len(old_keys))
+
+        if more and len(old_keys) == len(keys):
+            return cursor
+
+
+class Emails(ndb.Model):
+    """Outgoing email, sent and deleted by the /services/cron1 workers"""
+    to = ndb.StringProperty(indexed=False)
+    subject = ndb.StringProperty(indexed=False)
+    body_text = ndb.TextProperty()
+    body_html = ndb.TextProperty()
+    date_created = ndb.DateTimeProperty(auto_now_add=True)
+
+
+class MailchimpOperation(ndb.Model):
+    """Pending newsletter (un)subscription of one email address, which is
+    the key name. Queued by tools.mailchimp.queue_subscription() and sent
+    to MailChimp in batches by tools.mailchimp.flush()."""
+    subscribe = ndb.BooleanProperty(indexed=False)
+    # Set by flush() before sending: the operation can no longer cancel out
+    sending = ndb.BooleanProperty(default=False, indexed=False)
+    updated = ndb.DateTimeProperty(auto_now=True)
 
-        # Return key provided by db.Model.put()
-        return key
+
+class Project(ndb.Model):
+    """A monitored project. Metric agents authenticate against the ingest
+    API with the project's api_key, which embeds the project id so that
+    authentication is a get by key (served from the ndb caches) instead of a
+    query:
+
+        project = Project.create("web frontend")
+        project.api_key  # -> "<project id>-<secret>"
+
+        project = Project.from_api_key(key_from_request_header)
+    """
+    name = ndb.StringProperty()
+    api_secret = ndb.StringProperty(indexed=False)
+    date_created = ndb.DateTimeProperty(auto_now_add=True)
+
+    # Overrides of settings.RETENTION_DAYS, eg. {"raw": 14, "60": 90}
+    retention = ndb.JsonProperty()
+
+    # Ingest limits in samples per second and per day (UTC), None for the
+    # defaults of settings.INGEST_RATE_LIMIT and INGEST_DAILY_QUOTA
+    rate_limit = ndb.IntegerProperty()
+    daily_quota = ndb.IntegerProperty()
+
+    @property
+    def api_key(self):
+        return "%s-%s" % (self.key.id(), self.api_secret)
+
+    @classmethod
+    def create(cls, name):
+        """Creates and stores a new project with a random api secret"""
+        project = cls(name=name, api_secret=hexlify(os.urandom(16)))
+        project.put()
+        return project
+
+    def retention_days(self, data):
+        """Returns the number of days the data ("raw" or a rollup
+        resolution) is kept, or None if it is kept forever"""
+        overrides = self.retention or {}
+        if str(data) in overrides:
+            return overrides[str(data)]
+        return settings.RETENTION_DAYS.get(data)
+
+    @classmethod
+    def from_api_key(cls, api_key):
+        """Returns the project for this api key, or None if the key is
+        malformed or does not match."""
+        try:
+            project_id, secret = api_key.split("-", 1)
+            project = cls.get_by_id(int(project_id))
+        except (AttributeError, ValueError):
+            return None
+
+        if project and tools.common.constant_time_compare(
+                project.api_secret or "", secret):
+            return project
+
+
+class SeriesChunk(ndb.Model):
+    """The samples of one series within a fixed time window (see
+    settings.CHUNK_SECONDS), packed into a single blob with tools.tscodec.
+
+    The key name is derived from project, series and window start, so that
+    reading a time range is a batch get of the window keys instead of a
+    query (see metrics.read_range). Chunks reference their project instead
+    of using it as the parent, so that hundreds of agents can write
+    concurrently without contending on a single entity group.
+    """
+    project = ndb.KeyProperty(kind=Project)
+    series = ndb.StringProperty()
+
+    # Window start in unix seconds (a multiple of settings.CHUNK_SECONDS)
+    start = ndb.IntegerProperty()
+
+    count = ndb.IntegerProperty(default=0, indexed=False)
+    data = ndb.BlobProperty()
+
+    # Used by the rollup pipeline to find chunks written since its watermark
+    updated = ndb.DateTimeProperty(auto_now=True)
+
+    @classmethod
+    def window_start(cls, timestamp):
+        return timestamp - timestamp % settings.CHUNK_SECONDS
+
+    @classmethod
+    def key_for(cls, project_key, series, window_start):
+        return ndb.Key(cls, "%s:%s@%d" % (project_key.id(), series,
+                window_start))
+
+    @classmethod
+    def parse_key(cls, key):
+        """Returns the (series, window_start) tuple encoded in a chunk key"""
+        series, start = key.id().split(":", 1)[1].rsplit("@", 1)
+        return series, int(start)
+
+    def points(self):
+        """Returns the sorted list of (timestamp, value) tuples. The blob is
+        decoded on first access only."""
+        if not hasattr(self, "_points"):
+            if self.data:
+                self._points = zip(*tools.tscodec.decode(self.data))
+            else:
+                self._points = []
+        return self._points
+
+    def set_points(self, points):
+        """Replaces the content with a sorted list of (timestamp, value)
+        tuples"""
+        self._points = points
+        self.count = len(points)
+        self.data = tools.tscodec.encode(points)
+
+
+class RollupChunk(ndb.Model):
+    """Downsampled buckets of one series at one resolution (see
+    settings.ROLLUP_PERIODS), covering a fixed period. Each bucket keeps
+    [min, max, sum, count, last] of the samples within it.
+
+    Like SeriesChunk, the key name is derived from project, series,
+    resolution and period start, so reads are batch gets (see rollup.read).
+    """
+    project = ndb.KeyProperty(kind=Project)
+    series = ndb.StringProperty()
+    resolution = ndb.IntegerProperty()
+
+    # Period start in unix seconds
+    start = ndb.IntegerProperty()
+
+    # Packed array of doubles, 6 per bucket: start, min, max, sum, count, last
+    data = ndb.BlobProperty()
+
+    @classmethod
+    def period_start(cls, resolution, timestamp):
+        return timestamp - timestamp % settings.ROLLUP_PERIODS[resolution]
+
+    @classmethod
+    def key_for(cls, project_key, series, resolution, period_start):
+        return ndb.Key(cls, "%s:%s/%d@%d" % (project_key.id(), series,
+                resolution, period_start))
+
+    def buckets(self):
+        """Returns the dict of {bucket_start: [min, max, sum, count, last]}.
+        The blob is decoded on first access only."""
+        if not hasattr(self, "_buckets"):
+            self._buckets = {}
+            values = array("d")
+            values.fromstring(self.data or "")
+            for i in xrange(0, len(values), 6):
+                self._buckets[int(values[i])] = list(values[i + 1:i + 6])
+        return self._buckets
+
+    def set_buckets(self, buckets):
+        self._buckets = buckets
+        values = array("d")
+        for start in sorted(buckets):
+            values.append(start)
+            values.extend(buckets[start])
+        self.data = values.tostring()
+
+
+class HistogramBucket(ndb.Model):
+    """Quantile sketch (tools.sketch) of the samples of a histogram series
+    within one time bucket. Dashboards get percentiles by merging sketches
+    (see metrics.read_sketch) instead of sorting raw samples.
+
+    Ingest merges samples into buckets of the smallest rollup resolution,
+    into one of settings.HISTOGRAM_SHARDS randomly chosen shards so that
+    agents reporting the same series rarely update the same entity. The
+    rollup pipeline merges the shards into the larger resolutions, which
+    always use shard 0.
+    """
+    project = ndb.KeyProperty(kind=Project)
+    series = ndb.StringProperty()
+    resolution = ndb.IntegerProperty()
+
+    # Bucket start in unix seconds
+    start = ndb.IntegerProperty()
+
+    sketch = ndb.BlobProperty()
+
+    # Set by ingest only, used by the rollup pipeline to find new buckets
+    updated = ndb.DateTimeProperty()
+
+    @classmethod
+    def key_for(cls, project_key, series, resolution, start, shard=0):
+        return ndb.Key(cls, "%s:%s/%d@%d#%d" % (project_key.id(), series,
+                resolution, start, shard))
+
+    @classmethod
+    def parse_key(cls, key):
+        """Returns the (series, bucket start) tuple encoded in a key"""
+        series, rest = key.id().split(":", 1)[1].rsplit("/", 1)
+        return series, int(rest.split("@")[1].split("#")[0])
+
+    def get_sketch(self):
+        return tools.sketch.Sketch.deserialize(self.sketch)
+
+    def set_sketch(self, sketch):
+        self.sketch = sketch.serialize()
+
+
+class Watermark(ndb.Model):
+    """Progress marker of an incremental background job for one project.
+    The key name is "<job>:<project id>" (see Watermark.key_for)."""
+    value = ndb.DateTimeProperty()
+
+    @classmethod
+    def key_for(cls, job, project_key):
+        return ndb.Key(cls, "%s:%s" % (job, project_key.id()))
+
+
+class AlertRule(ndb.Model):
+    """Alert rule of a series, evaluated incrementally as samples arrive (see
+    alerts.py):
+
+    - threshold: fires while the EWMA of the values is above (op ">") or
+      below (op "<") the threshold
+    - rate: fires while the change per second over the last `window`
+      seconds is above or below the threshold
+    - absence: fires if the series got no sample for `window` seconds
+    """
+    project = ndb.KeyProperty(kind=Project)
+    series = ndb.StringProperty()
+    kind = ndb.StringProperty(choices=["threshold", "rate", "absence"])
+    op = ndb.StringProperty(choices=[">", "<"], default=">")
+    threshold = ndb.FloatProperty(default=0.0)
+    window = ndb.IntegerProperty(default=300)
+
+    # Smoothing factor of the EWMA of threshold rules (1.0: no smoothing)
+    alpha = ndb.FloatProperty(default=1.0)
+
+    # Email address notified when the alert fires or resolves
+    notify = ndb.StringProperty()
+    date_created = ndb.DateTimeProperty(auto_now_add=True)
+
+    def _post_put_hook(self, future):
+        mc.cache.clear_alert_rules(self.project)
 
     def delete(self):
-        """
-        Overrides db.Model.delete() to remove the object from memcache.
-        """
-        super(UserPrefs, self).delete()
-        self._clear_cache()
+        self.key.delete()
+        mc.cache.clear_alert_rules(self.project)
 
-    def _clear_cache(self):
-        """
-        Removes the object from memcache. Automatically called on .put()
-        and .delete().
-        """
-        mc.cache.get_userprefs(self._user, clear=True)
 
+class AlertState(ndb.Model):
+    """Rolling evaluation state of an AlertRule, with the same id. The state
+    lives in memcache and is written through to this entity when the alert
+    fires or resolves, and periodically (see alerts.py)."""
+    state = ndb.JsonProperty()
 
-class Project(ndb.Model):
-	name = ndb.StringProperty()
-	
+
+class SeriesCatalog(ndb.Model):
+    """Root of the series catalog of a project, with the same id as the
+    project (see catalog.py). The catalog entities below are children of
+    it, so a registration updates them in one transaction. `count` is the
+    number of registered series, ie. the next series id."""
+    count = ndb.IntegerProperty(default=0, indexed=False)
+
+    @classmethod
+    def key_for(cls, project_key):
+        return ndb.Key(cls, project_key.id())
+
+
+class SeriesId(ndb.Model):
+    """Id of a registered series, with the series name as key name"""
+    series_id = ndb.IntegerProperty(indexed=False)
+
+
+class SeriesNames(ndb.Model):
+    """Names of the series with ids page * catalog.PAGE_SIZE and up, with
+    the page number as id"""
+    names = ndb.JsonProperty(compressed=True)
 
 
+class SeriesPosting(ndb.Model):
+    """Sorted ids (array of uint32) of the series with one label pair, with
+    "label=value" as key name. The metric name is the label __name__."""
+    ids = ndb.BlobProperty(compressed=True)
+
+    def get_ids(self):
+        return array('I', self.ids or "")
+
+    def set_ids(self, ids):
+        self.ids = ids.tostring()
+
+
+class AnomalyCandidate(ndb.Model):
+    """Anomaly found in a rollup bucket of a series by the batch detection
+    (see anomaly.py): the bucket mean `value` deviated from the `expected`
+    value by `score` standard deviations. A candidate for an alert rule, or
+    for a closer look. The key name is "<project id>:<series>@<bucket
+    start>:<method>", so a repeated detection overwrites it."""
+    project = ndb.KeyProperty(kind=Project)
+    series = ndb.StringProperty()
+    timestamp = ndb.IntegerProperty()
+    method = ndb.StringProperty(choices=["ewma", "seasonal"])
+    score = ndb.FloatProperty(indexed=False)
+    value = ndb.FloatProperty(indexed=False)
+    expected = ndb.FloatProperty(indexed=False)
+    date_created = ndb.DateTimeProperty(auto_now_add=True)
+
+    @classmethod
+    def key_for(cls, project_key, series, timestamp, method):
+        return ndb.Key(cls, "%s:%s@%d:%s" % (project_key.id(), series,
+                timestamp, method))
+
+
+class HttpCheck(ndb.Model):
+    """Synthetic HTTP check of a project, run every `interval` seconds (one
+    of settings.CHECK_INTERVALS, see checks.py). Each run records the
+    samples <series>.up (1 if the response had the expected status, else
+    0), <series>.status (0 if the request failed) and <series>.latency (in
+    seconds), so alert rules work on checks like on any other series.
+    """
+    project = ndb.KeyProperty(kind=Project)
+    url = ndb.StringProperty()
+    method = ndb.StringProperty(choices=["GET", "HEAD"], default="GET")
+    interval = ndb.IntegerProperty(default=60,
+            choices=settings.CHECK_INTERVALS)
+    timeout = ndb.FloatProperty(default=10.0)
+    expected_status = ndb.IntegerProperty(default=200)
+    enabled = ndb.BooleanProperty(default=True)
+
+    # Prefix of the recorded series, "check.<id>" if not set
+    series = ndb.StringProperty()
+
+    def series_prefix(self):
+        return self.series or "check.%s" % self.key.id()
+
+
+class QuotaUsage(ndb.Model):
+    """Samples ingested and rejected by a project on one day (UTC). The
+    counters live in memcache and are written through to this entity
+    periodically (see quotas.py)."""
+    project = ndb.KeyProperty(kind=Project)
+    day = ndb.IntegerProperty()
+    samples = ndb.IntegerProperty(default=0, indexed=False)
+    rejected = ndb.IntegerProperty(default=0, indexed=False)
+    updated = ndb.DateTimeProperty(auto_now=True)
+
+    @classmethod
+    def key_for(cls, project_key, day):
+        """Returns the key for the usage of a project on a day (unix time //
+        86400)"""
+        return ndb.Key(cls, "%s:%s" % (project_key.id(), day))
+
+
+class StatsSample(ndb.Model):
+    """Request stats of one instance, aggregated by handler over
+    settings.STATS_FLUSH_SECONDS (see tools.stats)"""
+    handlers = ndb.JsonProperty(compressed=True)
+    date_created = ndb.DateTimeProperty(auto_now_add=True)
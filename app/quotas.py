@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+"""
+Ingest rate limits and daily quotas per project.
+
+Both are counters in memcache, updated with a single offset_multi() RPC per
+ingest request (see consume()):
+
+- rate: samples of the current window of settings.INGEST_RATE_WINDOW
+  seconds. Every window allots rate_limit * INGEST_RATE_WINDOW samples, so
+  a project can burst within a window but not exceed its average rate.
+- quota: samples of the current day (UTC), against daily_quota.
+
+Requests over a limit are rejected with 429 and the seconds until the
+window or day ends (for Retry-After), and their samples are taken off the
+counters again. The daily usage is written through to a QuotaUsage entity
+every settings.QUOTA_PERSIST_SAMPLES samples. If memcache evicts the daily
+counter, the next request restores it from there.
+
+If memcache is unavailable, requests are accepted (fail open).
+"""
+import time
+import logging
+
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+
+import settings
+from models import QuotaUsage
+
+
+def limits(project):
+    """Returns (samples per second, samples per day) of the project"""
+    return (project.rate_limit or settings.INGEST_RATE_LIMIT,
+            project.daily_quota or settings.INGEST_DAILY_QUOTA)
+
+
+def _rate_key(project_key, window):
+    return "ratelimit:%s:%s" % (project_key.id(), window)
+
+
+def _quota_key(project_key, day):
+    return "quota:%s:%s" % (project_key.id(), day)
+
+
+def _rejected_key(project_key, day):
+    return "quota-rejected:%s:%s" % (project_key.id(), day)
+
+
+def consume(project, count, now=None):
+    """Counts count samples against the limits of the project. Returns
+    None if they are accepted, or the number of seconds after which the
+    client may retry."""
+    now = int(now or time.time())
+    window = now // settings.INGEST_RATE_WINDOW
+    day = now // 86400
+    rate_key = _rate_key(project.key, window)
+    quota_key = _quota_key(project.key, day)
+
+    counters = memcache.offset_multi({rate_key: count, quota_key: count},
+            initial_value=0)
+    rate = counters.get(rate_key)
+    used = counters.get(quota_key)
+    if rate is None or used is None:
+        logging.warning("Quota counters of project %s not available",
+                project.key.id())
+        return None
+
+    if used == count:
+        # The daily counter was just created: continue from the stored usage
+        # if it was evicted
+        usage = QuotaUsage.key_for(project.key, day).get()
+        if usage and usage.samples:
+            used = memcache.incr(quota_key, usage.samples) or used
+
+    rate_limit, daily_quota = limits(project)
+    retry_after = None
+    if rate > rate_limit * settings.INGEST_RATE_WINDOW:
+        retry_after = (window + 1) * settings.INGEST_RATE_WINDOW - now
+    if used > daily_quota:
+        retry_after = (day + 1) * 86400 - now
+
+    if retry_after is not None:
+        memcache.offset_multi({rate_key: -count, quota_key: -count,
+                _rejected_key(project.key, day): count}, initial_value=0)
+        logging.info("Project %s over its ingest limits, retry after %ss",
+                project.key.id(), retry_after)
+        return max(1, retry_after)
+
+    if used // settings.QUOTA_PERSIST_SAMPLES != \
+            (used - count) // settings.QUOTA_PERSIST_SAMPLES:
+        persist(project.key, day, used)
+    return None
+
+
+def persist(project_key, day, used):
+    """Writes the daily usage through to its QuotaUsage entity"""
+    rejected = memcache.get(_rejected_key(project_key, day)) or 0
+    QuotaUsage(key=QuotaUsage.key_for(project_key, day), project=project_key,
+            day=day, samples=used, rejected=rejected).put()
+
+
+def get_usage(projects, now=None):
+    """Returns a list of dicts with the current consumption of the projects
+    (for the admin view), read with one memcache RPC"""
+    now = int(now or time.time())
+    window = now // settings.INGEST_RATE_WINDOW
+    day = now // 86400
+
+    keys = []
+    for project in projects:
+        keys.extend([_rate_key(project.key, window),
+                _quota_key(project.key, day),
+                _rejected_key(project.key, day)])
+    cached = memcache.get_multi(keys)
+
+    # Stored usage of projects whose daily counter is not in memcache
+    missing = [project.key for project in projects
+            if _quota_key(project.key, day) not in cached]
+    stored = dict((key, usage) for key, usage in zip(missing,
+            ndb.get_multi([QuotaUsage.key_for(key, day) for key in missing])))
+
+    usage = []
+    for project in projects:
+        rate_limit, daily_quota = limits(project)
+        used = cached.get(_quota_key(project.key, day))
+        rejected = cached.get(_rejected_key(project.key, day))
+        if used is None and stored.get(project.key):
+            used = stored[project.key].samples
+            rejected = stored[project.key].rejected
+        used = used or 0
+        usage.append({
+            "project": project,
+            "rate": (cached.get(_rate_key(project.key, window)) or 0) /
+                    float(settings.INGEST_RATE_WINDOW),
+            "rate_limit": rate_limit,
+            "used": used,
+            "rejected": rejected or 0,
+            "daily_quota": daily_quota,
+            "percent": used * 100.0 / daily_quota,
+        })
+    return usage
@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+"""
+Deletes the data of a project that is older than its retention (see
+settings.RETENTION_DAYS and models.Project.retention_days()):
+
+1. /services/retention (daily cron) enqueues one task per project.
+2. /services/retention/project (purge()) runs a keys-only query for the
+   expired entities of each kind of data in turn and deletes the keys of
+   every page with delete_multi_async batches, at most
+   settings.RETENTION_CONCURRENCY batches at a time.
+
+An entity is only deleted when all of its data is expired: a raw chunk once
+its whole window is older than the retention, a rollup chunk once its whole
+period is.
+
+A purge that takes longer than TASK_SECONDS continues in a new task with
+the query cursor. The cutoff time is passed on as well, so the continuation
+works on the same set of entities. Deleting is idempotent, so a retried task
+simply starts again at its cursor.
+"""
+import time
+import logging
+
+from google.appengine.api import taskqueue
+from google.appengine.ext import ndb
+
+import settings
+import tools.fanout as fanout
+from models import Project, SeriesChunk, RollupChunk, HistogramBucket
+
+QUEUE = "retention"
+
+# Stop paging and continue in a new task after this many seconds
+TASK_SECONDS = 300
+
+# Keys fetched per query page
+PAGE_SIZE = 2000
+
+
+def enqueue_projects():
+    """Enqueues one purge task per project"""
+    tasks = [taskqueue.Task(url="/services/retention/project",
+            params={"project": key.id()})
+            for key in Project.query().iter(keys_only=True)]
+    fanout.add_tasks(tasks, QUEUE)
+    logging.info("Enqueued %s retention tasks", len(tasks))
+
+
+def expired_queries(project, now):
+    """Returns the queries for the expired entities of the project, one per
+    kind of data (raw chunks, and rollup chunks and histogram buckets per
+    resolution)"""
+    queries = []
+    days = project.retention_days("raw")
+    if days is not None:
+        cutoff = now - days * 86400
+        queries.append(SeriesChunk.query(
+                SeriesChunk.project == project.key,
+                SeriesChunk.start <= cutoff - settings.CHUNK_SECONDS))
+
+    for resolution in sorted(settings.ROLLUP_PERIODS):
+        days = project.retention_days(resolution)
+        if days is None:
+            continue
+        cutoff = now - days * 86400
+        queries.append(RollupChunk.query(
+                RollupChunk.project == project.key,
+                RollupChunk.resolution == resolution,
+                RollupChunk.start <= cutoff -
+                        settings.ROLLUP_PERIODS[resolution]))
+        queries.append(HistogramBucket.query(
+                HistogramBucket.project == project.key,
+                HistogramBucket.resolution == resolution,
+                HistogramBucket.start <= cutoff - resolution))
+    return queries
+
+
+@ndb.tasklet
+def _delete_batch(keys):
+    yield ndb.delete_multi_async(keys)
+
+
+def delete_keys(keys):
+    """Deletes the keys in batches of settings.RETENTION_BATCH_SIZE, with at
+    most settings.RETENTION_CONCURRENCY batch deletes in flight"""
+    size = settings.RETENTION_BATCH_SIZE
+    pending = []
+    for i in xrange(0, len(keys), size):
+        if len(pending) >= settings.RETENTION_CONCURRENCY:
+            done = ndb.Future.wait_any(pending)
+            pending.remove(done)
+            done.check_success()
+        pending.append(_delete_batch(keys[i:i + size]))
+
+    ndb.Future.wait_all(pending)
+    for future in pending:
+        future.check_success()
+
+
+def purge(project_key, stage=0, cursor=None, now=None):
+    """Deletes the expired data of a project, starting with the query
+    expired_queries()[stage] at cursor. Returns the number of deleted
+    entities."""
+    started = time.time()
+    project = project_key.get()
+    if not project:
+        return 0
+
+    now = now or int(started)
+    queries = expired_queries(project, now)
+    deleted = 0
+    while stage < len(queries):
+        more = True
+        while more:
+            keys, cursor, more = queries[stage].fetch_page(PAGE_SIZE,
+                    keys_only=True, start_cursor=cursor)
+            delete_keys(keys)
+            deleted += len(keys)
+
+            if more and time.time() - started > TASK_SECONDS:
+                taskqueue.add(url="/services/retention/project",
+                        queue_name=QUEUE, params={"project": project_key.id(),
+                        "stage": stage, "cursor": cursor.urlsafe(),
+                        "now": now})
+                logging.info("Retention of project %s: deleted %s entities, "
+                        "continuing", project_key.id(), deleted)
+                return deleted
+
+        stage += 1
+        cursor = None
+
+    logging.info("Retention of project %s: deleted %s entities",
+            project_key.id(), deleted)
+    return deleted
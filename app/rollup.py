@@ -0,0 +1,292 @@
+# -*- coding: utf-8 -*-
+"""
+Incremental rollups (downsampling) of the raw series.
+
+Every bucket of a rollup keeps [min, max, sum, count, last] of its samples,
+at the resolutions configured in settings.ROLLUP_PERIODS. Long time ranges
+are read from the rollups (see read()), so a 90-day dashboard reads a few
+RollupChunk entities instead of thousands of raw chunks.
+
+The pipeline is driven by cron and partitioned by project and series (see
+the Rollup* handlers in services.py):
+
+1. /services/rollup (cron) enqueues one task per project.
+2. /services/rollup/project finds the chunks written since the project's
+   watermark with a keys-only query and enqueues one task per series.
+3. /services/rollup/series recomputes the buckets of the affected windows.
+
+Histogram series are rolled up the same way (through
+/services/rollup/histogram): their sketches are merged into the sketches of
+the larger resolutions.
+
+Buckets are always recomputed from their complete source data and replaced,
+so retried tasks, late samples and chunks that are rolled up again (see
+settings.ROLLUP_OVERLAP_SECONDS) do not count anything twice.
+"""
+import time
+import logging
+import calendar
+
+from datetime import datetime, timedelta
+from google.appengine.api import taskqueue
+from google.appengine.ext import ndb
+
+import settings
+import tools.fanout as fanout
+from models import Project, SeriesChunk, RollupChunk, HistogramBucket, \
+        Watermark
+
+QUEUE = "rollup"
+WATERMARK_PREFIX = "rollup-"
+
+# Entities that are rolled up: the model, with project and updated
+# properties and a parse_key() method, and the url of the series worker
+SOURCES = {
+    "series": (SeriesChunk, "/services/rollup/series"),
+    "histogram": (HistogramBucket, "/services/rollup/histogram"),
+}
+
+# Resolutions in ascending order
+RESOLUTIONS = sorted(settings.ROLLUP_PERIODS)
+
+# Stop paging and continue in a new task after this many seconds
+TASK_SECONDS = 300
+
+# Source entities read per rollup transaction (cross-group transactions
+# span at most 25 entity groups, one is the RollupChunk)
+XG_SOURCES = 24
+
+
+def aggregate(points, resolution):
+    """Returns {bucket_start: [min, max, sum, count, last]} for a sorted list
+    of (timestamp, value) tuples."""
+    buckets = {}
+    for timestamp, value in points:
+        start = timestamp - timestamp % resolution
+        bucket = buckets.get(start)
+        if bucket is None:
+            buckets[start] = [value, value, value, 1, value]
+        else:
+            if value < bucket[0]:
+                bucket[0] = value
+            if value > bucket[1]:
+                bucket[1] = value
+            bucket[2] += value
+            bucket[3] += 1
+            bucket[4] = value
+    return buckets
+
+
+def merge(buckets):
+    """Merges a list of buckets, sorted by bucket start, into one"""
+    return [min(b[0] for b in buckets), max(b[1] for b in buckets),
+            sum(b[2] for b in buckets), sum(b[3] for b in buckets),
+            buckets[-1][4]]
+
+
+def enqueue_projects():
+    """Enqueues one rollup task per project and source"""
+    tasks = [taskqueue.Task(url="/services/rollup/project",
+            params={"project": key.id(), "source": source})
+            for key in Project.query().iter(keys_only=True)
+            for source in SOURCES]
+    fanout.add_tasks(tasks, QUEUE)
+    logging.info("Enqueued %s rollup tasks", len(tasks))
+
+
+def enqueue_series(project_key, source="series", cursor=None, until=None):
+    """Enqueues one rollup task per series with source entities (see
+    SOURCES) written since the project's watermark. Continues in a new task
+    if paging takes too long; the watermark is only advanced once all
+    series are enqueued."""
+    model, worker_url = SOURCES[source]
+    started = time.time()
+    watermark_key = Watermark.key_for(WATERMARK_PREFIX + source, project_key)
+    watermark = watermark_key.get() or Watermark(key=watermark_key,
+            value=datetime.utcfromtimestamp(0))
+    until = until or datetime.utcfromtimestamp(int(started) -
+            settings.ROLLUP_SETTLE_SECONDS)
+
+    # Writes that only became visible after the watermark passed them are
+    # picked up by re-scanning an overlap window
+    since = watermark.value - timedelta(
+            seconds=settings.ROLLUP_OVERLAP_SECONDS)
+    q = model.query(model.project == project_key,
+            model.updated > since,
+            model.updated <= until)
+
+    more = True
+    while more:
+        keys, cursor, more = q.fetch_page(1000, keys_only=True,
+                start_cursor=cursor)
+
+        windows = {}
+        for key in keys:
+            series, start = model.parse_key(key)
+            windows.setdefault(series, set()).add(str(start))
+
+        fanout.add_tasks([taskqueue.Task(url=worker_url,
+                params={"project": project_key.id(), "series": series,
+                        "windows": ",".join(starts)})
+                for series, starts in windows.iteritems()], QUEUE)
+
+        if more and time.time() - started > TASK_SECONDS:
+            taskqueue.add(url="/services/rollup/project", queue_name=QUEUE,
+                    params={"project": project_key.id(), "source": source,
+                            "cursor": cursor.urlsafe(),
+                            "until": calendar.timegm(until.timetuple())})
+            return
+
+    watermark.value = until
+    watermark.put()
+
+
+def update_series(project_key, series, windows):
+    """Recomputes all rollup buckets of a series that cover the given raw
+    chunk windows.
+
+    Every RollupChunk is updated in a transaction that also reads the
+    entities its buckets are computed from, so two tasks for the same series
+    (eg. from overlapping cron runs) cannot overwrite each other's buckets
+    or write buckets computed from outdated data."""
+    # Bucket starts updated per resolution
+    updated = {}
+    source = None
+    for resolution in RESOLUTIONS:
+        # {period: {source key: [bucket start, ...]}}
+        by_period = {}
+        if resolution <= settings.CHUNK_SECONDS:
+            # Computed from the raw chunks
+            for window in windows:
+                key = SeriesChunk.key_for(project_key, series, window)
+                for start in xrange(window, window + settings.CHUNK_SECONDS,
+                        resolution):
+                    by_period.setdefault(RollupChunk.period_start(resolution,
+                            start), {}).setdefault(key, []).append(start)
+        else:
+            # Computed from the buckets of the next smaller resolution
+            for start in set(t - t % resolution for t in updated[source]):
+                key = RollupChunk.key_for(project_key, series, source,
+                        RollupChunk.period_start(source, start))
+                by_period.setdefault(RollupChunk.period_start(resolution,
+                        start), {}).setdefault(key, []).append(start)
+
+        updated[resolution] = set()
+        for period, sources in by_period.iteritems():
+            keys = sorted(sources)
+            for i in xrange(0, len(keys), XG_SOURCES):
+                _update_rollup(project_key, series, resolution, period,
+                        source, dict((key, sources[key])
+                                for key in keys[i:i + XG_SOURCES]))
+            for starts in sources.itervalues():
+                updated[resolution].update(starts)
+        source = resolution
+
+
+@ndb.transactional(xg=True)
+def _update_rollup(project_key, series, resolution, period, source, sources):
+    """Recomputes buckets of one RollupChunk from {source key: [bucket
+    start, ...]}, where the sources are raw chunks, or the rollup chunks of
+    the source resolution"""
+    key = RollupChunk.key_for(project_key, series, resolution, period)
+    source_keys = sources.keys()
+    entities = ndb.get_multi([key] + source_keys)
+    rollup = entities[0] or RollupChunk(key=key, project=project_key,
+            series=series, resolution=resolution, start=period)
+    buckets = rollup.buckets()
+
+    for source_key, entity in zip(source_keys, entities[1:]):
+        if resolution <= settings.CHUNK_SECONDS:
+            if not entity:
+                continue
+            # Windows start on bucket boundaries, so any bucket of the
+            # window without samples is gone now
+            computed = aggregate(entity.points(), resolution)
+        else:
+            parts = entity.buckets() if entity else {}
+            computed = {}
+            for start in sources[source_key]:
+                found = [parts[t] for t in xrange(start, start + resolution,
+                        source) if t in parts]
+                if found:
+                    computed[start] = merge(found)
+
+        for start in sources[source_key]:
+            if start in computed:
+                buckets[start] = computed[start]
+            else:
+                buckets.pop(start, None)
+
+    rollup.set_buckets(buckets)
+    rollup.put()
+
+
+def update_histogram(project_key, series, starts):
+    """Recomputes the sketches of all resolutions of a histogram series that
+    cover the given ingest buckets, by merging the sketches of the next
+    smaller resolution (all shards, for the ingest resolution)."""
+    # Sketches computed here, by key, which are not readable with a get yet
+    written = {}
+    updated = set(starts)
+    source = RESOLUTIONS[0]
+    for resolution in RESOLUTIONS[1:]:
+        shards = settings.HISTOGRAM_SHARDS if source == RESOLUTIONS[0] else 1
+        sources = {}
+        for start in set(t - t % resolution for t in updated):
+            sources[start] = [HistogramBucket.key_for(project_key, series,
+                    source, t, shard)
+                    for t in xrange(start, start + resolution, source)
+                    for shard in xrange(shards)]
+
+        keys = [key for keys in sources.itervalues() for key in keys
+                if key not in written]
+        loaded = dict(zip(keys, ndb.get_multi(keys)))
+        loaded.update(written)
+
+        for start, keys in sources.iteritems():
+            buckets = [loaded[key] for key in keys if loaded.get(key)]
+            if not buckets:
+                continue
+            sketch = buckets[0].get_sketch()
+            for bucket in buckets[1:]:
+                sketch.merge(bucket.get_sketch())
+
+            key = HistogramBucket.key_for(project_key, series, resolution,
+                    start)
+            written[key] = HistogramBucket(key=key, project=project_key,
+                    series=series, resolution=resolution, start=start,
+                    sketch=sketch.serialize())
+
+        updated = sources.keys()
+        source = resolution
+
+    ndb.put_multi(written.values())
+
+
+def choose_resolution(start, end):
+    """Returns the smallest resolution that yields at most
+    settings.ROLLUP_MAX_POINTS buckets for the time range"""
+    for resolution in RESOLUTIONS:
+        if (end - start) / resolution <= settings.ROLLUP_MAX_POINTS:
+            return resolution
+    return RESOLUTIONS[-1]
+
+
+def read(project, series, start, end, resolution=None):
+    """Returns the sorted list of (bucket_start, min, max, sum, count, last)
+    tuples of a series with start <= bucket_start < end. If resolution is
+    not set it is chosen by choose_resolution()."""
+    resolution = resolution or choose_resolution(start, end)
+    period = settings.ROLLUP_PERIODS[resolution]
+    keys = [RollupChunk.key_for(project.key, series, resolution, t)
+            for t in xrange(RollupChunk.period_start(resolution, start), end,
+                    period)]
+
+    buckets = []
+    for rollup in ndb.get_multi(keys):
+        if rollup:
+            buckets.extend((t,) + tuple(b) for t, b in
+                    rollup.buckets().iteritems() if start <= t < end)
+    buckets.sort()
+    return buckets
+
@@ -1,62 +1,281 @@
 # -*- coding: utf-8 -*-
-import os
-from google.appengine.dist import use_library
-os.environ['DJANGO_SETTINGS_MODULE'] = 'settings'
-use_library('django', '1.2')
-
 """
 Services that are accessible to admin only (eg. cron).
 """
+import os
+os.environ['DJANGO_SETTINGS_MODULE'] = 'settings'
 
+from datetime import datetime, timedelta
 from google.appengine.api import mail
 from google.appengine.api import taskqueue
+from google.appengine.datastore.datastore_query import Cursor
+from google.appengine.ext import ndb
 from google.appengine.ext import webapp
 from google.appengine.ext.webapp.util import run_wsgi_app
 
-from models import Emails
-from handlers import *
+import activity
+import alerts
+import catalog
+import checks
+import quotas
+import retention
+import rollup
+import settings
+import tools.fanout as fanout
+import tools.mailchimp
+import tools.stats
+from handlers.baserequesthandler import BaseRequestHandler
+from models import AlertRule, Emails, Project, StatsSample, UserPrefs
 
 
 class Cron1(webapp.RequestHandler):
     def get(self):
-        """Cron job that queries the db and forks a worker for each entry"""
-        emails = db.GqlQuery("SELECT * FROM emails WHERE 1")
+        """Cron job that scans the db and forks a worker for each batch of
+        entries. Large scans continue in a new task (see tools.fanout)."""
+        fanout.scan(Emails.query(), '/services/cron1-worker1',
+                continue_url='/services/cron1',
+                cursor=self.request.get('cursor'),
+                scan_id=self.request.get('scan'))
 
-        # Start worker requests in the background
-        for email in emails:
-            taskqueue.add(url='/services/cron1-worker1/%s' % email.key())
+    # Continuation tasks of the scan
+    post = get
 
 
 class Cron1_Worker1(webapp.RequestHandler):
-    def post(self, key):
-        """Worker that runs in the 'background'"""
-        # Get the object from the database
-        email = Emails.get(key)
+    def post(self):
+        """Worker that runs in the 'background' for a batch of entries"""
+        # Get the objects from the database
+        emails = [email for email in
+                ndb.get_multi(fanout.get_keys(self.request)) if email]
+
+        sent = []
+        try:
+            for email in emails:
+                # Construct a appengine.api.mail object
+                message = mail.EmailMessage()
+                message.sender = "Your Name <you@domain.x>"
+                message.to = email.to
+                message.subject = email.subject
+
+                # Set text and html body
+                message.body = email.body_text
+                message.html = email.body_html
+
+                # Send. Important: Sometimes emails fail to send, which will
+                # throw an exception and end the function there. The task is
+                # retried for the emails that were not sent yet.
+                message.send()
+                sent.append(email.key)
+
+        finally:
+            # Now the messages were sent and we can safely delete them.
+            ndb.delete_multi(sent)
+
+
+class AlertAbsence(webapp.RequestHandler):
+    def get(self):
+        """Cron job that checks all absence alert rules in batches"""
+        fanout.scan(AlertRule.query(AlertRule.kind == "absence"),
+                '/services/alerts/absence-worker',
+                continue_url='/services/alerts/absence',
+                cursor=self.request.get('cursor'),
+                scan_id=self.request.get('scan'))
+
+    # Continuation tasks of the scan
+    post = get
+
+
+class AlertAbsence_Worker(webapp.RequestHandler):
+    def post(self):
+        """Worker that checks a batch of absence alert rules"""
+        rules = [rule for rule in
+                ndb.get_multi(fanout.get_keys(self.request)) if rule]
+        alerts.check_absence(rules)
+
+
+class Checks(webapp.RequestHandler):
+    def get(self):
+        """Cron job that enqueues the HTTP checks due in this minute"""
+        checks.schedule()
+
+
+class Checks_Worker(webapp.RequestHandler):
+    def post(self):
+        """Worker that runs a batch of HTTP checks concurrently"""
+        checks.run(fanout.get_keys(self.request))
+
+
+class MailchimpFlush(webapp.RequestHandler):
+    def post(self):
+        """Worker that sends the pending newsletter subscriptions to
+        MailChimp (see tools.mailchimp)"""
+        if tools.mailchimp.flush():
+            # More pending operations than fit in one batch
+            taskqueue.add(url='/services/mailchimp/flush',
+                    queue_name=tools.mailchimp.QUEUE)
+
+
+class MigrateUserPrefs(webapp.RequestHandler):
+    """Moves all UserPrefs to identity-based key names in batches (see
+    UserPrefs.migrate_batch). Visit /services/migrate/userprefs once to
+    start the migration."""
+    def get(self):
+        taskqueue.add(url='/services/migrate/userprefs')
+        self.response.out.write("UserPrefs migration started")
+
+    def post(self):
+        cursor = self.request.get("cursor")
+        cursor = UserPrefs.migrate_batch(
+                Cursor(urlsafe=cursor) if cursor else None)
+
+        # Continue with the next batch in a new task
+        if cursor:
+            taskqueue.add(url='/services/migrate/userprefs',
+                    params={"cursor": cursor.urlsafe()})
 
-        # Construct a appengine.api.mail object
-        message = mail.EmailMessage()
-        message.sender = "Your Name <you@domain.x>"
-        message.to = email.to
-        message.subject = email.subject
 
-        # Set text and html body
-        message.body = email.body_text
-        message.html = email.body_html
+class ActivityFlush(webapp.RequestHandler):
+    def get(self):
+        """Cron job that writes the recorded user activity to the UserPrefs
+        (see activity.py)"""
+        activity.flush()
+
+
+class CatalogRegister(webapp.RequestHandler):
+    def post(self):
+        """Worker that adds new series to the catalog of a project (see
+        catalog.register())"""
+        project_key = ndb.Key(Project, int(self.request.get("project")))
+        catalog.add_series(project_key, self.request.get_all("names"))
+
+
+class Stats(BaseRequestHandler):
+    def get(self):
+        """Request stats of the last settings.STATS_WINDOW_SECONDS: the
+        slowest handlers and the handlers with the most datastore calls per
+        request (likely N+1 queries)"""
+        since = datetime.utcnow() - \
+                timedelta(seconds=settings.STATS_WINDOW_SECONDS)
+        samples = StatsSample.query(StatsSample.date_created >= since).fetch()
+        rows = tools.stats.summarize(tools.stats.merge(samples))
+        limit = int(self.request.get("limit") or 20)
+
+        self.render("stats.html", {
+            "samples": len(samples),
+            "slowest": sorted(rows, key=lambda r: -r["wall_ms"])[:limit],
+            "datastore_heavy": sorted(rows,
+                    key=lambda r: -r["datastore_calls"])[:limit],
+        })
+
+
+class Quotas(BaseRequestHandler):
+    def get(self):
+        """Current ingest rate and daily quota consumption of all projects,
+        the most loaded first"""
+        usage = quotas.get_usage(Project.query().fetch())
+        self.render("quotas.html", {
+            "usage": sorted(usage, key=lambda u: -u["percent"]),
+        })
+
+
+class Rollup(webapp.RequestHandler):
+    def get(self):
+        """Cron job that starts the rollup of every project"""
+        rollup.enqueue_projects()
+
+
+class RollupProject(webapp.RequestHandler):
+    def post(self):
+        """Worker that enqueues a rollup task for each series of the project
+        with new samples"""
+        project_key = ndb.Key(Project, int(self.request.get("project")))
+        cursor = self.request.get("cursor")
+        until = self.request.get("until")
+        rollup.enqueue_series(project_key,
+                source=self.request.get("source") or "series",
+                cursor=Cursor(urlsafe=cursor) if cursor else None,
+                until=datetime.utcfromtimestamp(int(until)) if until else None)
+
+
+class RollupSeries(webapp.RequestHandler):
+    def post(self):
+        """Worker that updates the rollups of one series"""
+        project_key = ndb.Key(Project, int(self.request.get("project")))
+        windows = [int(w) for w in self.request.get("windows").split(",")]
+        rollup.update_series(project_key, self.request.get("series"), windows)
+
+
+class RollupHistogram(webapp.RequestHandler):
+    def post(self):
+        """Worker that updates the rollup sketches of one histogram series"""
+        project_key = ndb.Key(Project, int(self.request.get("project")))
+        starts = [int(t) for t in self.request.get("windows").split(",")]
+        rollup.update_histogram(project_key, self.request.get("series"),
+                starts)
+
+
+class Retention(webapp.RequestHandler):
+    def get(self):
+        """Cron job that starts deleting the expired data of every project"""
+        retention.enqueue_projects()
+
+
+class RetentionProject(webapp.RequestHandler):
+    def post(self):
+        """Worker that deletes the expired data of one project"""
+        project_key = ndb.Key(Project, int(self.request.get("project")))
+        cursor = self.request.get("cursor")
+        now = self.request.get("now")
+        retention.purge(project_key,
+                stage=int(self.request.get("stage") or 0),
+                cursor=Cursor(urlsafe=cursor) if cursor else None,
+                now=int(now) if now else None)
+
+
+class Anomaly(webapp.RequestHandler):
+    def get(self):
+        """Cron job that starts the anomaly detection of every project"""
+        # Imported here, so only these requests load numpy
+        import anomaly
+        anomaly.enqueue_projects()
 
-        # Send. Important: Sometimes emails fail to send, which will throw an
-        # exception and end the function there. Next round tries again.
-        message.send()
 
-        # Now the message was sent and we can safely delete it.
-        email.delete()
+class AnomalyProject(webapp.RequestHandler):
+    def post(self):
+        """Worker that scores the last hour of every series of one project"""
+        import anomaly
+        project_key = ndb.Key(Project, int(self.request.get("project")))
+        cursor = self.request.get("cursor")
+        end = self.request.get("end")
+        anomaly.detect(project_key, end=int(end) if end else None,
+                cursor=Cursor(urlsafe=cursor) if cursor else None)
 
 
 urls = [
     (r'/services/cron1', Cron1),
     (r'/services/cron1-worker1', Cron1_Worker1),
+    (r'/services/alerts/absence', AlertAbsence),
+    (r'/services/alerts/absence-worker', AlertAbsence_Worker),
+    (r'/services/checks', Checks),
+    (r'/services/checks/worker', Checks_Worker),
+    (r'/services/mailchimp/flush', MailchimpFlush),
+    (r'/services/migrate/userprefs', MigrateUserPrefs),
+    (r'/services/activity/flush', ActivityFlush),
+    (r'/services/catalog/register', CatalogRegister),
+    (r'/services/stats', Stats),
+    (r'/services/quotas', Quotas),
+    (r'/services/rollup', Rollup),
+    (r'/services/rollup/project', RollupProject),
+    (r'/services/rollup/series', RollupSeries),
+    (r'/services/rollup/histogram', RollupHistogram),
+    (r'/services/retention', Retention),
+    (r'/services/retention/project', RetentionProject),
+    (r'/services/anomaly', Anomaly),
+    (r'/services/anomaly/project', AnomalyProject),
 ]
 
-application = webapp.WSGIApplication(urls, debug=True)
+application = tools.stats.StatsMiddleware(
+        webapp.WSGIApplication(urls, debug=True))
 
 
 def main():
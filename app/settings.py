@@ -12,3 +12,129 @@ MAILCHIMP_LIST_ID = ""
 # Use this switch to turn the MailChimp API calls on and off. Set to True only
 # for testing and production. Set to False during development.
 MAILCHIMP_ENABLED = False
+
+# MailChimp API url, derived from the API key if empty. Set it to point the
+# API calls to a local stand-in server for testing, eg.
+# "http://localhost:9000/?method="
+MAILCHIMP_API_URL = ""
+
+# Metric ingest: maximum number of samples accepted with a single request, and
+# the number of entities written per datastore put RPC.
+INGEST_MAX_SAMPLES = 50000
+INGEST_PUT_BATCH_SIZE = 500
+
+# Maximum size of a decompressed ingest request body
+INGEST_MAX_BODY_BYTES = 32 * 1024 * 1024
+
+# Maximum length of a series name in utf-8 bytes. Names are part of the key
+# names of the chunk, rollup and catalog entities, which may not be longer
+# than 500 bytes.
+SERIES_MAX_BYTES = 200
+
+# Accepted sample timestamps: from the epoch to this many seconds from now
+INGEST_MAX_FUTURE_SECONDS = 86400
+
+# Default ingest limits of a project (see quotas.py): samples per second,
+# averaged over windows of INGEST_RATE_WINDOW seconds, and samples per day.
+# The daily usage is written to the datastore every QUOTA_PERSIST_SAMPLES.
+INGEST_RATE_LIMIT = 5000
+INGEST_RATE_WINDOW = 10
+INGEST_DAILY_QUOTA = 100 * 1000 * 1000
+QUOTA_PERSIST_SAMPLES = 100000
+
+# Raw samples of a series are stored in chunks covering this many seconds
+CHUNK_SECONDS = 3600
+
+# Rollup resolutions (bucket size in seconds), each mapped to the period
+# covered by one RollupChunk. Resolutions up to CHUNK_SECONDS are computed
+# from the raw chunks, larger ones from the next smaller resolution.
+ROLLUP_PERIODS = {
+    60: 86400,              # 1-minute buckets, one chunk per day
+    3600: 30 * 86400,       # 1-hour buckets, one chunk per 30 days
+    86400: 360 * 86400,     # 1-day buckets, one chunk per 360 days
+}
+
+# Chunks written within this many seconds are left for the next rollup run,
+# to allow for eventually consistent queries.
+ROLLUP_SETTLE_SECONDS = 120
+
+# Each rollup run also re-scans the chunks written this many seconds before
+# the watermark, which were not yet visible to the previous run's query
+ROLLUP_OVERLAP_SECONDS = 600
+
+# Range reads pick the smallest resolution with at most this many buckets
+ROLLUP_MAX_POINTS = 1500
+
+# Histogram series: number of shards of the ingest buckets, and the maximum
+# number of sketches merged for a percentile query
+HISTOGRAM_SHARDS = 8
+HISTOGRAM_MAX_SKETCHES = 500
+
+# Alert states are written through to the datastore at least this often
+ALERT_PERSIST_SECONDS = 300
+
+# An export response stops after this many seconds or bytes, and returns a
+# cursor to continue with (see handlers/export.py). The response is buffered
+# in memory until the request ends, so keep the size small.
+EXPORT_MAX_SECONDS = 40
+EXPORT_MAX_BYTES = 4 * 1024 * 1024
+
+# Time the imports of new instances in production (see tools/importprofile.py).
+# Always on on the dev server.
+IMPORT_PROFILE = False
+
+# Request stats (see tools/stats.py): fraction of requests recorded, how often
+# an instance stores its stats, and the time span shown by /services/stats
+STATS_SAMPLE_RATE = 1.0
+STATS_FLUSH_SECONDS = 60
+STATS_WINDOW_SECONDS = 3600
+
+# Long-poll dashboard updates (see handlers/poll.py): maximum time a request
+# waits for changes, how often it checks for them, and how far back a poll
+# returns samples (older watermarks need a full reload of the data)
+POLL_TIMEOUT_SECONDS = 25
+POLL_INTERVAL_SECONDS = 1
+POLL_MAX_BACKFILL_SECONDS = 3600
+
+# HTTP checks (see checks.py): allowed check intervals in seconds, the
+# checks run by one task, how many of them are fetched at the same time, and
+# the granularity in seconds at which the checks are spread over a minute
+CHECK_INTERVALS = (60, 300, 900, 3600)
+CHECKS_PER_TASK = 50
+CHECK_CONCURRENCY = 25
+CHECK_SLOT_SECONDS = 10
+
+# Days the raw samples and the rollups (by resolution) are kept, None keeps
+# them forever. Projects can override it (models.Project.retention). Expired
+# data is deleted by a daily job (see retention.py) in batches of
+# RETENTION_BATCH_SIZE keys, with at most RETENTION_CONCURRENCY batches at a
+# time.
+RETENTION_DAYS = {
+    "raw": 7,
+    60: 30,
+    3600: 365,
+    86400: None,
+}
+RETENTION_BATCH_SIZE = 500
+RETENTION_CONCURRENCY = 4
+
+# User activity (see activity.py): an instance records the activity of a user
+# at most this often. The recorded timestamps are written to the UserPrefs by
+# a cron job every few minutes.
+ACTIVITY_RESOLUTION_SECONDS = 60
+
+# Seconds that browsers and the App Engine edge cache keep public pages (see
+# BaseRequestHandler.render). Logged in visitors may see the anonymous
+# version of a page for up to this long.
+PUBLIC_MAX_AGE = 300
+
+# Batch anomaly detection (see anomaly.py): rollup resolution and days of
+# history that are analysed, EWMA smoothing factor, length of the seasonal
+# cycle in seconds, minimum number of buckets with data for a series to be
+# scored, and the z-score above which a bucket is an anomaly
+ANOMALY_RESOLUTION = 3600
+ANOMALY_DAYS = 14
+ANOMALY_ALPHA = 0.1
+ANOMALY_SEASON = 86400
+ANOMALY_MIN_POINTS = 48
+ANOMALY_THRESHOLD = 4.0
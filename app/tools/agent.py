@@ -0,0 +1,267 @@
+# -*- coding: utf-8 -*-
+"""
+Client library for hosts that report metrics to the ingest API (see
+handlers/ingest.py). It only needs the Python standard library, so this
+file can be copied to the monitored hosts:
+
+    agent = Agent("<project api key>")
+    agent.add("cpu.load", 0.52)
+    agent.add_histogram("api.latency", 0.120)
+    ...
+    agent.close()  # sends what is left, eg. at exit
+
+add() never blocks the application and never does network I/O:
+
+- Samples go into a bounded in-memory ring buffer. If the buffer is full,
+  the oldest samples are dropped (and counted in agent.dropped).
+- A background thread sends the buffer when it holds batch_size samples, or
+  every flush_interval seconds. Each batch is one gzip-compressed request
+  over a persistent HTTP connection, as JSON or (with
+  wire_format="binary") in the compact format of tools.wireformat. Copy
+  wireformat.py next to this file to use it.
+- Failed requests are retried with jittered exponential backoff. Batches
+  that still fail, or that the server rejects (4xx), are dropped.
+"""
+import time
+import gzip
+import socket
+import random
+import httplib
+import logging
+import urlparse
+import threading
+
+from collections import deque
+from cStringIO import StringIO
+
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+try:
+    from tools import wireformat
+except ImportError:
+    # Copied to a monitored host next to this file
+    import wireformat
+
+DEFAULT_URL = "https://thatstat.appspot.com/api/v1/ingest"
+
+log = logging.getLogger("thatstat.agent")
+
+
+class AgentError(Exception):
+    pass
+
+
+class Agent(object):
+    """
+    Buffers samples and sends them to the ingest API in the background.
+
+    - max_samples: size of the ring buffer
+    - batch_size: maximum number of samples per request; a flush starts as
+      soon as the buffer holds this many
+    - flush_interval: seconds after which a smaller batch is sent anyway
+    - wire_format: "json", or "binary" for the cheaper tools.wireformat
+    - retries, backoff, max_backoff: a failed request is retried up to
+      retries times, after a random delay of up to backoff * 2^attempt
+      seconds (at most max_backoff)
+    """
+    def __init__(self, api_key, url=DEFAULT_URL, max_samples=100000,
+            batch_size=5000, flush_interval=10, wire_format="json",
+            retries=5, backoff=1.0, max_backoff=60, timeout=30,
+            compresslevel=6):
+        if not api_key:
+            raise ValueError("Thatstat api key not valid")
+        if wire_format not in ("json", "binary"):
+            raise ValueError("wire_format must be 'json' or 'binary'")
+
+        self.api_key = api_key
+        self.url = urlparse.urlsplit(url)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.wire_format = wire_format
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.timeout = timeout
+        self.compresslevel = compresslevel
+
+        # (kind, series, timestamp, value). deque.append() is thread-safe
+        # and drops the oldest item once maxlen is reached.
+        self._buffer = deque(maxlen=max_samples)
+        self._connection = None
+        self._wake = threading.Event()
+        self._closed = threading.Event()
+        self._flushed = threading.Condition()
+        self._sent_until = 0
+        self._added = 0
+
+        # Counters for monitoring the agent itself
+        self.dropped = 0
+        self.sent = 0
+        self.failed = 0
+
+        self._thread = threading.Thread(target=self._run,
+                name="thatstat-agent")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def add(self, series, value, timestamp=None):
+        """Adds a sample of a series (timestamp in unix seconds, default
+        now)"""
+        self._append("samples", series, value, timestamp)
+
+    def add_histogram(self, series, value, timestamp=None):
+        """Adds a single observation of a histogram series, eg. the latency
+        of one request"""
+        self._append("histograms", series, value, timestamp)
+
+    def flush(self, timeout=None):
+        """Sends all samples added so far and waits until they were sent (or
+        dropped). Returns False if timeout seconds passed before."""
+        deadline = timeout and time.time() + timeout
+        with self._flushed:
+            target = self._added
+            self._wake.set()
+            while self._sent_until < target and self._thread.is_alive():
+                remaining = deadline and deadline - time.time()
+                if deadline and remaining <= 0:
+                    return False
+                self._flushed.wait(remaining or 1.0)
+        return True
+
+    def close(self, timeout=10):
+        """Sends the buffered samples and stops the background thread"""
+        self._closed.set()
+        self._wake.set()
+        self._thread.join(timeout)
+        self._disconnect()
+
+    def _append(self, kind, series, value, timestamp):
+        if len(self._buffer) == self._buffer.maxlen:
+            self.dropped += 1
+        self._buffer.append((kind, series,
+                int(timestamp if timestamp is not None else time.time()),
+                float(value)))
+        self._added += 1
+        if len(self._buffer) >= self.batch_size:
+            self._wake.set()
+
+    def _run(self):
+        while not self._closed.is_set():
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            self._send_buffer()
+
+        # Final flush after close()
+        self._send_buffer()
+
+    def _send_buffer(self):
+        while True:
+            with self._flushed:
+                added = self._added
+            batch = []
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._buffer.popleft())
+                except IndexError:
+                    break
+
+            if batch:
+                self._send_batch(batch)
+
+            if len(batch) < self.batch_size:
+                # Buffer is empty: everything added before is sent
+                with self._flushed:
+                    self._sent_until = added
+                    self._flushed.notify_all()
+                return
+
+    def _send_batch(self, batch):
+        payload = {"samples": [], "histograms": []}
+        for kind, series, timestamp, value in batch:
+            payload[kind].append((series, timestamp, value))
+        try:
+            if self.wire_format == "binary":
+                body = wireformat.encode(payload["samples"],
+                        payload["histograms"])
+            else:
+                body = json.dumps(payload)
+        except ValueError as e:
+            log.warning("Thatstat: dropping %s samples: %s", len(batch), e)
+            self.failed += len(batch)
+            return
+        body = self._compress(body)
+
+        for attempt in xrange(self.retries + 1):
+            try:
+                self._post(body)
+                self.sent += len(batch)
+                return
+            except AgentError as e:
+                # The server rejected the payload, a retry would not help
+                log.warning("Thatstat: dropping %s samples: %s", len(batch),
+                        e)
+                break
+            except (socket.error, httplib.HTTPException, IOError) as e:
+                self._disconnect()
+                if attempt == self.retries:
+                    log.warning("Thatstat: dropping %s samples after %s "
+                            "attempts: %s", len(batch), attempt + 1, e)
+                    break
+
+                delay = getattr(e, "retry_after", None) or random.uniform(0,
+                        min(self.max_backoff, self.backoff * 2 ** attempt))
+                log.info("Thatstat: ingest failed (%s), retrying in %.1fs",
+                        e, delay)
+                # Retry without delay once close() was called
+                self._closed.wait(delay)
+
+        self.failed += len(batch)
+
+    def _compress(self, data):
+        out = StringIO()
+        with gzip.GzipFile(fileobj=out, mode="wb",
+                compresslevel=self.compresslevel) as f:
+            f.write(data)
+        return out.getvalue()
+
+    def _post(self, body):
+        """Sends one request over the persistent connection. Raises
+        AgentError for client errors (4xx, except 429) and
+        httplib.HTTPException for server errors."""
+        if not self._connection:
+            connection_class = httplib.HTTPSConnection \
+                    if self.url.scheme == "https" else httplib.HTTPConnection
+            self._connection = connection_class(self.url.netloc,
+                    timeout=self.timeout)
+
+        path = self.url.path + ("?" + self.url.query if self.url.query else "")
+        self._connection.request("POST", path, body, {
+            "X-Thatstat-Key": self.api_key,
+            "Content-Type": wireformat.CONTENT_TYPE
+                    if self.wire_format == "binary" else "application/json",
+            "Content-Encoding": "gzip",
+        })
+
+        # The response must be read completely to reuse the connection
+        response = self._connection.getresponse()
+        content = response.read()
+        if response.status == 200:
+            return
+
+        message = "HTTP %s: %s" % (response.status, content[:200])
+        if 400 <= response.status < 500 and response.status != 429:
+            raise AgentError(message)
+
+        error = httplib.HTTPException(message)
+        retry_after = response.getheader("Retry-After")
+        if retry_after and retry_after.isdigit():
+            error.retry_after = min(int(retry_after), self.max_backoff)
+        raise error
+
+    def _disconnect(self):
+        if self._connection:
+            self._connection.close()
+            self._connection = None
@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+"""
+Fan-out of background work over all entities of a query.
+
+A scan pages through the query keys-only and adds one worker task per batch
+of keys, with up to 100 tasks per taskqueue RPC. If the scan runs out of
+time it re-enqueues itself with the query cursor, so it covers any number
+of entities:
+
+    class Cron1(webapp.RequestHandler):
+        def get(self):
+            fanout.scan(Emails.query(), '/services/cron1-worker1',
+                    continue_url='/services/cron1',
+                    cursor=self.request.get('cursor'),
+                    scan_id=self.request.get('scan'))
+
+        post = get  # continuation tasks are POST requests
+
+    class Cron1_Worker1(webapp.RequestHandler):
+        def post(self):
+            for email in ndb.get_multi(fanout.get_keys(self.request)):
+                ...
+
+The worker and continuation tasks are named after the scan, the cursor of
+their page and their position in it. A retried continuation task adds
+tasks with the same names, which the taskqueue drops, so no batch is
+processed twice.
+"""
+import time
+import uuid
+import logging
+
+from hashlib import md5
+
+from google.appengine.api import taskqueue
+from google.appengine.datastore.datastore_query import Cursor
+from google.appengine.ext import ndb
+
+# Taskqueue accepts at most 100 tasks per add() call
+TASK_BATCH_SIZE = 100
+
+# Scans continue in a new task after this many seconds
+SCAN_SECONDS = 60
+
+
+def add_tasks(tasks, queue_name="default"):
+    """Adds a list of taskqueue.Task objects with as few RPCs as possible.
+    Named tasks that exist already are skipped."""
+    queue = taskqueue.Queue(queue_name)
+    for i in xrange(0, len(tasks), TASK_BATCH_SIZE):
+        try:
+            queue.add(tasks[i:i + TASK_BATCH_SIZE])
+        except (taskqueue.TaskAlreadyExistsError,
+                taskqueue.TombstonedTaskError):
+            # The other tasks of the batch are added
+            logging.info("Skipped tasks that were added before")
+
+
+def scan(query, worker_url, continue_url, cursor=None, batch_size=100,
+        page_size=1000, queue_name="default", params=None, scan_id=None):
+    """Adds a task to worker_url for each batch of batch_size keys of the
+    query. The keys are passed as the 'keys' parameter (see get_keys()),
+    together with the optional dict of params. If there are more keys after
+    SCAN_SECONDS, a continuation task is added to continue_url with the
+    'cursor' and 'scan' parameters, which the continuation passes back as
+    cursor and scan_id. Returns the number of keys scanned."""
+    started = time.time()
+    if cursor and not isinstance(cursor, Cursor):
+        cursor = Cursor(urlsafe=cursor)
+    scan_id = scan_id or uuid.uuid4().hex
+
+    count = 0
+    more = True
+    while more:
+        page = _task_name(scan_id, cursor)
+        keys, cursor, more = query.fetch_page(page_size, keys_only=True,
+                start_cursor=cursor)
+        count += len(keys)
+
+        tasks = []
+        for i in xrange(0, len(keys), batch_size):
+            task_params = dict(params or {})
+            task_params["keys"] = ",".join(key.urlsafe()
+                    for key in keys[i:i + batch_size])
+            tasks.append(taskqueue.Task(url=worker_url, params=task_params,
+                    name="%s-%d" % (page, i // batch_size)))
+        add_tasks(tasks, queue_name)
+
+        if more and time.time() - started > SCAN_SECONDS:
+            continue_params = dict(params or {})
+            continue_params["cursor"] = cursor.urlsafe()
+            continue_params["scan"] = scan_id
+            add_tasks([taskqueue.Task(url=continue_url,
+                    params=continue_params,
+                    name="%s-next" % _task_name(scan_id, cursor))],
+                    queue_name)
+            break
+
+    logging.info("Fan-out to %s: %s keys", worker_url, count)
+    return count
+
+
+def _task_name(scan_id, cursor):
+    """Returns the task name prefix of a page of a scan"""
+    return "scan-%s-%s" % (scan_id,
+            md5(cursor.urlsafe() if cursor else "").hexdigest())
+
+
+def get_keys(request):
+    """Returns the list of ndb keys passed to a worker by scan()"""
+    keys = request.get("keys")
+    return [ndb.Key(urlsafe=key) for key in keys.split(",")] if keys else []
@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+"""
+Measures how long the imports of an instance take, to find the modules that
+make cold starts slow. Install it before any other import:
+
+    import tools.importprofile
+    if tools.importprofile.enabled():
+        tools.importprofile.install()
+
+It is enabled on the dev server, and in production with
+settings.IMPORT_PROFILE. report() returns the modules sorted by their own
+import time (excluding the modules they import themselves). The warmup
+handler logs it and uninstalls the hook, so the instance serves its
+requests with the original __import__.
+"""
+import sys
+import time
+import threading
+import __builtin__
+
+import settings
+import tools.common
+
+# Own import time in seconds, by module name
+timings = {}
+
+# Time spent in nested imports, one entry per import in progress. Per
+# thread, as concurrent requests import in parallel.
+_local = threading.local()
+
+_original_import = __builtin__.__import__
+
+
+def _timed_import(name, globals=None, locals=None, fromlist=None, level=-1):
+    if name in sys.modules:
+        return _original_import(name, globals, locals, fromlist, level)
+
+    nested = getattr(_local, "nested", None)
+    if nested is None:
+        nested = _local.nested = []
+
+    started = time.time()
+    nested.append(0.0)
+    try:
+        return _original_import(name, globals, locals, fromlist, level)
+    finally:
+        elapsed = time.time() - started
+        own = elapsed - nested.pop()
+        timings[name] = timings.get(name, 0.0) + own
+        if nested:
+            nested[-1] += elapsed
+
+
+def enabled():
+    """True on the dev server, or if settings.IMPORT_PROFILE is set"""
+    return settings.IMPORT_PROFILE or tools.common.is_testenv()
+
+
+def install():
+    """Starts timing imports"""
+    __builtin__.__import__ = _timed_import
+
+
+def uninstall():
+    """Stops timing imports"""
+    __builtin__.__import__ = _original_import
+
+
+def report(limit=30):
+    """Returns a text report of the slowest imports"""
+    total = sum(timings.itervalues())
+    lines = ["Imports: %s modules, %.0f ms" % (len(timings), total * 1000)]
+    for name, seconds in sorted(timings.iteritems(), key=lambda i: -i[1])[
+            :limit]:
+        lines.append("%8.1f ms  %s" % (seconds * 1000, name))
+    return "\n".join(lines)
@@ -1,40 +1,159 @@
+import time
+import random
 import logging
 import urllib2
 import settings
 
+from google.appengine.api import taskqueue
+from google.appengine.ext import ndb
+
+import models
+
 try:
     import simplejson as json
 except ImportError:
     import json
 
+"""
+Newsletter subscriptions are not sent to MailChimp from the request that
+changes them. queue_subscription() stores a pending operation per email and
+schedules a flush task, which sends all pending operations with one batch
+subscribe and one batch unsubscribe API call:
+
+    tools.mailchimp.queue_subscription("user@example.com", subscribe=True)
+"""
+
+QUEUE = "mailchimp"
+
+# Pending operations are flushed this many seconds after they are queued,
+# so that changes within this time are sent together
+FLUSH_DELAY = 60
+
+# Maximum number of operations sent with one flush
+FLUSH_BATCH_SIZE = 1000
+
+# MailSnake instance of this process (see get_mailsnake())
+_mailsnake = None
 
-def mailchimp_subscribe(email, list_id=None, double_optin=True):
-    """
-    Subscribes this email to your mailchimp newsletter. If list_id is not
-    set it will default to settings.MAILCHIMP_LIST_ID.
-    """
-    ms = MailSnake(settings.MAILCHIMP_API_KEY)
-    list_id = list_id or settings.MAILCHIMP_LIST_ID
-    res = ms.listSubscribe(id=list_id, email_address=email, \
-            double_optin=double_optin)
-    logging.info("MailChimp: Subscribed user %s to list %s. Result: %s", email,
-            list_id, res)
 
+class MailChimpError(Exception):
+    pass
 
-def mailchimp_unsubscribe(email, list_id=None, delete_member=False,
-        send_goodbye=True, send_notify=True):
+
+def get_mailsnake():
+    """Returns the MailSnake for settings.MAILCHIMP_API_KEY, which is created
+    once per process."""
+    global _mailsnake
+    if not _mailsnake:
+        _mailsnake = MailSnake(settings.MAILCHIMP_API_KEY,
+                api_url=settings.MAILCHIMP_API_URL)
+    return _mailsnake
+
+
+def queue_subscription(email, subscribe=True):
+    """
+    Queues subscribing (or unsubscribing) this email to your mailchimp
+    newsletter. A queued operation that is reverted before flush() started
+    sending it (eg. subscribe followed by unsubscribe) cancels out. Returns
+    False if the email is not valid.
+    """
+    email = (email or "").strip()
+    if "@" not in email:
+        logging.warning("MailChimp: Not queueing invalid email %r", email)
+        return False
+
+    @ndb.transactional
+    def txn():
+        key = ndb.Key(models.MailchimpOperation, email)
+        pending = key.get()
+        if pending and not pending.sending and \
+                pending.subscribe is not subscribe:
+            key.delete()
+            return False
+        # Replaces an operation that is being sent, so flush() keeps it
+        models.MailchimpOperation(key=key, subscribe=subscribe).put()
+        return True
+
+    if txn():
+        schedule_flush()
+    logging.info("MailChimp: Queued %s of %s",
+            "subscription" if subscribe else "unsubscription", email)
+    return True
+
+
+def schedule_flush(delay=FLUSH_DELAY):
+    """Adds a flush task, unless there is one for this time slot already"""
+    slot = int(time.time() / delay)
+    try:
+        taskqueue.add(url="/services/mailchimp/flush", queue_name=QUEUE,
+                name="mailchimp-flush-%s" % slot, countdown=delay)
+    except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+        pass
+
+
+def flush(list_id=None, double_optin=True):
     """
-    Unsubscribes this email from your mailchimp newsletter. If list_id is not
-    set it will default to settings.MAILCHIMP_LIST_ID.
+    Sends pending operations to MailChimp with one batch subscribe and one
+    batch unsubscribe call. Raises MailChimpError if the API call failed,
+    so that the task is retried with backoff. Returns True if there are more
+    pending operations.
     """
-    ms = MailSnake(settings.MAILCHIMP_API_KEY)
+    fetched = models.MailchimpOperation.query().fetch(FLUSH_BATCH_SIZE)
+    if not fetched:
+        return False
+
+    # Mark the operations as sending, so that they cannot be cancelled out
+    # anymore (see queue_subscription()). Operations that were cancelled or
+    # changed since the query are left for the next flush.
+    futures = [_mark_sending(op) for op in fetched]
+    ops = [future.get_result() for future in futures]
+    ops = [op for op in ops if op]
+
+    ms = get_mailsnake()
     list_id = list_id or settings.MAILCHIMP_LIST_ID
-    res = ms.listUnsubscribe(id=list_id, email_address=email,
-            delete_member=delete_member, send_goodbye=send_goodbye,
-            send_notify=send_notify)
-
-    logging.info("MailChimp: Unsubscribed user %s from list %s. Result: %s",
-            email, list_id, res)
+    subscribe = [op.key.id() for op in ops if op.subscribe]
+    unsubscribe = [op.key.id() for op in ops if not op.subscribe]
+
+    if subscribe:
+        res = ms.listBatchSubscribe(id=list_id, double_optin=double_optin,
+                update_existing=True, batch=[{"EMAIL": email,
+                "EMAIL_TYPE": "html"} for email in subscribe])
+        _check_batch_result("listBatchSubscribe", res)
+
+    if unsubscribe:
+        res = ms.listBatchUnsubscribe(id=list_id, emails=unsubscribe,
+                delete_member=False, send_goodbye=True, send_notify=True)
+        _check_batch_result("listBatchUnsubscribe", res)
+
+    # Remove the sent operations, unless they were changed in the meantime
+    ndb.Future.wait_all([_delete_sent(op) for op in ops])
+
+    logging.info("MailChimp: Subscribed %s, unsubscribed %s emails",
+            len(subscribe), len(unsubscribe))
+    return len(fetched) == FLUSH_BATCH_SIZE
+
+
+@ndb.transactional_tasklet
+def _mark_sending(op):
+    """Sets op.sending, unless the operation was deleted or changed since
+    it was fetched. Returns the updated operation, or None."""
+    current = yield op.key.get_async()
+    if not current or current.updated != op.updated:
+        raise ndb.Return(None)
+    if not current.sending:
+        current.sending = True
+        yield current.put_async()
+    raise ndb.Return(current)
+
+
+def _check_batch_result(method, res):
+    """Raises MailChimpError if the call failed. Errors for single emails
+    (eg. invalid addresses) are logged only, as retrying would not help."""
+    if "error" in res:
+        raise MailChimpError("%s failed: %s (%s)" % (method, res["error"],
+                res.get("code")))
+    for error in res.get("errors", []):
+        logging.warning("MailChimp: %s: %s", method, error)
 
 
 class MailSnake(object):
@@ -42,12 +161,18 @@ class MailSnake(object):
     MailSnake is a simple MailChimp API Wrapper.
     - URL: https://github.com/leftium/mailsnake
     - Author: John-Kim Murphy (https://github.com/leftium)
+
+    Added for Thatstat: api_url to use a local stand-in server for testing,
+    and retries with exponential backoff for failed requests.
     """
-    def __init__(self, apikey='', extra_params={}):
+    def __init__(self, apikey='', extra_params={}, api_url=None, retries=3,
+            backoff=0.5):
         if not apikey:
             raise ValueError("MailChimp API Key not valid. Set in settings.py")
 
         self.apikey = apikey
+        self.retries = retries
+        self.backoff = backoff
 
         self.default_params = {'apikey': apikey}
         self.default_params.update(extra_params)
@@ -55,7 +180,8 @@ class MailSnake(object):
         dc = 'us1'  # Overwritten if part of the API key
         if '-' in self.apikey:
             dc = self.apikey.split('-')[1]
-        self.base_api_url = 'https://%s.api.mailchimp.com/1.3/?method=' % dc
+        self.base_api_url = api_url or \
+                'https://%s.api.mailchimp.com/1.3/?method=' % dc
 
     def call(self, method, params={}):
         url = self.base_api_url + method
@@ -64,9 +190,23 @@ class MailSnake(object):
         post_data = json.dumps(params)
         headers = {'Content-Type': 'application/json'}
         request = urllib2.Request(url, post_data, headers)
-        response = urllib2.urlopen(request)
 
-        return json.loads(response.read())
+        for attempt in xrange(self.retries + 1):
+            try:
+                response = urllib2.urlopen(request)
+                return json.loads(response.read())
+            except urllib2.HTTPError as e:
+                # Client errors are not going to change with a retry
+                if e.code < 500 or attempt == self.retries:
+                    raise
+            except urllib2.URLError:
+                if attempt == self.retries:
+                    raise
+
+            delay = self.backoff * 2 ** attempt
+            logging.info("MailChimp: %s failed, retrying in %.1fs", method,
+                    delay)
+            time.sleep(delay * random.uniform(0.5, 1.5))
 
     def __getattr__(self, method_name):
         def get(self, *args, **kwargs):
@@ -75,3 +215,11 @@ class MailSnake(object):
             return self.call(method_name, params)
 
         return get.__get__(self)
+
+
+@ndb.transactional_tasklet
+def _delete_sent(op):
+    """Deletes a sent operation, unless it was replaced since"""
+    current = yield op.key.get_async()
+    if current and current.updated == op.updated:
+        yield op.key.delete_async()
@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+"""
+Mergeable quantile sketch for latency-style metrics.
+
+Values are counted in logarithmic buckets: bucket i holds the values in
+(gamma^(i-1), gamma^i] with gamma = (1 + accuracy) / (1 - accuracy), so any
+quantile is returned with a relative error of at most `accuracy`. Merging
+two sketches adds their bucket counts, which makes a sketch of a day the
+exact merge of the sketches of its hours:
+
+    sketch = Sketch()
+    for latency in latencies:
+        sketch.add(latency)
+    sketch.quantile(0.99)
+
+    data = sketch.serialize()
+    total = Sketch.deserialize(data)
+    total.merge(other_sketch)
+
+Values <= 0 are counted in a separate zero bucket. Serialized sketches of
+typical latency distributions take a few hundred bytes.
+"""
+import math
+import struct
+
+from array import array
+
+from tools.tscodec import write_varint, read_varint, zigzag, unzigzag
+
+VERSION = 1
+
+# Relative accuracy of the quantiles of new sketches
+DEFAULT_ACCURACY = 0.01
+
+# version (B), accuracy, sum, min, max (d)
+_header = struct.Struct('<Bdddd')
+
+
+class Sketch(object):
+    def __init__(self, accuracy=DEFAULT_ACCURACY):
+        self.accuracy = accuracy
+        self.gamma = (1 + accuracy) / (1 - accuracy)
+        self._log_gamma = math.log(self.gamma)
+        self.buckets = {}
+        self.zero_count = 0
+        self.count = 0
+        self.sum = 0.0
+        self.min = float('inf')
+        self.max = float('-inf')
+
+    def add(self, value, count=1):
+        if value > 0:
+            i = int(math.ceil(math.log(value) / self._log_gamma))
+            self.buckets[i] = self.buckets.get(i, 0) + count
+        else:
+            self.zero_count += count
+        self.count += count
+        self.sum += value * count
+        if value < self.min:
+            self.min = value
+        if value > self.max:
+            self.max = value
+
+    def merge(self, other):
+        """Adds the counts of another sketch with the same accuracy"""
+        if other.accuracy != self.accuracy:
+            raise ValueError("cannot merge sketches with accuracy %s and %s" %
+                    (self.accuracy, other.accuracy))
+        for i, count in other.buckets.iteritems():
+            self.buckets[i] = self.buckets.get(i, 0) + count
+        self.zero_count += other.zero_count
+        self.count += other.count
+        self.sum += other.sum
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+
+    def quantile(self, q):
+        """Returns the estimated value at quantile q (0 <= q <= 1), or None
+        if the sketch is empty"""
+        if not self.count:
+            return None
+
+        rank = q * (self.count - 1)
+        seen = self.zero_count
+        if rank < seen:
+            # In the zero bucket
+            return 0.0
+        for i in sorted(self.buckets):
+            seen += self.buckets[i]
+            if rank < seen:
+                # Midpoint of the bucket, in relative terms
+                value = 2 * self.gamma ** i / (self.gamma + 1)
+                return min(max(value, self.min), self.max)
+        return self.max
+
+    def mean(self):
+        return self.sum / self.count if self.count else None
+
+    def serialize(self):
+        """Returns the sketch as a compact string. Bucket indexes are
+        delta encoded, and indexes and counts written as varints."""
+        out = array('B', _header.pack(VERSION, self.accuracy, self.sum,
+                self.min, self.max))
+        write_varint(out, self.count)
+        write_varint(out, self.zero_count)
+        write_varint(out, len(self.buckets))
+        prev = 0
+        for i in sorted(self.buckets):
+            write_varint(out, zigzag(i - prev))
+            write_varint(out, self.buckets[i])
+            prev = i
+        return out.tostring()
+
+    @classmethod
+    def deserialize(cls, data):
+        version, accuracy, total, min_value, max_value = \
+                _header.unpack_from(data)
+        if version != VERSION:
+            raise ValueError("unknown sketch version %s" % version)
+
+        sketch = cls(accuracy)
+        sketch.sum, sketch.min, sketch.max = total, min_value, max_value
+        buf = array('B', data)
+        pos = _header.size
+        sketch.count, pos = read_varint(buf, pos)
+        sketch.zero_count, pos = read_varint(buf, pos)
+        n, pos = read_varint(buf, pos)
+        i = 0
+        for _ in xrange(n):
+            delta, pos = read_varint(buf, pos)
+            count, pos = read_varint(buf, pos)
+            i += unzigzag(delta)
+            sketch.buckets[i] = count
+        return sketch
@@ -0,0 +1,244 @@
+# -*- coding: utf-8 -*-
+"""
+Per-request instrumentation for the WSGI applications.
+
+StatsMiddleware wraps a WSGI application and records for every (sampled)
+request:
+
+- the number and time of API calls, by service and method (eg.
+  datastore_v3.Get), collected with apiproxy hooks
+- memcache hits and misses, plus hits of the in-process tier of mc.tiered
+- template render time (see BaseRequestHandler.render)
+- total wall time
+
+The numbers are aggregated per handler in-process and flushed as one
+StatsSample entity per instance every settings.STATS_FLUSH_SECONDS. The
+admin page /services/stats merges the recent samples (see aggregate()).
+
+Other code adds numbers to the current request with:
+
+    tools.stats.count("cache.local_hits")
+    with tools.stats.timer("template"):
+        ...
+"""
+import time
+import random
+import logging
+import threading
+
+from contextlib import contextmanager
+from google.appengine.api import apiproxy_stub_map
+
+import settings
+
+# Per-thread stats of the current request: {"calls": {}, "counts": {},
+# "times": {}}, or None if the request is not recorded
+_local = threading.local()
+
+# Aggregates of this instance since the last flush, by handler name
+_aggregates = {}
+_lock = threading.Lock()
+_last_flush = [time.time()]
+
+_hooks_installed = [False]
+
+
+def current():
+    return getattr(_local, "stats", None)
+
+
+def count(name, n=1):
+    """Adds n to a counter of the current request"""
+    stats = current()
+    if stats is not None:
+        stats["counts"][name] = stats["counts"].get(name, 0) + n
+
+
+@contextmanager
+def timer(name):
+    """Adds the time spent in the with block to a timer of the current
+    request"""
+    started = time.time()
+    try:
+        yield
+    finally:
+        stats = current()
+        if stats is not None:
+            stats["times"][name] = stats["times"].get(name, 0.0) + \
+                    time.time() - started
+
+
+@contextmanager
+def recording():
+    """Records the stats of everything the current thread does in the with
+    block, and yields the stats dict (used by the benchmarks in bench/)"""
+    install_hooks()
+    stats = {"calls": {}, "counts": {}, "times": {}, "pending": {}}
+    _local.stats = stats
+    try:
+        yield stats
+    finally:
+        _local.stats = None
+
+
+def _pre_call_hook(service, call, request, response, rpc=None):
+    stats = current()
+    if stats is not None:
+        stats["pending"][id(request)] = time.time()
+
+
+def _post_call_hook(service, call, request, response, rpc=None, error=None):
+    stats = current()
+    if stats is None:
+        return
+
+    name = "%s.%s" % (service, call)
+    started = stats["pending"].pop(id(request), None)
+    calls = stats["calls"].setdefault(name, [0, 0.0])
+    calls[0] += 1
+    if started:
+        calls[1] += time.time() - started
+
+    if name == "memcache.Get" and error is None:
+        hits = response.item_size()
+        count("memcache.hits", hits)
+        count("memcache.misses", request.key_size() - hits)
+
+
+def install_hooks():
+    """Registers the apiproxy hooks, once per process"""
+    if _hooks_installed[0]:
+        return
+    apiproxy_stub_map.apiproxy.GetPreCallHooks().Append("thatstat_stats",
+            _pre_call_hook)
+    apiproxy_stub_map.apiproxy.GetPostCallHooks().Append("thatstat_stats",
+            _post_call_hook)
+    _hooks_installed[0] = True
+
+
+class StatsMiddleware(object):
+    """WSGI middleware that records the stats of the requests of app"""
+    def __init__(self, app):
+        self.app = app
+        install_hooks()
+
+    def __call__(self, environ, start_response):
+        if random.random() >= settings.STATS_SAMPLE_RATE:
+            return self.app(environ, start_response)
+
+        _local.stats = {"calls": {}, "counts": {}, "times": {},
+                "pending": {}}
+        started = time.time()
+        try:
+            return self.app(environ, start_response)
+        finally:
+            stats = _local.stats
+            _local.stats = None
+            stats["times"]["wall"] = time.time() - started
+            self._record(self._handler_name(environ), stats)
+
+    def _handler_name(self, environ):
+        """Returns the name of the handler for the request, or its path if
+        the router cannot tell"""
+        try:
+            import webapp2
+            route = self.app.router.match(webapp2.Request(environ))[0]
+            handler = route.handler
+            if not isinstance(handler, basestring):
+                handler = "%s.%s" % (handler.__module__, handler.__name__)
+            return handler
+        except Exception:
+            return environ.get("PATH_INFO", "")
+
+    def _record(self, handler, stats):
+        datastore_calls = sum(n for name, (n, t) in
+                stats["calls"].iteritems() if name.startswith("datastore"))
+
+        with _lock:
+            agg = _aggregates.setdefault(handler, new_aggregate())
+            agg["requests"] += 1
+            agg["max_wall"] = max(agg["max_wall"], stats["times"]["wall"])
+            agg["max_datastore_calls"] = max(agg["max_datastore_calls"],
+                    datastore_calls)
+            for name, (n, t) in stats["calls"].iteritems():
+                calls = agg["calls"].setdefault(name, [0, 0.0])
+                calls[0] += n
+                calls[1] += t
+            for name, n in stats["counts"].iteritems():
+                agg["counts"][name] = agg["counts"].get(name, 0) + n
+            for name, t in stats["times"].iteritems():
+                agg["times"][name] = agg["times"].get(name, 0.0) + t
+
+            due = time.time() - _last_flush[0] > settings.STATS_FLUSH_SECONDS
+            if due:
+                _last_flush[0] = time.time()
+                aggregates = dict(_aggregates)
+                _aggregates.clear()
+
+        if due:
+            flush(aggregates)
+
+
+def new_aggregate():
+    return {"requests": 0, "max_wall": 0.0, "max_datastore_calls": 0,
+            "calls": {}, "counts": {}, "times": {}}
+
+
+def flush(aggregates):
+    """Stores the aggregates of this instance as one StatsSample"""
+    from models import StatsSample
+    try:
+        StatsSample(handlers=aggregates).put()
+    except Exception:
+        logging.exception("Could not store request stats")
+
+
+def merge(samples):
+    """Merges the aggregates of StatsSamples into one dict by handler"""
+    merged = {}
+    for sample in samples:
+        for handler, agg in sample.handlers.iteritems():
+            total = merged.setdefault(handler, new_aggregate())
+            total["requests"] += agg["requests"]
+            total["max_wall"] = max(total["max_wall"], agg["max_wall"])
+            total["max_datastore_calls"] = max(total["max_datastore_calls"],
+                    agg["max_datastore_calls"])
+            for name, (n, t) in agg["calls"].iteritems():
+                calls = total["calls"].setdefault(name, [0, 0.0])
+                calls[0] += n
+                calls[1] += t
+            for key in ("counts", "times"):
+                for name, value in agg[key].iteritems():
+                    total[key][name] = total[key].get(name, 0) + value
+    return merged
+
+
+def summarize(merged):
+    """Returns a list of per-handler summary dicts (averages per request),
+    for the stats page"""
+    rows = []
+    for handler, agg in merged.iteritems():
+        requests = float(agg["requests"]) or 1.0
+        datastore = [(n, name) for name, (n, t) in agg["calls"].iteritems()
+                if name.startswith("datastore")]
+        hits = agg["counts"].get("memcache.hits", 0)
+        misses = agg["counts"].get("memcache.misses", 0)
+        rows.append({
+            "handler": handler,
+            "requests": agg["requests"],
+            "wall_ms": agg["times"].get("wall", 0) / requests * 1000,
+            "max_wall_ms": agg["max_wall"] * 1000,
+            "template_ms": agg["times"].get("template", 0) / requests * 1000,
+            "rpc_calls": sum(n for n, t in agg["calls"].itervalues()) /
+                    requests,
+            "rpc_ms": sum(t for n, t in agg["calls"].itervalues()) /
+                    requests * 1000,
+            "datastore_calls": sum(n for n, name in datastore) / requests,
+            "max_datastore_calls": agg["max_datastore_calls"],
+            "top_datastore_call": max(datastore)[1] if datastore else "",
+            "memcache_hit_rate": hits * 100.0 / (hits + misses)
+                    if hits + misses else None,
+            "local_hits": agg["counts"].get("cache.local_hits", 0) /
+                    requests,
+        })
+    return rows
@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+"""
+Compact encoding for time-series chunks.
+
+A chunk holds the (timestamp, value) points of one series, sorted by
+timestamp, and is packed column by column into a single string:
+
+    version (1 byte) | count (varint) | timestamps | values
+
+- Timestamps (integer unix seconds) are delta-of-delta encoded: the first
+  timestamp as a varint, the first delta and all following delta-of-deltas
+  as zigzag varints. Regular sampling intervals encode to one byte per point.
+- Values (floats) are XORed with the previous value. The XOR is written as
+  one control byte (number of leading and trailing zero bytes) followed by
+  the remaining middle bytes. An unchanged value takes one byte.
+
+Decoding walks an array.array of bytes and returns array.array columns, so
+large chunks are decoded without creating a Python string per byte:
+
+    data = encode(points)
+    timestamps, values = decode(data)
+"""
+import struct
+
+from array import array
+
+VERSION = 1
+
+# Control byte of an unchanged value (8 leading zero bytes)
+_SAME_VALUE = 0x80
+
+_pack_double = struct.Struct('<d').pack
+_unpack_double = struct.Struct('<d').unpack
+_pack_u64 = struct.Struct('<Q').pack
+_unpack_u64 = struct.Struct('<Q').unpack
+
+
+def encode(points):
+    """Returns the encoded string for a sorted list of (timestamp, value)
+    tuples."""
+    out = array('B', [VERSION])
+    write_varint(out, len(points))
+
+    # Timestamps: first value, first delta, then delta-of-deltas
+    prev_ts = prev_delta = 0
+    for i, (timestamp, value) in enumerate(points):
+        if i == 0:
+            write_varint(out, timestamp)
+        else:
+            delta = timestamp - prev_ts
+            write_varint(out, zigzag(delta - prev_delta))
+            prev_delta = delta
+        prev_ts = timestamp
+
+    # Values: XOR with the previous value, without zero bytes at either end
+    prev_bits = 0
+    for timestamp, value in points:
+        bits = _unpack_u64(_pack_double(value))[0]
+        xor = bits ^ prev_bits
+        prev_bits = bits
+
+        if xor == 0:
+            out.append(_SAME_VALUE)
+            continue
+
+        raw = array('B', _pack_u64(xor))
+        trailing = 0
+        while raw[trailing] == 0:
+            trailing += 1
+        leading = 0
+        while raw[7 - leading] == 0:
+            leading += 1
+        out.append(leading << 4 | trailing)
+        out.extend(raw[trailing:8 - leading])
+
+    return out.tostring()
+
+
+def decode(data):
+    """Returns the (timestamps, values) columns of an encoded chunk as an
+    array('l') and an array('d')."""
+    buf = array('B', data)
+    if buf[0] != VERSION:
+        raise ValueError("unknown chunk encoding version %s" % buf[0])
+
+    count, pos = read_varint(buf, 1)
+
+    timestamps = array('l')
+    prev_ts = prev_delta = 0
+    for i in xrange(count):
+        n, pos = read_varint(buf, pos)
+        if i == 0:
+            prev_ts = n
+        else:
+            prev_delta += unzigzag(n)
+            prev_ts += prev_delta
+        timestamps.append(prev_ts)
+
+    values = array('d')
+    prev_bits = 0
+    for i in xrange(count):
+        control = buf[pos]
+        pos += 1
+        if control != _SAME_VALUE:
+            leading, trailing = control >> 4, control & 0x0f
+            end = pos + 8 - leading - trailing
+            raw = array('B', [0] * trailing)
+            raw.extend(buf[pos:end])
+            raw.extend([0] * leading)
+            pos = end
+            prev_bits ^= _unpack_u64(raw.tostring())[0]
+        values.append(_unpack_double(_pack_u64(prev_bits))[0])
+
+    return timestamps, values
+
+
+def merge(points, new_points):
+    """Merges two lists of (timestamp, value) tuples into one sorted list.
+    For duplicate timestamps the value from new_points wins, which makes
+    re-sending a batch idempotent."""
+    merged = dict(points)
+    merged.update(new_points)
+    return sorted(merged.iteritems())
+
+
+def zigzag(n):
+    """Maps signed to unsigned integers: 0, -1, 1, -2, ... -> 0, 1, 2, 3"""
+    return (n << 1) ^ (n >> 63)
+
+
+def unzigzag(n):
+    return (n >> 1) ^ -(n & 1)
+
+
+def write_varint(out, n):
+    """Appends the unsigned integer n to the array('B') out, 7 bits per
+    byte"""
+    while n > 0x7f:
+        out.append((n & 0x7f) | 0x80)
+        n >>= 7
+    out.append(n)
+
+
+def read_varint(buf, pos):
+    """Returns the varint at pos of the array('B') buf and the position
+    after it"""
+    result = shift = 0
+    while True:
+        b = buf[pos]
+        pos += 1
+        result |= (b & 0x7f) << shift
+        if not b & 0x80:
+            return result, pos
+        shift += 7
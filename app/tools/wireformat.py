@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+"""
+Binary batch format of the ingest API (Content-Type
+application/x-thatstat-batch), which is much cheaper to parse than JSON.
+All numbers are little-endian:
+
+    header      magic "TSTB" | version (1 byte) | padding (1 byte) |
+                number of series (uint16) | base timestamp (int64)
+    series      per series: flags (1 byte) | name length (uint16) |
+                utf-8 name
+    records     per sample: series index (uint16) |
+                timestamp - base timestamp (int32) | value (float64)
+
+Flag 1 marks a histogram series (see metrics.write_histograms). The records
+fill the rest of the payload and have a fixed size, so decode() unpacks
+them in large blocks with struct.unpack_from() on a memoryview of the body,
+without copying the payload or creating a string per record (every sample
+of a series references the same name object). It returns Records, which
+create the (series, timestamp, value) tuples only while iterating:
+
+    data = encode(samples, histograms)
+    samples, histograms = decode(data)
+    for series, timestamp, value in samples:
+        ...
+
+This module only needs the standard library, so tools.agent can use it on
+the monitored hosts as well.
+"""
+import struct
+import operator
+
+from itertools import compress, imap, izip
+
+MAGIC = "TSTB"
+VERSION = 1
+CONTENT_TYPE = "application/x-thatstat-batch"
+
+FLAG_HISTOGRAM = 1
+
+# Records per struct.unpack_from() call, to bound the size of the format
+_RECORDS_PER_UNPACK = 4096
+
+_header = struct.Struct("<4sBxHq")
+_series = struct.Struct("<BH")
+_record = struct.Struct("<Hid")
+
+
+def encode(samples, histograms=()):
+    """Returns the binary batch for lists of (series, timestamp, value)
+    tuples of normal and histogram series. Raises ValueError if they do not
+    fit the format."""
+    index = {}
+    names = []
+    records = []
+    for flags, items in ((0, samples), (FLAG_HISTOGRAM, histograms)):
+        for series, timestamp, value in items:
+            key = (flags, series)
+            if key not in index:
+                index[key] = len(names)
+                names.append(key)
+            records.append((index[key], int(timestamp), float(value)))
+
+    if len(names) > 0xffff:
+        raise ValueError("too many series in one batch (max 65535)")
+    base = min(r[1] for r in records) if records else 0
+
+    out = [_header.pack(MAGIC, VERSION, len(names), base)]
+    for flags, series in names:
+        name = series.encode("utf-8") if isinstance(series, unicode) \
+                else series
+        out.append(_series.pack(flags, len(name)))
+        out.append(name)
+
+    for i in xrange(0, len(records), _RECORDS_PER_UNPACK):
+        chunk = records[i:i + _RECORDS_PER_UNPACK]
+        flat = []
+        for series_id, timestamp, value in chunk:
+            flat.extend((series_id, timestamp - base, value))
+        try:
+            out.append(struct.pack("<" + "Hid" * len(chunk), *flat))
+        except struct.error:
+            raise ValueError("timestamps of a batch must be within 68 years")
+    return "".join(out)
+
+
+class Records(object):
+    """Sequence of the (series, timestamp, value) tuples of a decoded batch.
+    The records are kept in columns, and the tuples are only created (in C,
+    by izip) while iterating, so decoding does no per-record work."""
+    def __init__(self, names, ids, deltas, values, base):
+        self.names = names
+        self.ids = ids
+        self.deltas = deltas
+        self.values = values
+        self.base = base
+
+    def __len__(self):
+        return len(self.ids)
+
+    def time_range(self):
+        """Returns the (first, last) timestamp of the records"""
+        if not self.deltas:
+            return None, None
+        return self.base + min(self.deltas), self.base + max(self.deltas)
+
+    def __iter__(self):
+        return izip(imap(self.names.__getitem__, self.ids),
+                imap(self.base.__add__, self.deltas), self.values)
+
+
+def decode(data):
+    """Returns the Records of the normal and histogram series of a binary
+    batch. Raises ValueError if the batch is malformed."""
+    view = memoryview(data)
+    try:
+        magic, version, count, base = _header.unpack_from(view, 0)
+    except struct.error:
+        raise ValueError("invalid batch header")
+    if magic != MAGIC:
+        raise ValueError("invalid batch header")
+    if version != VERSION:
+        raise ValueError("unsupported batch version %s" % version)
+
+    # Series dictionary: decoded once, shared by all records
+    offset = _header.size
+    names = []
+    histogram = []
+    try:
+        for i in xrange(count):
+            flags, length = _series.unpack_from(view, offset)
+            offset += _series.size
+            if offset + length > len(view):
+                raise ValueError("truncated series name")
+            names.append(view[offset:offset + length].tobytes()
+                    .decode("utf-8"))
+            histogram.append(bool(flags & FLAG_HISTOGRAM))
+            offset += length
+    except (struct.error, UnicodeDecodeError):
+        raise ValueError("invalid series dictionary")
+
+    remaining = len(view) - offset
+    if remaining % _record.size:
+        raise ValueError("truncated record")
+
+    # Unpack the records straight from the buffer into columns
+    ids = []
+    deltas = []
+    values = []
+    records = remaining // _record.size
+    for i in xrange(0, records, _RECORDS_PER_UNPACK):
+        n = min(_RECORDS_PER_UNPACK, records - i)
+        flat = struct.unpack_from("<" + "Hid" * n, view,
+                offset + i * _record.size)
+        if max(flat[0::3]) >= count:
+            raise ValueError("invalid series index")
+        ids.extend(flat[0::3])
+        deltas.extend(flat[1::3])
+        values.extend(flat[2::3])
+
+    if not any(histogram):
+        return Records(names, ids, deltas, values, base), []
+
+    # Split the columns by the kind of series
+    is_histogram = map(histogram.__getitem__, ids)
+    is_normal = map(operator.not_, is_histogram)
+    return [Records(names, list(compress(ids, selectors)),
+            list(compress(deltas, selectors)),
+            list(compress(values, selectors)), base)
+            for selectors in (is_normal, is_histogram)]
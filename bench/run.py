@@ -0,0 +1,400 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Offline benchmarks of the hot paths of the app. They run against the App
+Engine testbed stubs (datastore, memcache, taskqueue, users), so no server
+or network access is needed:
+
+    python bench/run.py --sdk ~/google_appengine --output before.json
+    ... change the code ...
+    python bench/run.py --sdk ~/google_appengine --compare before.json
+
+Every benchmark case reports ops/sec (best of --repeat runs), the API calls
+per run by service and method (eg. datastore_v3.Get) and the cache counters
+of tools.stats, both averaged over the runs, and how much the case raised
+the peak memory of the process. Cases run after a case that used more
+memory show no growth, so run them alone (--only) to measure their peak.
+
+--output writes the results as JSON. --compare prints the changes against
+an earlier JSON file and exits with status 1 if a case got slower by more
+than --threshold percent or makes more API calls, so it can be run before
+every deploy.
+
+The stubs are much faster than the real services: compare the API calls
+across releases, but ops/sec only between runs on the same machine.
+"""
+from __future__ import print_function
+
+import os
+import gc
+import sys
+import json
+import time
+import logging
+import argparse
+import platform
+import resource
+import subprocess
+
+ROOT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+APP_DIR = os.path.join(ROOT_DIR, "app")
+
+# Fixed start of the generated samples, aligned to a chunk window
+SAMPLES_START = 1300003200
+
+# Functions that prepare a benchmark, see benchmark()
+BENCHMARKS = []
+
+
+def benchmark(func):
+    """Registers a benchmark. func(bed, options) prepares its data and
+    returns a list of (name, before, run, ops) cases: before() resets the
+    state and is not timed (may be None), run() is timed and does ops
+    operations."""
+    BENCHMARKS.append(func)
+    return func
+
+
+def setup_paths(sdk):
+    """Makes the SDK, its bundled libraries and the app importable"""
+    sys.path.insert(0, sdk)
+    import dev_appserver
+    dev_appserver.fix_sys_path()
+
+    # The app uses Django 1.2 (see app.yaml)
+    sys.path.insert(0, os.path.join(sdk, "lib", "django-1.2"))
+    sys.path.insert(0, APP_DIR)
+    os.environ["DJANGO_SETTINGS_MODULE"] = "settings"
+
+
+def activate_testbed():
+    from google.appengine.datastore import datastore_stub_util
+    from google.appengine.ext import testbed
+
+    bed = testbed.Testbed()
+    bed.activate()
+    bed.setup_env(USER_EMAIL="bench@example.com", USER_ID="1",
+            USER_IS_ADMIN="1", overwrite=True)
+
+    # Queries see all writes immediately, as in a quiet production app
+    policy = datastore_stub_util.PseudoRandomHRConsistencyPolicy(probability=1)
+    bed.init_datastore_v3_stub(consistency_policy=policy)
+    bed.init_memcache_stub()
+    bed.init_taskqueue_stub(root_path=APP_DIR)
+    bed.init_user_stub()
+    return bed
+
+
+def clear_local_caches():
+    """Empties the in-process caches: the LRUs of mc.tiered and the ndb
+    context cache"""
+    from google.appengine.ext import ndb
+    import mc
+    import common.templateaddons
+
+    for cache in (mc.cache.userprefs_cache, mc.cache.alert_rules_cache,
+            common.templateaddons.fragment_cache):
+        cache.local.clear()
+    ndb.get_context().clear_cache()
+
+
+def clear_caches():
+    from google.appengine.api import memcache
+    memcache.flush_all()
+    clear_local_caches()
+
+
+@benchmark
+def userprefs(bed, options):
+    """UserPrefs.from_user with a cold cache, with the value in memcache
+    only and with the value in the in-process tier"""
+    from google.appengine.api import users
+    from models import UserPrefs
+
+    people = [users.User("user%s@example.com" % i, _user_id=str(i))
+            for i in xrange(100)]
+
+    def run():
+        for user in people:
+            UserPrefs.from_user(user)
+
+    # Creates the UserPrefs
+    run()
+
+    return [
+        ("userprefs.cold", clear_caches, run, len(people)),
+        ("userprefs.memcache", clear_local_caches, run, len(people)),
+        ("userprefs.local", run, run, len(people)),
+    ]
+
+
+def check_templates(bed):
+    """Renders index.html and account.html for an anonymous and a logged in
+    user, and checks that the templates see the user's UserPrefs. Raises
+    AssertionError otherwise."""
+    import webapp2
+    from google.appengine.api import users
+    from handlers.baserequesthandler import BaseRequestHandler
+    from models import UserPrefs
+
+    def render(name):
+        clear_local_caches()
+        handler = BaseRequestHandler(webapp2.Request.blank("/"),
+                webapp2.Response())
+        handler.render(name)
+        return handler.response.body
+
+    prefs = UserPrefs.from_user(users.get_current_user())
+    prefs.nickname = "Bench Nickname"
+    prefs.email = "bench@example.com"
+    prefs.subscribed_to_newsletter = True
+    prefs.put()
+
+    body = render("index.html")
+    assert "Welcome, Bench Nickname" in body, "index.html: no nickname"
+    assert 'href="/logout"' in body, "index.html: no logout button"
+    body = render("account.html")
+    assert 'name="subscribe" value="on"' in body, \
+            "account.html: newsletter subscription not set"
+    assert 'value="bench@example.com"' in body, "account.html: no email"
+
+    bed.setup_env(USER_EMAIL="", USER_ID="", overwrite=True)
+    try:
+        body = render("index.html")
+        assert "Welcome" not in body, "index.html: welcome for anonymous"
+        assert 'href="/logout"' not in body, \
+                "index.html: logout button for anonymous"
+        body = render("account.html")
+        assert 'name="subscribe" value=""' in body, \
+                "account.html: subscription set for anonymous"
+    finally:
+        bed.setup_env(USER_EMAIL="bench@example.com", USER_ID="1",
+                USER_IS_ADMIN="1", overwrite=True)
+
+
+@benchmark
+def render(bed, options):
+    """BaseRequestHandler.render of every template, for a logged in user.
+    Checks the rendered pages first (see check_templates())."""
+    import webapp2
+    from handlers.baserequesthandler import BaseRequestHandler, TEMPLATE_DIR
+
+    check_templates(bed)
+    loops = 20
+    cases = []
+    for name in sorted(os.listdir(TEMPLATE_DIR)):
+        if not name.endswith(".html"):
+            continue
+
+        def run(name=name):
+            for i in xrange(loops):
+                handler = BaseRequestHandler(webapp2.Request.blank("/"),
+                        webapp2.Response())
+                handler.render(name)
+
+        cases.append(("render.%s" % name[:-5], None, run, loops))
+    return cases
+
+
+@benchmark
+def fanout(bed, options):
+    """Cron1 scanning all Emails and adding the worker tasks"""
+    import webapp2
+    from google.appengine.ext import ndb
+    from google.appengine.ext import testbed
+    from models import Emails
+    import services
+
+    taskqueue_stub = bed.get_stub(testbed.TASKQUEUE_SERVICE_NAME)
+    created = [0]
+
+    def fill(size):
+        while created[0] < size:
+            batch = min(500, size - created[0])
+            ndb.put_multi([Emails(to="user%s@example.com" % (created[0] + i),
+                    subject="Hello", body_text="Hello") for i in xrange(batch)])
+            created[0] += batch
+
+    def run():
+        services.Cron1(webapp2.Request.blank("/services/cron1"),
+                webapp2.Response()).get()
+
+    cases = []
+    for size in sorted(options.fanout_sizes):
+        def before(size=size):
+            fill(size)
+            taskqueue_stub.FlushQueue("default")
+            ndb.get_context().clear_cache()
+
+        cases.append(("cron1.fanout.%s" % size, before, run, size))
+    return cases
+
+
+@benchmark
+def ingest(bed, options):
+    """metrics.write_samples of a 10k sample batch into new chunks, and
+    read_range of every series of the batch"""
+    from google.appengine.ext import ndb
+    import metrics
+    from models import Project, SeriesChunk
+
+    project = Project.create("bench")
+    series = ["host%s.cpu" % i for i in xrange(20)]
+    samples = [(series[i % len(series)], SAMPLES_START + i // len(series) * 10,
+            float(i % 100)) for i in xrange(10000)]
+    end = samples[-1][1] + 1
+
+    def delete_chunks():
+        ndb.delete_multi(SeriesChunk.query(
+                SeriesChunk.project == project.key).fetch(keys_only=True))
+        ndb.get_context().clear_cache()
+
+    def write():
+        metrics.write_samples(project, samples)
+
+    def read():
+        for name in series:
+            metrics.read_range(project, name, SAMPLES_START, end)
+
+    return [
+        ("ingest.write", delete_chunks, write, len(samples)),
+        ("ingest.read_range", lambda: ndb.get_context().clear_cache(), read,
+                len(series)),
+    ]
+
+
+def run_case(before, run, ops, repeat):
+    import tools.stats
+
+    timings = []
+    calls = {}
+    counters = {}
+    peak_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    for i in xrange(repeat):
+        if before:
+            before()
+        gc.collect()
+        with tools.stats.recording() as stats:
+            started = time.time()
+            run()
+            timings.append(time.time() - started)
+
+        for name, (n, t) in stats["calls"].iteritems():
+            calls[name] = calls.get(name, 0) + n
+        for name, n in stats["counts"].iteritems():
+            counters[name] = counters.get(name, 0) + n
+
+    best = min(timings)
+    calls = dict((name, n / float(repeat)) for name, n in calls.iteritems())
+    counters = dict((name, n / float(repeat))
+            for name, n in counters.iteritems())
+    return {
+        "ops": ops,
+        "ops_per_sec": ops / best if best else None,
+        "best_seconds": best,
+        "median_seconds": sorted(timings)[len(timings) // 2],
+        "rpc_calls": calls,
+        "rpc_total": sum(calls.itervalues()),
+        "counters": counters,
+        # ru_maxrss only grows, so only the growth is specific to the case
+        "peak_rss_growth_kb": resource.getrusage(
+                resource.RUSAGE_SELF).ru_maxrss - peak_before,
+    }
+
+
+def run_benchmarks(options):
+    bed = activate_testbed()
+    results = {}
+    try:
+        for func in BENCHMARKS:
+            if options.only and not any(pattern in func.__name__
+                    for pattern in options.only):
+                continue
+            for name, before, run, ops in func(bed, options):
+                result = run_case(before, run, ops, options.repeat)
+                results[name] = result
+                print("%-28s %12.1f ops/s %8.1f rpcs %+9d kB" % (name,
+                        result["ops_per_sec"] or 0, result["rpc_total"],
+                        result["peak_rss_growth_kb"]))
+    finally:
+        bed.deactivate()
+    return results
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short",
+                "HEAD"], cwd=ROOT_DIR).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(old, new, threshold):
+    """Prints the changes of new against old results. Returns the names of
+    the cases that got slower by more than threshold percent or make more
+    API calls."""
+    regressions = []
+    print()
+    print("Compared to %s (%s):" % (old.get("revision"), old.get("date")))
+    for name in sorted(new["results"]):
+        result = new["results"][name]
+        previous = old["results"].get(name)
+        if not previous:
+            print("%-28s new" % name)
+            continue
+
+        change = 0.0
+        if previous["ops_per_sec"] and result["ops_per_sec"]:
+            change = (result["ops_per_sec"] / previous["ops_per_sec"] - 1) * 100
+        more_calls = result["rpc_total"] > previous["rpc_total"]
+        flag = ""
+        if change < -threshold or more_calls:
+            regressions.append(name)
+            flag = "  REGRESSION"
+        print("%-28s %+7.1f%% ops/s  rpcs %.1f -> %.1f%s" % (name, change,
+                previous["rpc_total"], result["rpc_total"], flag))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--sdk", default=os.environ.get("APPENGINE_SDK"),
+            help="path of the App Engine SDK (default: $APPENGINE_SDK)")
+    parser.add_argument("--only", action="append",
+            help="run only the benchmarks whose name contains this")
+    parser.add_argument("--repeat", type=int, default=5,
+            help="runs per case, the best one is reported")
+    parser.add_argument("--fanout-sizes", default="1000,10000,100000",
+            type=lambda s: [int(n) for n in s.split(",")],
+            help="comma-separated numbers of entities for Cron1")
+    parser.add_argument("--output", help="write the results as JSON")
+    parser.add_argument("--compare", help="JSON results to compare with")
+    parser.add_argument("--threshold", type=float, default=10.0,
+            help="slowdown in percent that counts as a regression")
+    options = parser.parse_args()
+    if not options.sdk:
+        parser.error("--sdk or $APPENGINE_SDK is required")
+
+    setup_paths(options.sdk)
+    logging.getLogger().setLevel(logging.WARNING)
+
+    report = {
+        "revision": git_revision(),
+        "date": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "python": platform.python_version(),
+        "repeat": options.repeat,
+        "results": run_benchmarks(options),
+    }
+
+    if options.output:
+        with open(options.output, "w") as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+
+    if options.compare:
+        with open(options.compare) as f:
+            if compare(json.load(f), report, options.threshold):
+                sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()